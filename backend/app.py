@@ -1,22 +1,36 @@
 from fastapi import FastAPI, HTTPException, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
-from fastapi.staticfiles import StaticFiles
 from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 import yt_dlp
+from yt_dlp.postprocessor import get_postprocessor
+from yt_dlp.networking import Request as YDLRequest
 import os
 import uuid
 import re
 import asyncio
+import anyio
+import copy
+import hashlib
+import secrets
+import json
+import threading
 from pathlib import Path
 import shutil
 import logging
 import zipfile
-from typing import Optional
+import tempfile
+from typing import Optional, Union
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass, field, replace
 import subprocess
 import requests
+from urllib.parse import urljoin
 from PIL import Image
 from io import BytesIO
 from mutagen.mp4 import MP4, MP4Cover
@@ -24,14 +38,33 @@ import time
 from datetime import datetime
 from dotenv import load_dotenv
 import glob
+from shared_store import SharedStore, LockTimeout, create_store
+from range_downloader import download_parallel
+from fingerprint import AudioLibrary, INDEX_SECONDS, PROBE_SECONDS, compute_fingerprint, decode_pcm
+from memory_budget import MemoryBudget, current_rss, rss_over_limit, wait_for_rss
+from profiler import Profiler, ProfilingMiddleware
+from scheduler import PREFETCH_LANE, PREVIEW_LANE, QueueCancelled, QueueTimeout, Slot, WorkScheduler, estimate_cost
+from static_assets import PrecompressedStaticFiles, precompress_directory
+from upstream_limiter import UpstreamLimiter, parse_host_rates
+from tracing import TracingMiddleware, create_tracer, install_log_correlation, set_attributes, current_request_id
 
 # 環境変数を読み込み
 load_dotenv()
 
-# ログ設定
+# ログ設定（リクエストIDを付けて出力）
 logging.basicConfig(level=logging.INFO)
+install_log_correlation()
 logger = logging.getLogger(__name__)
 
+# トレーシング設定（サンプリング率0で無効、リクエストIDは常に付与）
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+tracer = create_tracer(
+    TRACE_SAMPLE_RATE,
+    os.getenv("TRACE_EXPORTER", "memory"),
+    file_path=os.getenv("TRACE_FILE"),
+    otlp_endpoint=os.getenv("TRACE_OTLP_ENDPOINT"),
+)
+
 def find_ffmpeg_path():
     """FFmpegのパスを検索"""
     logger.info("FFmpegの検索を開始...")
@@ -149,7 +182,23 @@ def find_ffmpeg_path():
     logger.error("❌ FFmpegが見つかりません")
     return None
 
-app = FastAPI(title="YouTube M4A Downloader", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """アプリの起動・終了処理"""
+    sweeper = asyncio.create_task(sweep_prefetches())
+    yield
+    # シャットダウン: 新規ジョブを止めて実行中ジョブの完了を待つ
+    sweeper.cancel()
+    prefetch_manager.shutdown()
+    remaining = await run_in_threadpool(job_tracker.drain, DRAIN_TIMEOUT)
+    if remaining:
+        logger.warning(f"ドレイン完了前に停止: 未完了ジョブ {remaining}件")
+    else:
+        logger.info("✅ ドレイン完了")
+    tracer.shutdown()
+    shared_store.close()
+
+app = FastAPI(title="YouTube M4A Downloader", version="1.0.0", lifespan=lifespan)
 
 # CORS設定 - 本番環境対応
 allowed_origins = os.getenv("ALLOWED_ORIGINS", "*").split(",")
@@ -166,28 +215,98 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID", "X-Output-Profile", "X-Encode-Seconds"],
 )
 
+# 管理API用のトークン（未設定の場合は管理APIを無効にする）
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# オンデマンドのサンプリングプロファイラ（管理APIで有効にしたときだけ動作）
+profiler = Profiler()
+app.add_middleware(ProfilingMiddleware, profiler=profiler, admin_token=ADMIN_TOKEN, request_id=current_request_id)
+
+# リクエストIDの付与とリクエスト単位のトレース
+app.add_middleware(TracingMiddleware, tracer=tracer)
+
 # ダウンロードディレクトリの設定（Railway環境では/tmpを使用）
 DOWNLOAD_DIR = Path("/tmp/downloads")
 DOWNLOAD_DIR.mkdir(exist_ok=True)
 
+# 共有ストアの設定（複数ワーカーの場合は既定で同一ホスト用のSQLiteを使用）
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+SHARED_STORE_URL = os.getenv("SHARED_STORE_URL") or (
+    "sqlite:////tmp/imusic-shared/store.db" if WEB_CONCURRENCY > 1 else "memory://"
+)
+# memory:// の場合にステージキャッシュ（動画情報・ジャケット画像）に使う合計サイズ（MB）
+SHARED_STORE_MEMORY_CACHE_MB = float(os.getenv("SHARED_STORE_MEMORY_CACHE_MB", "64"))
+shared_store = create_store(SHARED_STORE_URL, memory_cache_bytes=int(SHARED_STORE_MEMORY_CACHE_MB * 1024 * 1024))
+
+# 上流（YouTube・サムネイル配信）への送信レート制限（既定は無効）
+#   ホストごとのリクエスト数と全体の受信帯域を制限し、UPSTREAM_LIMIT_SHARED でワーカー間で共有する
+UPSTREAM_REQUESTS_PER_SECOND = float(os.getenv("UPSTREAM_REQUESTS_PER_SECOND", "0"))
+UPSTREAM_REQUEST_BURST = float(os.getenv("UPSTREAM_REQUEST_BURST", "5"))
+UPSTREAM_HOST_RATES = parse_host_rates(os.getenv("UPSTREAM_HOST_RATES", ""))
+UPSTREAM_MAX_MB_PER_SECOND = float(os.getenv("UPSTREAM_MAX_MB_PER_SECOND", "0"))
+UPSTREAM_LIMIT_SHARED = os.getenv("UPSTREAM_LIMIT_SHARED", "false").lower() in ("1", "true", "yes")
+upstream_limiter = UpstreamLimiter(
+    requests_per_second=UPSTREAM_REQUESTS_PER_SECOND,
+    burst=UPSTREAM_REQUEST_BURST,
+    bytes_per_second=UPSTREAM_MAX_MB_PER_SECOND * 1024 * 1024,
+    host_rates=UPSTREAM_HOST_RATES,
+    store=shared_store if UPSTREAM_LIMIT_SHARED else None,
+)
+
+
+class PacedYoutubeDL(yt_dlp.YoutubeDL):
+    """上流へのリクエストをレート制限に従わせる YoutubeDL
+
+    抽出・ダウンロード（HttpFD、フラグメント、並列レンジ取得）はすべて urlopen を通るため、
+    ここで送信前に待ち、レスポンス本文の読み込みを帯域制限に従わせる。
+    yt-dlp の ratelimit はダウンロード1件ごとの制限で、全体の上限にはならないため使わない。
+    """
+
+    def urlopen(self, req):
+        url = req if isinstance(req, str) else getattr(req, 'url', None) or getattr(req, 'full_url', '')
+        upstream_limiter.acquire_request(url)
+        return upstream_limiter.pace_response(super().urlopen(req))
+
+
 # テンプレートの設定
 templates = Jinja2Templates(directory="templates")
 
 # 静的ファイル配信の設定（プロダクション環境用）
+#   起動時に .gz/.br を作成し、圧縮済みファイル・長期キャッシュ・小さいファイルのメモリキャッシュで配信する
+STATIC_PRECOMPRESS = os.getenv("STATIC_PRECOMPRESS", "true").lower() in ("1", "true", "yes")
+STATIC_MEMORY_CACHE_BYTES = int(float(os.getenv("STATIC_MEMORY_CACHE_MB", "16")) * 1024 * 1024)
+static_files = asset_files = None
 if Path("../dist").exists():
-    app.mount("/assets", StaticFiles(directory="../dist/assets"), name="assets")
-    app.mount("/static", StaticFiles(directory="../dist"), name="static")
+    if STATIC_PRECOMPRESS:
+        try:
+            precompress_directory(Path("../dist"))
+        except Exception as e:
+            logger.warning(f"静的ファイルの事前圧縮に失敗（圧縮なしで配信します）: {e}")
+    asset_files = PrecompressedStaticFiles(directory="../dist/assets", memory_cache_bytes=STATIC_MEMORY_CACHE_BYTES,
+                                           immutable_hashed=True)
+    static_files = PrecompressedStaticFiles(directory="../dist", memory_cache_bytes=STATIC_MEMORY_CACHE_BYTES)
+    app.mount("/assets", asset_files, name="assets")
+    app.mount("/static", static_files, name="static")
 
 class DownloadRequest(BaseModel):
     url: str
+    # 切り出す範囲（秒または "1:23:45" 形式）。省略時は全体
+    start: Optional[Union[float, str]] = None
+    end: Optional[Union[float, str]] = None
+    # 出力プロファイル（standard / mobile / passthrough）。省略時は OUTPUT_PROFILE
+    profile: Optional[str] = None
 
 class DownloadResponse(BaseModel):
     success: bool
     message: str
     file_path: str = ""
     file_name: str = ""
+    profile: str = ""
+    encode_seconds: float = 0.0
+    file_size: int = 0
 
 class PreviewRequest(BaseModel):
     url: str
@@ -206,6 +325,51 @@ class DownloadWithMetadataRequest(BaseModel):
     url: str
     title: str
     artist: str
+    start: Optional[Union[float, str]] = None
+    end: Optional[Union[float, str]] = None
+    profile: Optional[str] = None
+
+class BatchPreviewRequest(BaseModel):
+    urls: list[str]
+    details: bool = True
+
+class ProfileStartRequest(BaseModel):
+    requests: int = 0
+    seconds: float = 0
+    interval_ms: float = 10
+
+def parse_clip_range(start, end) -> Optional[tuple]:
+    """start/end（秒または "1:23:45" 形式）を検証して (開始秒, 終了秒) にする
+
+    end を省略した場合は最後まで（None）。どちらも省略、または全体を指す場合は None を返す。
+    """
+    def seconds(value, name):
+        if value is None or value == "":
+            return None
+        parsed = value if isinstance(value, (int, float)) else yt_dlp.utils.parse_duration(str(value).strip())
+        if parsed is None or parsed < 0:
+            raise ValueError(f"{name} の形式が正しくありません: {value}")
+        return float(parsed)
+
+    clip_start = seconds(start, "start") or 0.0
+    clip_end = seconds(end, "end")
+    if clip_end is not None and clip_end <= clip_start:
+        raise ValueError("end は start より後の時刻を指定してください")
+    if clip_start == 0 and clip_end is None:
+        return None
+    return clip_start, clip_end
+
+def parse_output_profile(profile: Optional[str]) -> str:
+    """出力プロファイルを検証する（省略時は OUTPUT_PROFILE）"""
+    profile = (profile or OUTPUT_PROFILE).strip().lower()
+    if profile not in OUTPUT_PROFILES:
+        raise ValueError(f"出力プロファイルが正しくありません: {profile}（{' / '.join(OUTPUT_PROFILES)}）")
+    return profile
+
+def clip_label(clip: tuple) -> str:
+    """範囲の表記（ファイル名・キャッシュキー用）: 90-300s / 90s-"""
+    start, end = clip
+    return f"{start:g}-{end:g}s" if end is not None else f"{start:g}s-"
 
 def sanitize_filename(filename: str) -> str:
     """ファイル名を安全な形式に変換"""
@@ -277,64 +441,126 @@ def parse_title_artist(title: str, uploader: str = None) -> tuple[str, str]:
     # パターンにマッチしない場合、全体をタイトルとして使用
     return title.strip(), "Unknown Artist"
 
-def download_and_process_thumbnail(thumbnail_url: str, output_path: Path) -> bool:
-    """サムネイル画像をダウンロードして800x800の正方形に加工"""
+# サムネイル画像の上限（ダウンロードサイズとデコード後の画素数）
+THUMBNAIL_MAX_BYTES = int(os.getenv("THUMBNAIL_MAX_BYTES", str(5 * 1024 * 1024)))
+THUMBNAIL_MAX_PIXELS = int(os.getenv("THUMBNAIL_MAX_PIXELS", str(4096 * 4096)))
+COVER_SIZE = 800
+
+# 画像デコードに同時に使えるメモリの合計（ジョブごとに見積もり量を確保してからデコードする）
+image_memory = MemoryBudget(int(os.getenv("IMAGE_MEMORY_BUDGET_MB", "256")) * 1024 * 1024)
+
+# fetch_limited で追うリダイレクトの最大回数
+MAX_FETCH_REDIRECTS = 5
+
+def fetch_limited(url: str, max_bytes: int, timeout: float = 30) -> bytes:
+    """Content-Length とストリーム読み込みでサイズを制限してダウンロード
+
+    リダイレクトは自前で追い、リクエストごとに上流のレート制限を通す。
+    """
+    for _ in range(MAX_FETCH_REDIRECTS + 1):
+        upstream_limiter.acquire_request(url)
+        with requests.get(url, timeout=timeout, stream=True, allow_redirects=False) as response:
+            if response.is_redirect:
+                url = urljoin(url, response.headers['Location'])
+                continue
+            response.raise_for_status()
+            content_length = response.headers.get('Content-Length')
+            if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+                raise ValueError(f"サイズが上限を超えています: {content_length} > {max_bytes} bytes")
+            buffer = bytearray()
+            for chunk in response.iter_content(64 * 1024):
+                upstream_limiter.acquire_bytes(len(chunk))
+                buffer.extend(chunk)
+                if len(buffer) > max_bytes:
+                    raise ValueError(f"サイズが上限を超えています: > {max_bytes} bytes")
+            return bytes(buffer)
+    raise ValueError(f"リダイレクトが多すぎます: {url}")
+
+@tracer.traced("download_and_process_thumbnail")
+def download_and_process_thumbnail(thumbnail_url: str) -> Optional[bytes]:
+    """サムネイル画像をダウンロードして800x800の正方形JPEGに加工（メモリ上で処理）
+
+    ダウンロードサイズと画素数に上限を設け、JPEGは必要な解像度まで縮小してデコードする。
+    デコードに使うメモリは image_memory の予算から確保する。
+    """
     try:
         logger.info(f"サムネイル画像をダウンロード中: {thumbnail_url}")
-        
+
+        data = None
         # より高解像度のサムネイルを取得するためのURL調整
         if 'maxresdefault' not in thumbnail_url:
             # YouTubeの場合、最高解像度のサムネイルを試行
             if 'i.ytimg.com' in thumbnail_url:
                 high_res_url = thumbnail_url.replace('hqdefault', 'maxresdefault')
                 try:
-                    response = requests.get(high_res_url, timeout=30)
-                    if response.status_code == 200:
-                        thumbnail_url = high_res_url
-                        logger.info("高解像度サムネイルを使用")
+                    # 取得したデータをそのまま使い、同じ画像を再取得しない
+                    data = fetch_limited(high_res_url, THUMBNAIL_MAX_BYTES)
+                    logger.info("高解像度サムネイルを使用")
                 except:
                     pass  # 失敗した場合は元のURLを使用
-        
-        response = requests.get(thumbnail_url, timeout=30)
-        response.raise_for_status()
-        
-        # 画像を開く
-        img = Image.open(BytesIO(response.content))
-        logger.info(f"元画像サイズ: {img.size}")
-        
-        # RGBモードに変換（透明度を削除）
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        
-        # 正方形にクロップ（中央部分を使用）
+
+        if data is None:
+            data = fetch_limited(thumbnail_url, THUMBNAIL_MAX_BYTES)
+
+        # 画像を開く（この時点ではヘッダーのみ読み込まれ、デコードはされない）
+        img = Image.open(BytesIO(data))
         width, height = img.size
-        size = min(width, height)
-        left = (width - size) // 2
-        top = (height - size) // 2
-        right = left + size
-        bottom = top + size
-        
-        img_cropped = img.crop((left, top, right, bottom))
-        logger.info(f"クロップ後サイズ: {img_cropped.size}")
-        
-        # 800x800にリサイズ（高品質リサンプリング）
-        img_resized = img_cropped.resize((800, 800), Image.Resampling.LANCZOS)
-        
+        logger.info(f"元画像サイズ: {img.size}")
+        if width * height > THUMBNAIL_MAX_PIXELS:
+            raise ValueError(f"画素数が上限を超えています: {width}x{height} > {THUMBNAIL_MAX_PIXELS}")
+
+        # JPEGは短辺がジャケットサイズを下回らない範囲で縮小デコードする
+        shorter = min(width, height)
+        if shorter > COVER_SIZE:
+            img.draft('RGB', (-(-width * COVER_SIZE // shorter), -(-height * COVER_SIZE // shorter)))
+            if img.size != (width, height):
+                logger.info(f"縮小デコード: {(width, height)} -> {img.size}")
+
+        # デコード後の画像、クロップ、リサイズ結果の分を見積もって確保
+        estimate = img.size[0] * img.size[1] * 4 * 2 + COVER_SIZE * COVER_SIZE * 3 * 2
+        with image_memory.reserve(estimate):
+            # 800x800の正方形に加工
+            cover_data = make_square_cover(img, sharpen=True)
+        logger.info(f"✅ サムネイル画像処理完了 ({len(cover_data)} bytes)")
+        return cover_data
+
+    except Exception as e:
+        logger.error(f"サムネイル画像処理エラー: {e}")
+        return None
+
+def make_square_cover(img: Image.Image, sharpen: bool = False) -> bytes:
+    """画像を中央で正方形にクロップし、800x800のJPEGバイト列にする"""
+    # RGBモードに変換（透明度を削除）
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    # 正方形にクロップ（中央部分を使用）
+    width, height = img.size
+    size = min(width, height)
+    left = (width - size) // 2
+    top = (height - size) // 2
+    right = left + size
+    bottom = top + size
+
+    img_cropped = img.crop((left, top, right, bottom))
+    logger.info(f"クロップ後サイズ: {img_cropped.size}")
+
+    # 800x800にリサイズ（高品質リサンプリング）
+    img_resized = img_cropped.resize((COVER_SIZE, COVER_SIZE), Image.Resampling.LANCZOS)
+
+    if sharpen:
         # 画質を向上させるためのシャープネス調整
         from PIL import ImageEnhance
         enhancer = ImageEnhance.Sharpness(img_resized)
-        img_enhanced = enhancer.enhance(1.2)  # シャープネスを20%向上
-        
-        # 保存
-        img_enhanced.save(output_path, 'JPEG', quality=95, optimize=True)
-        logger.info(f"✅ サムネイル画像処理完了: {output_path.name}")
-        return True
-        
-    except Exception as e:
-        logger.error(f"サムネイル画像処理エラー: {e}")
-        return False
+        img_resized = enhancer.enhance(1.2)  # シャープネスを20%向上
+
+    buffer = BytesIO()
+    img_resized.save(buffer, 'JPEG', quality=95, optimize=True)
+    return buffer.getvalue()
 
-def add_metadata_to_m4a(m4a_path: Path, title: str, artist: str, album: str = None, thumbnail_path: Path = None):
+@tracer.traced("add_metadata_to_m4a")
+def add_metadata_to_m4a(m4a_path: Path, title: str, artist: str, album: str = None, thumbnail_path: Path = None,
+                        cover_data: bytes = None):
     """M4Aファイルにメタデータとジャケット画像を追加"""
     try:
         logger.info(f"メタデータを追加中: {m4a_path.name}")
@@ -355,8 +581,11 @@ def add_metadata_to_m4a(m4a_path: Path, title: str, artist: str, album: str = No
         audio['\xa9day'] = [str(datetime.now().year)]  # 年
         audio['\xa9gen'] = ['Music']  # ジャンル
         
-        # ジャケット画像を追加
-        if thumbnail_path and thumbnail_path.exists():
+        # ジャケット画像を追加（メモリ上の画像を優先）
+        if cover_data:
+            audio['covr'] = [MP4Cover(cover_data, MP4Cover.FORMAT_JPEG)]
+            logger.info(f"✅ ジャケット画像を追加 ({len(cover_data)} bytes)")
+        elif thumbnail_path and thumbnail_path.exists():
             try:
                 with open(thumbnail_path, 'rb') as img_file:
                     img_data = img_file.read()
@@ -391,8 +620,9 @@ def get_ydl_opts(temp_dir: Path, is_playlist: bool = False, use_fallback: bool =
         'ignoreerrors': True,
         'no_warnings': False,
         'extract_flat': False,
-        'writeinfojson': True,
-        'writethumbnail': True,
+        # メディア本体のみを書き出す（info dictとサムネイルはメモリ上で扱う）
+        'writeinfojson': False,
+        'writethumbnail': False,
         'writesubtitles': False,
         'writeautomaticsub': False,
         'socket_timeout': 120,
@@ -457,12 +687,1479 @@ def get_ydl_opts(temp_dir: Path, is_playlist: bool = False, use_fallback: bool =
     
     return base_opts
 
+def detect_container(path: Path) -> Optional[str]:
+    """ファイル先頭のマジックバイトから実際のコンテナ形式を判定"""
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(12)
+    except OSError:
+        return None
+
+    if head[4:8] == b'ftyp':
+        return '3gp' if head[8:10] == b'3g' else 'mp4'
+    if head.startswith(b'\x1a\x45\xdf\xa3'):
+        return 'matroska'
+    if head.startswith(b'FLV'):
+        return 'flv'
+    if head.startswith(b'RIFF') and head[8:12] == b'AVI ':
+        return 'avi'
+    if head.startswith(b'OggS'):
+        return 'ogg'
+    if head.startswith(b'ID3') or head[:2] in (b'\xff\xfb', b'\xff\xf3', b'\xff\xf2'):
+        return 'mp3'
+    if head[:2] in (b'\xff\xf1', b'\xff\xf9'):
+        return 'aac'
+    return None
+
+# mobile プロファイルのビットレート（libfdk_aac があれば HE-AAC、なければ FFmpeg 標準の AAC-LC）
+MOBILE_HE_AAC_BITRATE = "48k"
+MOBILE_AAC_BITRATE = "64k"
+
+# パススルーでAAC以外の音声を元の形式のまま取り出す場合のコンテナ（拡張子, FFmpegのフォーマット）
+PASSTHROUGH_CONTAINERS = {
+    'opus': ('.ogg', 'ogg'),
+    'vorbis': ('.ogg', 'ogg'),
+    'mp3': ('.mp3', 'mp3'),
+}
+
+_ffmpeg_encoders = {}
+
+def ffmpeg_has_encoder(ffmpeg_path: str, name: str) -> bool:
+    """FFmpegがエンコーダーに対応しているか（一覧はFFmpegのパスごとに1回だけ取得）"""
+    encoders = _ffmpeg_encoders.get(ffmpeg_path)
+    if encoders is None:
+        try:
+            result = subprocess.run([ffmpeg_path, '-hide_banner', '-encoders'],
+                                    capture_output=True, text=True, timeout=10)
+            encoders = {line.split()[1] for line in result.stdout.splitlines() if len(line.split()) > 1}
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.warning(f"FFmpegのエンコーダー一覧を取得できません: {e}")
+            encoders = set()
+        _ffmpeg_encoders[ffmpeg_path] = encoders
+    return name in encoders
+
+def is_aac_codec(acodec: str = None) -> bool:
+    return bool(acodec) and (acodec.startswith('mp4a') or acodec == 'aac')
+
+def audio_codec_args(acodec: str = None, profile: str = "standard", ffmpeg_path: str = None) -> list:
+    """出力プロファイルに合わせたFFmpegの音声引数
+
+    standard / passthrough はAACをそのままコピーし、それ以外は128kのAACに再エンコードする。
+    mobile はAACでも低ビットレートに再エンコードする（libfdk_aac があれば HE-AAC）。
+    """
+    if profile == "mobile":
+        if ffmpeg_path and ffmpeg_has_encoder(ffmpeg_path, 'libfdk_aac'):
+            return ['-c:a', 'libfdk_aac', '-profile:a', 'aac_he', '-b:a', MOBILE_HE_AAC_BITRATE]
+        return ['-c:a', 'aac', '-b:a', MOBILE_AAC_BITRATE]
+    return ['-c:a', 'copy'] if is_aac_codec(acodec) else ['-c:a', 'aac', '-b:a', '128k']
+
+# FFmpeg実行中にキャンセルを確認する間隔（秒）
+FFMPEG_CANCEL_POLL_INTERVAL = 0.2
+
+def run_ffmpeg(cmd: list, input_data: bytes = None, cancel_event: threading.Event = None):
+    """FFmpegを実行し、失敗した場合はPipelineErrorを送出
+
+    cancel_event がセットされたらFFmpegを終了させ、キャンセルのPipelineErrorを送出する。
+    """
+    with tracer.span("ffmpeg", args=len(cmd)):
+        process = subprocess.Popen(
+            cmd, stdin=subprocess.PIPE if input_data is not None else subprocess.DEVNULL,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        while True:
+            try:
+                _, stderr = process.communicate(input_data, timeout=FFMPEG_CANCEL_POLL_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                # 標準入力は最初の呼び出しで渡し済み（再試行時に渡すとエラーになる）
+                input_data = None
+                if cancel_event is not None and cancel_event.is_set():
+                    process.terminate()
+                    try:
+                        process.communicate(timeout=5)
+                    except subprocess.TimeoutExpired:
+                        process.kill()
+                        process.communicate()
+                    logger.info("FFmpegを終了しました（キャンセル）")
+                    raise PipelineError("ジョブがキャンセルされました", status_code=499)
+    if process.returncode != 0:
+        stderr = stderr.decode('utf-8', 'replace').strip()
+        raise PipelineError(f"M4Aへの変換に失敗しました: {stderr[-200:]}")
+
+def remux_to_m4a(source: Path, ffmpeg_path: str, acodec: str = None, cancel_event: threading.Event = None,
+                 profile: str = "standard") -> Path:
+    """音声ストリームをM4A(MP4)コンテナに詰め替える（出力プロファイルに応じてコピーまたは再エンコード）"""
+    output = source.with_suffix('.m4a')
+    if output == source:
+        output = source.with_name(f"{source.stem}.remux.m4a")
+
+    codec_args = audio_codec_args(acodec, profile, ffmpeg_path)
+    cmd = [
+        ffmpeg_path, '-y', '-loglevel', 'error', '-i', str(source),
+        '-map', '0:a:0', '-vn', *codec_args, '-movflags', '+faststart', str(output),
+    ]
+    logger.info(f"M4Aにリマックス中: {source.name} ({'コピー' if 'copy' in codec_args else '再エンコード'})")
+    try:
+        run_ffmpeg(cmd, cancel_event=cancel_event)
+    except PipelineError:
+        output.unlink(missing_ok=True)
+        raise
+
+    source.unlink(missing_ok=True)
+    final = source.with_suffix('.m4a') if output.name.endswith('.remux.m4a') else output
+    if final != output:
+        output.rename(final)
+    return final
+
+def extract_audio_stream(source: Path, ffmpeg_path: str, acodec: str = None,
+                         cancel_event: threading.Event = None) -> Optional[Path]:
+    """音声ストリームを再エンコードせずに元の形式のまま取り出す（パススルー用）。対応外の形式は None"""
+    container = PASSTHROUGH_CONTAINERS.get((acodec or '').split('.')[0].lower())
+    if container is None:
+        return None
+    extension, muxer = container
+    output = source.with_name(f"{source.stem}.passthrough{extension}")
+    cmd = [
+        ffmpeg_path, '-y', '-loglevel', 'error', '-i', str(source),
+        '-map', '0:a:0', '-vn', '-c:a', 'copy', '-f', muxer, str(output),
+    ]
+    logger.info(f"音声をそのまま取り出し中: {source.name} ({acodec} → {extension})")
+    try:
+        run_ffmpeg(cmd, cancel_event=cancel_event)
+    except PipelineError:
+        output.unlink(missing_ok=True)
+        raise
+
+    source.unlink(missing_ok=True)
+    return output.rename(source.with_suffix(extension))
+
+def convert_single_pass(source: Path, ffmpeg_path: str, title: str, artist: str,
+                        cover_data: bytes = None, acodec: str = None, cancel_event: threading.Event = None,
+                        profile: str = "standard") -> Path:
+    """1回のFFmpeg実行で変換・ジャケット画像の埋め込み・タグ付けを行う
+
+    ジャケット画像は標準入力から渡すため、ディスクには書き出さない。
+    """
+    output = source.with_name(f"{source.stem}.tagged.m4a")
+    cmd = [ffmpeg_path, '-y', '-loglevel', 'error', '-i', str(source)]
+    if cover_data:
+        cmd += ['-f', 'jpeg_pipe', '-i', 'pipe:0']
+    cmd += ['-map', '0:a:0', *audio_codec_args(acodec, profile, ffmpeg_path)]
+    if cover_data:
+        cmd += ['-map', '1:v:0', '-c:v', 'copy', '-disposition:v:0', 'attached_pic']
+    cmd += [
+        # 元ファイルのメタデータは引き継がない（add_metadata_to_m4a の clear と同じ）
+        '-map_metadata', '-1',
+        '-metadata', f'title={title}',
+        '-metadata', f'artist={artist}',
+        '-metadata', f'date={datetime.now().year}',
+        '-metadata', 'genre=Music',
+        '-movflags', '+faststart', '-f', 'ipod', str(output),
+    ]
+    logger.info(f"1パス変換中（変換+ジャケット画像+タグ）: {source.name}")
+    try:
+        run_ffmpeg(cmd, input_data=cover_data, cancel_event=cancel_event)
+    except PipelineError:
+        output.unlink(missing_ok=True)
+        raise
+
+    source.unlink(missing_ok=True)
+    return output.rename(source.with_suffix('.m4a'))
+
+# ---------------------------------------------------------------------------
+# ダウンロードパイプライン
+#   resolve → match → queue → fetch → convert → cover → tag → deliver
+# ---------------------------------------------------------------------------
+
+PIPELINE_STAGES = ("resolve", "match", "queue", "fetch", "convert", "cover", "tag", "deliver")
+
+# 変換モード
+#   three_step:  yt-dlpで変換 → ジャケット画像作成 → mutagenでタグ付け（既定）
+#   single_pass: ジャケット画像作成後、1回のFFmpeg実行で変換とタグ付けを同時に行う
+CONVERT_MODES = ("three_step", "single_pass")
+CONVERT_MODE = os.getenv("CONVERT_MODE", "three_step")
+if CONVERT_MODE not in CONVERT_MODES:
+    raise ValueError(f"CONVERT_MODE が正しくありません: {CONVERT_MODE}（{' / '.join(CONVERT_MODES)}）")
+
+# 出力プロファイル（リクエストの profile で選択。プリフェッチなどの再利用はプロファイルごとに分ける）
+#   standard:    AAC 128k（AACのソースはコピー）
+#   mobile:      低ビットレート（libfdk_aac があれば HE-AAC 48k、なければ AAC-LC 64k）
+#   passthrough: 再エンコードしない（AACはM4Aに詰め替え、Opus/Vorbis/MP3は元の形式のまま取り出す）
+OUTPUT_PROFILES = ("standard", "mobile", "passthrough")
+OUTPUT_PROFILE = os.getenv("OUTPUT_PROFILE", "standard")
+if OUTPUT_PROFILE not in OUTPUT_PROFILES:
+    raise ValueError(f"OUTPUT_PROFILE が正しくありません: {OUTPUT_PROFILE}（{' / '.join(OUTPUT_PROFILES)}）")
+
+# 並列ダウンロード（1ジョブあたりの最大接続数、1で無効）
+#   HTTPの単一ファイルはバイト範囲ごと、DASH/HLSはyt-dlpのフラグメント単位で並列に取得する
+PARALLEL_DOWNLOAD_CONNECTIONS = max(1, int(os.getenv("PARALLEL_DOWNLOAD_CONNECTIONS", "1")))
+PARALLEL_DOWNLOAD_CHUNK_SIZE = int(float(os.getenv("PARALLEL_DOWNLOAD_CHUNK_MB", "4")) * 1024 * 1024)
+
+# 同一音源の再利用（動画IDが違っても、フィンガープリントが一致すれば処理済みのファイルを使う）
+FINGERPRINT_ENABLED = os.getenv("FINGERPRINT_ENABLED", "false").lower() in ("1", "true", "yes")
+FINGERPRINT_LIBRARY_DIR = Path(os.getenv("FINGERPRINT_LIBRARY_DIR", "/tmp/imusic-library"))
+FINGERPRINT_LIBRARY_MAX_BYTES = int(float(os.getenv("FINGERPRINT_LIBRARY_MAX_MB", "1024")) * 1024 * 1024)
+# 同一音源とみなす再生時間の差（秒）。歌詞動画などは前後に数秒の余白があることが多い
+FINGERPRINT_DURATION_TOLERANCE = float(os.getenv("FINGERPRINT_DURATION_TOLERANCE", "5"))
+# 照合用に取得する冒頭部分の余裕（コンテナのヘッダー分）
+FINGERPRINT_PROBE_HEADER_BYTES = 256 * 1024
+
+# 実行枠のスケジューリング（レーンごとの同時実行数、0で無制限）
+#   ダウンロードは resolve 後に推定処理量（再生時間×ビットレート）の小さい順、長時間の動画は別レーンで実行する
+SCHEDULER_DOWNLOAD_SLOTS = int(os.getenv("SCHEDULER_DOWNLOAD_SLOTS", "4"))
+SCHEDULER_PREVIEW_SLOTS = int(os.getenv("SCHEDULER_PREVIEW_SLOTS", "8"))
+SCHEDULER_LONG_JOB_SECONDS = float(os.getenv("SCHEDULER_LONG_JOB_SECONDS", "1800"))
+SCHEDULER_LONG_JOB_SLOTS = int(os.getenv("SCHEDULER_LONG_JOB_SLOTS", "1"))
+# 1秒待つごとに推定処理量をこの分だけ割り引く（大きいジョブが後回しにされ続けないように）
+SCHEDULER_AGING_MB_PER_SECOND = float(os.getenv("SCHEDULER_AGING_MB_PER_SECOND", "1"))
+SCHEDULER_QUEUE_TIMEOUT = float(os.getenv("SCHEDULER_QUEUE_TIMEOUT", "600"))
+# パイプラインを実行するスレッド数の上限（実行枠の待機中を含む）。
+#   プレビューなどが使う既定のスレッドプールとは別枠にし、待機中のジョブで塞がないようにする
+PIPELINE_THREAD_LIMIT = 100
+
+# コンテナ形式ごとの拡張子とMIMEタイプ（M4Aに変換できなかった場合の配信用）
+CONTAINER_EXTENSIONS = {
+    'mp4': '.m4a',
+    '3gp': '.3gp',
+    'matroska': '.webm',
+    'flv': '.flv',
+    'avi': '.avi',
+    'aac': '.aac',
+    'mp3': '.mp3',
+    'ogg': '.ogg',
+}
+
+MEDIA_TYPES = {
+    '.m4a': 'audio/m4a',
+    '.3gp': 'audio/3gpp',
+    '.webm': 'audio/webm',
+    '.flv': 'video/x-flv',
+    '.avi': 'video/x-msvideo',
+    '.aac': 'audio/aac',
+    '.mp3': 'audio/mpeg',
+    '.ogg': 'audio/ogg',
+}
+
+# 全パイプライン共通のステージ計測フック: hook(stage, elapsed, ctx, error)
+PIPELINE_HOOKS = []
+
+class PipelineError(Exception):
+    """パイプライン処理のエラー（HTTPステータスコード付き）"""
+
+    def __init__(self, message: str, status_code: int = 500):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+@dataclass
+class PipelineContext:
+    """1件のダウンロードジョブの状態"""
+    url: str
+    temp_dir: Path
+    job_id: str = ""
+    title: Optional[str] = None
+    artist: Optional[str] = None
+    use_fallback: bool = False
+    ydl: Optional[yt_dlp.YoutubeDL] = None
+    ffmpeg_path: Optional[str] = None
+    postprocessors: list = field(default_factory=list)
+    info: Optional[dict] = None
+    downloaded_info: Optional[dict] = None
+    produced_files: list = field(default_factory=list)
+    media_path: Optional[Path] = None
+    cover_data: Optional[bytes] = None
+    output_path: Optional[Path] = None
+    filename: str = ""
+    media_type: str = "audio/m4a"
+    tagged: bool = False
+    timings: dict = field(default_factory=dict)
+    cache_hits: set = field(default_factory=set)
+    files_written: int = 0
+    bytes_written: int = 0
+    fetch_stats: dict = field(default_factory=dict)
+    cancel_event: threading.Event = field(default_factory=threading.Event)
+    completed_stages: set = field(default_factory=set)
+    library_match: Optional[dict] = None
+    slot: Optional[Slot] = None
+    # 切り出す範囲 (開始秒, 終了秒 or None)。None なら全体
+    clip: Optional[tuple] = None
+    profile: str = "standard"
+    output_bytes: int = 0
+    # 投機的プリフェッチ（実行枠は低優先度の prefetch レーンから確保する）
+    speculative: bool = False
+
+    def record_write(self, path: Path):
+        """ジョブが書き込んだファイルを計上"""
+        try:
+            size = path.stat().st_size
+        except OSError:
+            return
+        self.files_written += 1
+        self.bytes_written += size
+
+    def cleanup(self):
+        """一時ディレクトリを削除"""
+        if self.temp_dir and self.temp_dir.exists():
+            try:
+                shutil.rmtree(self.temp_dir)
+                logger.info(f"一時ディレクトリを削除: {self.temp_dir}")
+            except Exception as e:
+                logger.warning(f"一時ディレクトリの削除に失敗: {e}")
+
+class StageCache:
+    """共有ストアに保存するステージ結果のキャッシュ
+
+    dictはJSON、bytesはそのまま保存するため、複数ワーカー間で共有できる。
+    """
+
+    def __init__(self, store: SharedStore):
+        self.store = store
+        # このワーカーでの参照結果（waited_hits: シングルフライトロックを待った後に見つかったもの）
+        self.stats = {"hits": 0, "waited_hits": 0, "misses": 0}
+        self._stats_lock = threading.Lock()
+
+    def count(self, name: str):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def snapshot(self) -> dict:
+        with self._stats_lock:
+            stats = dict(self.stats)
+        lookups = stats["hits"] + stats["misses"]
+        return {**stats, "hit_rate": stats["hits"] / lookups if lookups else 0.0}
+
+    @staticmethod
+    def _key(stage: str, key: str) -> str:
+        return f"stage:{stage}:{hashlib.sha1(key.encode('utf-8')).hexdigest()}"
+
+    def get(self, stage: str, key: str):
+        raw = self.store.get(self._key(stage, key))
+        if raw is None:
+            return None
+        kind, payload = raw[:1], raw[1:]
+        return json.loads(payload) if kind == b'J' else payload
+
+    def put(self, stage: str, key: str, value, ttl: float):
+        if isinstance(value, bytes):
+            raw = b'B' + value
+        else:
+            raw = b'J' + json.dumps(value, ensure_ascii=False).encode('utf-8')
+        self.store.set(self._key(stage, key), raw, ttl)
+
+    def lock(self, stage: str, key: str):
+        """同じ結果を複数のワーカーが同時に計算しないためのロック"""
+        return self.store.lock(self._key(stage, key), ttl=STAGE_LOCK_TIMEOUT, timeout=STAGE_LOCK_TIMEOUT)
+
+# ステージごとのキャッシュ有効期間（秒）。ストリームURLは数時間で失効するため短めにする
+STAGE_CACHE_TTL = {
+    "resolve": 30 * 60,
+    "cover": 24 * 60 * 60,
+}
+
+# シングルフライトロックの最大待ち時間（秒）
+STAGE_LOCK_TIMEOUT = 120
+
+stage_cache = StageCache(shared_store)
+
+audio_library = AudioLibrary(
+    FINGERPRINT_LIBRARY_DIR, FINGERPRINT_LIBRARY_MAX_BYTES, FINGERPRINT_DURATION_TOLERANCE,
+) if FINGERPRINT_ENABLED else None
+
+work_scheduler = WorkScheduler(
+    download_slots=SCHEDULER_DOWNLOAD_SLOTS,
+    long_slots=SCHEDULER_LONG_JOB_SLOTS,
+    preview_slots=SCHEDULER_PREVIEW_SLOTS,
+    long_job_seconds=SCHEDULER_LONG_JOB_SECONDS,
+    aging_bytes_per_second=SCHEDULER_AGING_MB_PER_SECOND * 1024 * 1024,
+    queue_timeout=SCHEDULER_QUEUE_TIMEOUT,
+    # プリフェッチの同時実行数は PREFETCH_MAX_WORKERS（専用スレッドプール）で制限する
+    prefetch_slots=0,
+)
+pipeline_threads = anyio.CapacityLimiter(PIPELINE_THREAD_LIMIT)
+
+class DownloadPipeline:
+    """単一動画をM4Aに変換してメタデータを付与するステージ型パイプライン
+
+    各ステージは `skip` で個別にスキップでき、resolve と cover の結果は
+    `cache` に保存されて同じ動画の次回処理で再利用される。`library` を渡すと
+    変換済みの音源を登録し、同じ音源（別の動画IDを含む）では fetch と convert を省く。
+    `scheduler` を渡すと fetch 以降を実行枠を確保してから行う。
+    コンテキストに `clip` があれば、その範囲だけを取得・変換する（ライブラリは使わない）。
+    `profile` で出力のコーデックとビットレートを選ぶ（ライブラリは standard のみ）。
+    """
+
+    def __init__(self, download_dir: Path, skip=(), cache: Optional[StageCache] = None, hooks=None,
+                 convert_mode: str = None, connections: int = None, library: Optional[AudioLibrary] = None,
+                 scheduler: Optional[WorkScheduler] = None):
+        unknown = set(skip) - set(PIPELINE_STAGES)
+        if unknown:
+            raise ValueError(f"不明なステージ: {sorted(unknown)}")
+        self.convert_mode = convert_mode or CONVERT_MODE
+        if self.convert_mode not in CONVERT_MODES:
+            raise ValueError(f"不明な変換モード: {self.convert_mode}")
+        self.connections = max(1, connections or PARALLEL_DOWNLOAD_CONNECTIONS)
+        self.download_dir = download_dir
+        self.skip = set(skip)
+        self.cache = cache
+        self.library = library
+        self.scheduler = scheduler
+        self.hooks = list(PIPELINE_HOOKS if hooks is None else hooks)
+
+    def new_context(self, url: str, title: str = None, artist: str = None, clip: tuple = None,
+                    profile: str = None) -> PipelineContext:
+        """ダウンロード用の一意な一時ディレクトリを持つコンテキストを作成"""
+        download_id = str(uuid.uuid4())[:8]
+        temp_dir = self.download_dir / download_id
+        temp_dir.mkdir(exist_ok=True)
+        logger.info(f"一時ディレクトリ: {temp_dir}")
+        return PipelineContext(url=url, temp_dir=temp_dir, job_id=download_id, title=title, artist=artist,
+                               clip=clip, profile=profile or OUTPUT_PROFILE)
+
+    def run(self, ctx: PipelineContext, deliver: str = "stream") -> PipelineContext:
+        """全ステージを実行
+
+        deliver="store" の場合は完成ファイルをダウンロードディレクトリへ移動し、
+        "stream" の場合は一時ディレクトリに残したままレスポンスに渡す。
+        single_pass モードではジャケット画像を先に作り、convert でタグ付けまで済ませる。
+        """
+        single_pass = self.convert_mode == "single_pass"
+        try:
+            if ctx.media_path is None:
+                self._run_download_attempts(ctx, convert=not single_pass)
+            else:
+                logger.info(f"プリフェッチ済みのファイルを使用: {ctx.media_path.name}")
+
+            if not ctx.title or not ctx.artist:
+                parsed_title, parsed_artist = parse_title_artist(
+                    ctx.info.get('title', 'Unknown'), ctx.info.get('uploader', 'Unknown Artist'))
+                ctx.title = ctx.title or parsed_title
+                ctx.artist = ctx.artist or parsed_artist
+                logger.info(f"解析結果 - タイトル: '{ctx.title}', アーティスト: '{ctx.artist}'")
+
+            self._run_stage("cover", ctx)
+            if single_pass:
+                self._run_stage("convert", ctx)
+            self._store_in_library(ctx)
+            self._run_stage("tag", ctx)
+            self._run_stage("deliver", ctx, mode=deliver)
+            return ctx
+        finally:
+            self._release_slot(ctx)
+
+    def resumable(self, ctx: PipelineContext) -> bool:
+        """中断されたジョブの成果物が、プリフェッチ完了時と同じ状態で再利用できるか"""
+        if ctx.media_path is None or not ctx.media_path.exists() or "deliver" in ctx.completed_stages:
+            return False
+        if self.convert_mode == "single_pass":
+            # 1パス変換後のファイルを再度変換すると再エンコードになるため、変換前のみ
+            return "fetch" in ctx.completed_stages and "convert" not in ctx.completed_stages
+        return "convert" in ctx.completed_stages
+
+    def prefetch(self, ctx: PipelineContext) -> PipelineContext:
+        """タイトル・アーティストに依存しないステージだけを先に実行
+
+        three_step モードでは変換まで、single_pass モードではダウンロードまで行い、
+        ジャケット画像はキャッシュに載せておく。残りは run() で実行する。
+        実行枠は prefetch レーンから確保し、ユーザーのダウンロードが待っている間は開始しない。
+        """
+        ctx.speculative = True
+        try:
+            self._run_download_attempts(ctx, convert=self.convert_mode != "single_pass")
+            self._run_stage("cover", ctx)
+            return ctx
+        finally:
+            self._release_slot(ctx)
+
+    # --- 実行制御 ---
+
+    def _run_download_attempts(self, ctx: PipelineContext, convert: bool = True):
+        """resolve → fetch (→ convert) を通常設定、フォールバック設定の順に試行"""
+        download_attempts = [
+            ('通常', False),
+            ('フォールバック', True)
+        ]  # ローカル成功版ベースのシンプル設定
+
+        for attempt, (attempt_name, use_fallback) in enumerate(download_attempts):
+            logger.info(f"ダウンロード試行 {attempt + 1}/{len(download_attempts)} ({attempt_name}設定)")
+            ctx.use_fallback = use_fallback
+            ydl_opts = get_ydl_opts(ctx.temp_dir, False, use_fallback)
+            # 変換は convert ステージで明示的に行う
+            ctx.postprocessors = ydl_opts.pop('postprocessors', [])
+            ctx.ffmpeg_path = ydl_opts.get('ffmpeg_location')
+            ydl_opts['concurrent_fragment_downloads'] = self.connections
+            if ctx.clip:
+                ydl_opts['download_ranges'] = self._clip_ranges(ctx.clip)
+
+            try:
+                with tracer.span("download_attempt", attempt=attempt + 1, config=attempt_name), \
+                        PacedYoutubeDL(ydl_opts) as ydl:
+                    ctx.ydl = ydl
+                    self._run_stage("resolve", ctx)
+                    if not ctx.info:
+                        raise PipelineError("動画情報を取得できませんでした", status_code=404)
+                    self._run_stage("match", ctx)
+                    if ctx.library_match is None:
+                        self._run_stage("queue", ctx)
+                        self._run_stage("fetch", ctx)
+                        if convert:
+                            self._run_stage("convert", ctx)
+                return
+            except Exception as e:
+                logger.warning(f"ダウンロード試行 {attempt + 1} ({attempt_name}設定) 失敗: {e}")
+                if ctx.cancel_event.is_set():
+                    raise PipelineError("ジョブがキャンセルされました", status_code=499)
+                if isinstance(e, PipelineError) and e.status_code in (400, 503):
+                    # 範囲指定の誤りや実行枠の待機タイムアウトは設定を変えても解消しない
+                    raise
+                if use_fallback:
+                    # フォールバックでも失敗した場合はエラーを発生
+                    raise PipelineError(f"全ての方法でダウンロードに失敗しました: {str(e)}")
+            finally:
+                ctx.ydl = None
+
+    def _release_slot(self, ctx: PipelineContext):
+        if ctx.slot is not None:
+            ctx.slot.release()
+            ctx.slot = None
+
+    def _run_stage(self, stage: str, ctx: PipelineContext, **kwargs):
+        """ステージを1つ実行し、処理時間をコンテキストとフックに記録"""
+        if stage in self.skip:
+            logger.info(f"ステージをスキップ: {stage}")
+            return
+        if ctx.cancel_event.is_set():
+            raise PipelineError("ジョブがキャンセルされました", status_code=499)
+
+        error = None
+        start = time.perf_counter()
+        try:
+            with tracer.span(f"stage.{stage}", **{"job.id": ctx.job_id}):
+                getattr(self, f"_stage_{stage}")(ctx, **kwargs)
+            ctx.completed_stages.add(stage)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            ctx.timings[stage] = ctx.timings.get(stage, 0.0) + elapsed
+            for hook in self.hooks:
+                try:
+                    hook(stage, elapsed, ctx, error)
+                except Exception as hook_error:
+                    logger.warning(f"ステージフックでエラー: {hook_error}")
+
+    def _cached(self, ctx: PipelineContext, stage: str, key: Optional[str], compute):
+        """キャッシュにあれば再利用し、なければ計算して保存"""
+        if self.cache is None or not key:
+            return compute()
+        value = self.cache.get(stage, key)
+        if value is not None:
+            return self._cache_hit(ctx, stage, key, value)
+        try:
+            # 同じキーを処理中のワーカーがあれば完了を待ち、その結果を再利用する
+            with self.cache.lock(stage, key):
+                value = self.cache.get(stage, key)
+                if value is not None:
+                    return self._cache_hit(ctx, stage, key, value, waited=True)
+                self.cache.count("misses")
+                set_attributes(cache_hit=False)
+                value = compute()
+                if value is not None:
+                    self.cache.put(stage, key, value, STAGE_CACHE_TTL[stage])
+                return value
+        except LockTimeout:
+            logger.warning(f"シングルフライトロックの待機がタイムアウト: {stage} ({key})")
+            self.cache.count("misses")
+            set_attributes(cache_hit=False)
+            return compute()
+
+    def _cache_hit(self, ctx: PipelineContext, stage: str, key: str, value, waited: bool = False):
+        logger.info(f"キャッシュを使用: {stage} ({key}){' (他のジョブの完了待ち後)' if waited else ''}")
+        self.cache.count("hits")
+        if waited:
+            self.cache.count("waited_hits")
+        ctx.cache_hits.add(stage)
+        set_attributes(cache_hit=True, cache_waited=waited)
+        return value
+
+    # --- ステージ ---
+
+    def _stage_resolve(self, ctx: PipelineContext):
+        """動画情報を取得（フォーマット選択済みのinfo dict）"""
+        def extract():
+            logger.info("動画情報を取得中...")
+            with tracer.span("yt_dlp.extract_info", url=ctx.url):
+                info = ctx.ydl.extract_info(ctx.url, download=False)
+            # JSONで共有ストアに保存できる形にする
+            return ctx.ydl.sanitize_info(info) if info else None
+
+        key = f"{ctx.url}|{'fallback' if ctx.use_fallback else 'default'}"
+        ctx.info = self._cached(ctx, "resolve", key, extract)
+        if ctx.info:
+            set_attributes(format_id=ctx.info.get('format_id'), extractor=ctx.info.get('extractor'))
+            duration = ctx.info.get('duration')
+            if ctx.clip and duration and ctx.clip[0] >= duration:
+                raise PipelineError(f"開始位置 ({ctx.clip[0]:g}秒) が動画の長さ ({duration:g}秒) を超えています",
+                                    status_code=400)
+
+    def _stage_match(self, ctx: PipelineContext):
+        """処理済みの同じ音源があればライブラリのファイルを使い、fetch と convert を省く
+
+        動画IDが登録済みならそのまま使い、未登録なら冒頭だけを取得してフィンガープリントを照合する。
+        見つかった場合は次回から照合を省けるよう、動画IDをその音源に関連付ける。
+        """
+        if self.library is None or not ctx.ffmpeg_path or ctx.clip or ctx.profile != "standard":
+            return
+        video_key = self._library_key(ctx.info)
+        duration = ctx.info.get('duration')
+        match = self.library.lookup_video(video_key)
+        if match is None and duration:
+            probe = self._probe_fingerprint(ctx)
+            if probe is not None:
+                match = self.library.lookup(probe, duration)
+                if match is not None:
+                    self.library.alias(video_key, match.track_id)
+        if match is None:
+            set_attributes(library_hit=False)
+            return
+
+        media_path = ctx.temp_dir / f"{ctx.job_id}{match.path.suffix}"
+        try:
+            shutil.copyfile(match.path, media_path)
+        except OSError as e:
+            # 容量上限で削除された直後など。通常どおりダウンロードする
+            logger.warning(f"ライブラリの音源を読み込めません: {e}")
+            return
+        ctx.media_path = media_path
+        ctx.downloaded_info = dict(ctx.info, filepath=str(media_path), ext='m4a', acodec='aac')
+        ctx.record_write(media_path)
+        ctx.library_match = match.to_dict()
+        # fetch（three_step では convert も）を済ませた状態として扱う
+        ctx.completed_stages.add("fetch")
+        if self.convert_mode != "single_pass":
+            ctx.completed_stages.add("convert")
+        logger.info(f"📚 ライブラリの音源を使用: track={match.track_id} ({match.reason}"
+                    f"{f', BER {match.ber}' if match.ber is not None else ''})")
+        set_attributes(library_hit=True, **{f"library.{k}": v for k, v in ctx.library_match.items()})
+
+    def _stage_queue(self, ctx: PipelineContext):
+        """推定処理量（再生時間×ビットレート）の小さい順に実行枠を確保する
+
+        長時間の動画は同時実行数を絞った別レーンで、プリフェッチは低優先度の prefetch レーンで待つ。
+        確保した枠は run() / prefetch() の終了時に返す。
+        フォールバック設定での再試行では確保済みの枠をそのまま使う。
+        """
+        if self.scheduler is None or ctx.slot is not None:
+            return
+        info = ctx.info
+        if ctx.clip:
+            # 範囲指定は切り出す長さで見積もる（ファイルサイズは全体のものなので使わない）
+            info = dict(info, duration=self._clip_duration(ctx), filesize=None, filesize_approx=None)
+        cost = estimate_cost(info)
+        lane = PREFETCH_LANE if ctx.speculative else self.scheduler.lane_for(info.get('duration'))
+        try:
+            ctx.slot = self.scheduler.acquire(lane, cost, cancel_event=ctx.cancel_event)
+        except QueueCancelled:
+            raise PipelineError("ジョブがキャンセルされました", status_code=499)
+        except QueueTimeout as e:
+            raise PipelineError(str(e), status_code=503)
+        set_attributes(**{"queue.lane": lane, "queue.cost": round(cost), "queue.wait": round(ctx.slot.waited, 3)})
+
+    def _stage_fetch(self, ctx: PipelineContext):
+        """resolve 済みのinfo dictから再抽出せずにメディアをダウンロード
+
+        出力ファイルはディレクトリを走査せず、yt-dlpが返す
+        requested_downloads とダウンロード/後処理フックから特定する。
+        並列ダウンロードが有効な場合はHTTPのバイト範囲を複数接続で取得し、
+        転送量と所要時間を ctx.fetch_stats に記録する。
+        """
+        def track(d):
+            if ctx.cancel_event.is_set():
+                raise yt_dlp.utils.DownloadCancelled("ジョブがキャンセルされました")
+            path = d.get('filename') or (d.get('info_dict') or {}).get('filepath')
+            if d.get('status') == 'finished' and path and Path(path) not in ctx.produced_files:
+                ctx.produced_files.append(Path(path))
+
+        ctx.fetch_stats = {}
+        start = time.perf_counter()
+        media_path = self._fetch_ranges(ctx) if self.connections > 1 and not ctx.clip else None
+        if media_path is None:
+            ctx.ydl.add_progress_hook(track)
+            ctx.ydl.add_postprocessor_hook(track)
+
+            if ctx.clip:
+                self._prepare_clip(ctx)
+            logger.info("単一動画をダウンロード中...")
+            with tracer.span("yt_dlp.download", format_id=ctx.info.get('format_id')):
+                ctx.downloaded_info = ctx.ydl.process_ie_result(copy.deepcopy(ctx.info), download=True) or {}
+            # ignoreerrors 有効時はキャンセルの例外がyt-dlp内で握りつぶされるため改めて確認する
+            if ctx.cancel_event.is_set():
+                raise PipelineError("ジョブがキャンセルされました", status_code=499)
+
+            requested = ctx.downloaded_info.get('requested_downloads') or []
+            filepath = requested[0].get('filepath') if requested else None
+            if filepath:
+                media_path = Path(filepath)
+            else:
+                media_path = ctx.produced_files[-1] if ctx.produced_files else None
+
+        if media_path is None or not media_path.exists():
+            logger.warning(f"ダウンロードは完了したが音声/動画ファイルが見つかりません: {[f.name for f in ctx.produced_files]}")
+            raise Exception("音声/動画ファイルのダウンロードに失敗")
+        if not ctx.fetch_stats:
+            ctx.fetch_stats = {
+                "mode": "clip" if ctx.clip else "yt-dlp",
+                "bytes": media_path.stat().st_size,
+                "seconds": time.perf_counter() - start,
+                "connections": self.connections,
+            }
+        ctx.media_path = media_path
+        for path in ctx.produced_files or [media_path]:
+            ctx.record_write(path)
+        seconds = ctx.fetch_stats.get("seconds") or 0
+        ctx.fetch_stats["throughput"] = ctx.fetch_stats["bytes"] / seconds if seconds > 0 else 0.0
+        logger.info(f"✅ ダウンロード成功 - ファイル: {media_path.name}")
+        set_attributes(format_id=ctx.downloaded_info.get('format_id'), **{
+            f"fetch.{k}": v for k, v in ctx.fetch_stats.items()})
+        logger.info(f"📶 転送: {ctx.fetch_stats['bytes']} bytes, {seconds:.2f}s, "
+                    f"{ctx.fetch_stats['throughput'] / 1e6:.2f} MB/s ({ctx.fetch_stats['mode']}, "
+                    f"{ctx.fetch_stats['connections']}接続)")
+
+    @staticmethod
+    def _clip_ranges(clip: tuple):
+        """yt-dlp の download_ranges に渡す関数（終了位置の省略は最後まで）"""
+        start, end = clip
+
+        def ranges(info, ydl):
+            return [{'start_time': start, 'end_time': end if end is not None else float('inf')}]
+        return ranges
+
+    @staticmethod
+    def _clip_duration(ctx: PipelineContext) -> Optional[float]:
+        start, end = ctx.clip
+        duration = ctx.info.get('duration')
+        if end is None or (duration and end > duration):
+            end = duration
+        return end - start if end is not None else None
+
+    def _prepare_clip(self, ctx: PipelineContext):
+        """範囲指定のダウンロードの準備
+
+        範囲指定はyt-dlpがFFmpegに任せ、FFmpegはシークしながら必要なバイト範囲・フラグメントだけを取得する。
+        FFmpegがないと全体がダウンロードされてしまうため、その場合はエラーにする。
+        音声のみの形式はすべてのフレームから切り出せるためストリームコピーで切り出し、
+        映像を含む形式（フォールバック設定など）のみキーフレームを打ち直すため再エンコードする。
+        """
+        if not ctx.ffmpeg_path:
+            raise PipelineError("FFmpegがないため範囲指定のダウンロードはできません", status_code=503)
+        formats = ctx.info.get('requested_formats') or [ctx.info]
+        has_video = any(f.get('vcodec') not in (None, 'none') for f in formats)
+        ctx.ydl.params['force_keyframes_at_cuts'] = has_video
+        # FFmpegが直接取得するため urlopen を通らない。リクエスト数の制限だけここで受ける
+        upstream_limiter.acquire_request(ctx.info.get('url') or ctx.url)
+        logger.info(f"✂️ 範囲を指定してダウンロード: {clip_label(ctx.clip)}"
+                    f"{'（映像を含むためキーフレームで再エンコード）' if has_video else ''}")
+        set_attributes(**{"clip.start": ctx.clip[0], "clip.end": ctx.clip[1], "clip.reencode": has_video})
+
+    def _fetch_ranges(self, ctx: PipelineContext) -> Optional[Path]:
+        """選択済みフォーマットがHTTPの単一ファイルならバイト範囲を並列に取得
+
+        対象外（DASH/HLS、映像と音声の結合など）や失敗時は None を返し、yt-dlpでの取得に任せる。
+        リクエストはyt-dlp経由で送るため、プロキシやCookieなどの設定はそのまま使われる。
+        """
+        info = ctx.info
+        if info.get('requested_formats') or info.get('protocol') not in ('http', 'https') or not info.get('url'):
+            return None
+
+        media_path = Path(ctx.ydl.prepare_filename(info))
+
+        def opener(url, headers):
+            return ctx.ydl.urlopen(YDLRequest(url, headers=headers))
+
+        try:
+            with tracer.span("range_download", connections=self.connections):
+                stats = download_parallel(
+                    opener, info['url'], media_path, headers=info.get('http_headers'),
+                    connections=self.connections, chunk_size=PARALLEL_DOWNLOAD_CHUNK_SIZE,
+                    should_abort=ctx.cancel_event.is_set)
+        except Exception as e:
+            if ctx.cancel_event.is_set():
+                raise PipelineError("ジョブがキャンセルされました", status_code=499)
+            logger.warning(f"並列ダウンロードできないため通常のダウンロードを行います: {e}")
+            return None
+
+        ctx.downloaded_info = dict(info, filepath=str(media_path))
+        ctx.produced_files.append(media_path)
+        ctx.fetch_stats = {
+            "mode": "range",
+            "bytes": stats.bytes,
+            "seconds": stats.seconds,
+            "connections": stats.connections,
+        }
+        return media_path
+
+    def _probe_fingerprint(self, ctx: PipelineContext):
+        """ストリームの冒頭だけを取得してフィンガープリントを計算（対象外の形式や失敗時は None）
+
+        取得量はビットレートから PROBE_SECONDS 秒分を見積もる。リクエストはyt-dlp経由で送る。
+        """
+        info = ctx.info
+        if info.get('requested_formats') or info.get('protocol') not in ('http', 'https') or not info.get('url'):
+            return None
+        bitrate = info.get('abr') or info.get('tbr')
+        size = info.get('filesize') or info.get('filesize_approx')
+        if bitrate:
+            probe_bytes = int(bitrate * 1000 / 8 * PROBE_SECONDS * 1.25)
+        elif size and info.get('duration'):
+            probe_bytes = int(size * PROBE_SECONDS / info['duration'] * 1.25)
+        else:
+            return None
+        probe_bytes += FINGERPRINT_PROBE_HEADER_BYTES
+
+        probe_path = ctx.temp_dir / "fingerprint.probe"
+        headers = {**(info.get('http_headers') or {}), 'Range': f'bytes=0-{probe_bytes - 1}'}
+        try:
+            with tracer.span("fingerprint.probe", bytes=probe_bytes):
+                response = ctx.ydl.urlopen(YDLRequest(info['url'], headers=headers))
+                try:
+                    with open(probe_path, 'wb') as f:
+                        # Range非対応のサーバーは全体を返すため、必要な分だけ読む
+                        remaining = probe_bytes
+                        while remaining > 0:
+                            data = response.read(min(256 * 1024, remaining))
+                            if not data:
+                                break
+                            f.write(data)
+                            remaining -= len(data)
+                finally:
+                    response.close()
+                ctx.record_write(probe_path)
+                return compute_fingerprint(decode_pcm(ctx.ffmpeg_path, probe_path, PROBE_SECONDS))
+        except Exception as e:
+            logger.warning(f"フィンガープリントを計算できません（通常どおりダウンロードします）: {e}")
+            return None
+        finally:
+            probe_path.unlink(missing_ok=True)
+
+    def _store_in_library(self, ctx: PipelineContext):
+        """変換済みの音源をライブラリに登録
+
+        タグとジャケット画像は配信ごとに書き直すため、single_pass でタグ付け済みのファイルでもよい。
+        """
+        if (self.library is None or ctx.library_match is not None or not ctx.ffmpeg_path or ctx.clip
+                or ctx.profile != "standard"):
+            return
+        duration = ctx.info.get('duration')
+        if not duration or detect_container(ctx.media_path) != 'mp4':
+            return
+        try:
+            with tracer.span("library.add"):
+                fingerprint = compute_fingerprint(decode_pcm(ctx.ffmpeg_path, ctx.media_path, INDEX_SECONDS))
+                self.library.add(self._library_key(ctx.info), ctx.media_path, fingerprint, duration)
+        except Exception as e:
+            logger.warning(f"ライブラリへの登録に失敗（処理は続行）: {e}")
+
+    @staticmethod
+    def _library_key(info: dict) -> str:
+        return f"{info.get('extractor_key') or info.get('extractor')}:{info.get('id')}"
+
+    def _stage_convert(self, ctx: PipelineContext):
+        """ダウンロードしたメディアをM4Aに変換
+
+        拡張子ではなく実際のコンテナ形式を判定し、MP4以外はFFmpegで
+        M4Aにリマックス（AAC以外は再エンコード）する。FFmpegがない場合は
+        実際の形式に合った拡張子のまま配信する。
+        single_pass モードでは変換と同時にジャケット画像とタグも書き込む。
+        コーデックとビットレートは出力プロファイルに従い、passthrough でAAC以外の場合は
+        元の形式のまま取り出す（M4Aではないためタグは付けない）。
+        """
+        source = ctx.media_path
+        acodec = ctx.downloaded_info.get('acodec')
+        if ctx.profile == "passthrough" and ctx.ffmpeg_path and not is_aac_codec(acodec):
+            extracted = extract_audio_stream(source, ctx.ffmpeg_path, acodec, ctx.cancel_event)
+            if extracted is not None:
+                ctx.record_write(extracted)
+                ctx.media_path = extracted
+                ctx.media_type = MEDIA_TYPES.get(extracted.suffix, 'application/octet-stream')
+                set_attributes(container=detect_container(extracted), media_type=ctx.media_type)
+                return
+            logger.warning(f"パススルーに対応していない音声形式のため通常どおり変換します: {acodec}")
+
+        if self.convert_mode == "single_pass" and ctx.ffmpeg_path:
+            try:
+                ctx.media_path = convert_single_pass(
+                    source, ctx.ffmpeg_path, ctx.title, ctx.artist, ctx.cover_data,
+                    acodec, ctx.cancel_event, profile=ctx.profile)
+                ctx.record_write(ctx.media_path)
+                ctx.tagged = True
+                return
+            except PipelineError as e:
+                if e.status_code == 499:
+                    raise
+                # 通常の変換とmutagenでのタグ付けにフォールバック
+                logger.warning(f"1パス変換に失敗したため通常の変換を行います: {e}")
+            source = remux_to_m4a(source, ctx.ffmpeg_path, acodec, ctx.cancel_event, profile=ctx.profile)
+            ctx.record_write(source)
+        elif ctx.postprocessors:
+            info = dict(ctx.downloaded_info, filepath=str(source))
+            for pp_def in ctx.postprocessors:
+                pp_args = dict(pp_def)
+                pp_key = pp_args.pop('key')
+                if pp_key == 'FFmpegExtractAudio' and ctx.ffmpeg_path:
+                    # FFmpegExtractAudio (m4a) と同じ変換（standard ではAACはコピー、それ以外は128kのAAC）を
+                    # キャンセル時に終了できるよう、出力プロファイルに合わせて自前のFFmpeg実行で行う
+                    info['filepath'] = str(remux_to_m4a(
+                        Path(info['filepath']), ctx.ffmpeg_path, acodec, ctx.cancel_event, profile=ctx.profile))
+                    continue
+                pp = get_postprocessor(pp_key)(ctx.ydl, **pp_args)
+                with tracer.span(f"postprocessor.{pp_key}"):
+                    files_to_delete, info = pp.run(info)
+                for path in files_to_delete:
+                    Path(path).unlink(missing_ok=True)
+            if Path(info['filepath']) != source:
+                ctx.record_write(Path(info['filepath']))
+            source = Path(info['filepath'])
+
+        container = detect_container(source)
+        logger.info(f"コンテナ形式: {container or '不明'} ({source.name})")
+        if container != 'mp4':
+            if ctx.ffmpeg_path:
+                source = remux_to_m4a(source, ctx.ffmpeg_path, acodec, ctx.cancel_event, profile=ctx.profile)
+                ctx.record_write(source)
+            else:
+                logger.warning(f"FFmpegがないためM4Aに変換できません。{container or '不明'}形式のまま配信します")
+        elif source.suffix.lower() != '.m4a':
+            # MP4コンテナなので拡張子だけをm4aにする
+            m4a_file = source.with_suffix('.m4a')
+            source.rename(m4a_file)
+            logger.info(f"拡張子をm4aに変更: {source.name} -> {m4a_file.name}")
+            source = m4a_file
+
+        extension = CONTAINER_EXTENSIONS.get(detect_container(source), source.suffix.lower())
+        if source.suffix.lower() != extension:
+            source = source.rename(source.with_suffix(extension))
+        ctx.media_path = source
+        ctx.media_type = MEDIA_TYPES.get(extension, 'application/octet-stream')
+        set_attributes(container=container, media_type=ctx.media_type)
+
+    def _stage_cover(self, ctx: PipelineContext):
+        """サムネイルから800x800のジャケット画像を作成（ディスクには書き出さない）"""
+        def build():
+            thumbnail_url = ctx.info.get('thumbnail')
+            if not thumbnail_url:
+                return None
+            cover_data = download_and_process_thumbnail(thumbnail_url)
+            if cover_data is None:
+                logger.warning("サムネイル画像の処理に失敗")
+            return cover_data
+
+        ctx.cover_data = self._cached(ctx, "cover", ctx.info.get('id'), build)
+        set_attributes(bytes=len(ctx.cover_data) if ctx.cover_data else 0)
+
+    def _stage_tag(self, ctx: PipelineContext):
+        """M4Aファイルにメタデータを追加"""
+        if ctx.tagged:
+            logger.info("変換時にタグ付け済みのためスキップ")
+            return
+        if ctx.media_path.suffix.lower() != '.m4a':
+            logger.warning(f"M4A以外のためメタデータの追加をスキップ: {ctx.media_path.name}")
+            return
+        try:
+            if add_metadata_to_m4a(ctx.media_path, ctx.title, ctx.artist, None, cover_data=ctx.cover_data):
+                ctx.record_write(ctx.media_path)
+                logger.info("✅ メタデータの追加が完了しました")
+            else:
+                logger.warning("メタデータの追加に失敗しました（処理は続行）")
+        except Exception as e:
+            logger.warning(f"メタデータ追加中にエラーが発生: {e} （処理は続行）")
+
+    def _stage_deliver(self, ctx: PipelineContext, mode: str = "stream"):
+        """完成したファイルを配信用に配置"""
+        clip = f"_{clip_label(ctx.clip)}" if ctx.clip else ""
+        ctx.filename = f"{sanitize_filename(ctx.artist)}-{sanitize_filename(ctx.title)}{clip}{ctx.media_path.suffix}"
+
+        if mode == "store":
+            # ファイルをダウンロードディレクトリに移動し、一時ディレクトリを削除
+            final_path = self.download_dir / ctx.filename
+            shutil.move(str(ctx.media_path), str(final_path))
+            logger.info(f"ファイル移動: {ctx.filename} -> downloads/")
+            ctx.cleanup()
+            ctx.output_path = final_path
+        else:
+            ctx.output_path = ctx.media_path
+        ctx.output_bytes = ctx.output_path.stat().st_size
+        set_attributes(mode=mode, bytes=ctx.output_bytes, profile=ctx.profile)
+        logger.info(f"ダウンロード完了: {ctx.filename}")
+        logger.info(f"🎚️ 出力プロファイル {ctx.profile}: {ctx.output_bytes} bytes, "
+                    f"変換 {ctx.timings.get('convert', 0.0):.2f}s")
+        logger.info(f"📊 書き込み: {ctx.files_written}ファイル, {ctx.bytes_written} bytes")
+
+# ---------------------------------------------------------------------------
+# ジョブ管理（共有ストアへの状態記録とシャットダウン時のドレイン）
+# ---------------------------------------------------------------------------
+
+# ジョブ状態の保持期間（秒）
+JOB_STATE_TTL = 24 * 60 * 60
+
+# シャットダウン時に実行中ジョブの完了を待つ最大時間（秒）
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "120"))
+
+# クライアントごとのダウンロード回数上限（1分あたり, 0で無制限）
+DOWNLOAD_RATE_LIMIT_PER_MINUTE = int(os.getenv("DOWNLOAD_RATE_LIMIT_PER_MINUTE", "0"))
+# アプリの前段にある信頼できるプロキシの段数（Railwayは1）。0なら接続元のアドレスを使う
+TRUSTED_PROXY_COUNT = int(os.getenv("TRUSTED_PROXY_COUNT", "0"))
+
+# プロセスのRSS上限（MB, 0で無効）。超えている間は新しいジョブを最大 MEMORY_WAIT_TIMEOUT 秒待たせる
+MEMORY_LIMIT_BYTES = int(os.getenv("MEMORY_LIMIT_MB", "0")) * 1024 * 1024
+MEMORY_WAIT_TIMEOUT = float(os.getenv("MEMORY_WAIT_TIMEOUT", "30"))
+
+# クライアントの切断を確認する間隔（秒）
+DISCONNECT_POLL_INTERVAL = 1.0
+
+class JobTracker:
+    """実行中ジョブを管理し、状態を共有ストアに記録する"""
+
+    def __init__(self, store: SharedStore):
+        self.store = store
+        self.draining = False
+        self._active = {}
+        self._condition = threading.Condition()
+
+    def start(self, ctx: PipelineContext):
+        """ジョブを登録（ドレイン中は受け付けない）"""
+        with self._condition:
+            if self.draining:
+                raise PipelineError("サーバーを停止中です。しばらくしてから再試行してください", status_code=503)
+            self._active[ctx.job_id] = ctx
+        self._save(ctx, status="running", stage=None)
+
+    def stage_hook(self, stage, elapsed, ctx, error):
+        """パイプラインのステージ完了ごとに状態を更新"""
+        if ctx.job_id in self._active:
+            self._save(ctx, status="running", stage=stage)
+
+    def finish(self, ctx: PipelineContext, status: str, message: str = ""):
+        self._save(ctx, status=status, stage=None, message=message)
+        with self._condition:
+            self._active.pop(ctx.job_id, None)
+            self._condition.notify_all()
+
+    def get(self, job_id: str) -> Optional[dict]:
+        return self.store.get_json(f"job:{job_id}")
+
+    def active_count(self) -> int:
+        """このワーカーで実行中のジョブ数"""
+        with self._condition:
+            return len(self._active)
+
+    def _save(self, ctx: PipelineContext, **fields):
+        try:
+            self.store.set_json(f"job:{ctx.job_id}", {
+                "job_id": ctx.job_id,
+                "request_id": current_request_id(),
+                "url": ctx.url,
+                "worker": os.getpid(),
+                "timings": ctx.timings,
+                "fetch": ctx.fetch_stats,
+                "library": ctx.library_match,
+                "clip": ctx.clip,
+                "output": {
+                    "profile": ctx.profile,
+                    "encode_seconds": ctx.timings.get("convert", 0.0),
+                    "bytes": ctx.output_bytes,
+                },
+                "updated_at": time.time(),
+                **fields,
+            }, ttl=JOB_STATE_TTL)
+        except Exception as e:
+            logger.warning(f"ジョブ状態の保存に失敗: {e}")
+
+    def drain(self, timeout: float) -> int:
+        """新規ジョブを止め、実行中ジョブの完了を待つ。残ったジョブ数を返す"""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            self.draining = True
+            logger.info(f"ドレイン開始: 実行中のジョブ {len(self._active)}件")
+            while self._active:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            leftover = list(self._active.values())
+
+        for ctx in leftover:
+            logger.warning(f"ドレインがタイムアウトしたジョブの一時ファイルを削除: {ctx.job_id}")
+            ctx.cleanup()
+        return len(leftover)
+
+job_tracker = JobTracker(shared_store)
+PIPELINE_HOOKS.append(job_tracker.stage_hook)
+
+class OutputProfileStats:
+    """出力プロファイルごとの変換時間と出力サイズの集計（このワーカーで完了したジョブ）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def stage_hook(self, stage, elapsed, ctx, error):
+        if stage != "deliver" or error is not None:
+            return
+        with self._lock:
+            stats = self._stats.setdefault(ctx.profile, {"jobs": 0, "encode_seconds": 0.0, "bytes": 0})
+            stats["jobs"] += 1
+            stats["encode_seconds"] += ctx.timings.get("convert", 0.0)
+            stats["bytes"] += ctx.output_bytes
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                profile: {
+                    **stats,
+                    "avg_encode_seconds": stats["encode_seconds"] / stats["jobs"],
+                    "avg_bytes": stats["bytes"] // stats["jobs"],
+                }
+                for profile, stats in self._stats.items()
+            }
+
+output_profile_stats = OutputProfileStats()
+PIPELINE_HOOKS.append(output_profile_stats.stage_hook)
+
+async def watch_disconnect(http_request: Request, task: asyncio.Future, ctx: PipelineContext):
+    """ジョブの実行中にクライアントが切断したらキャンセルを通知する"""
+    while not task.done():
+        await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+        if not task.done() and await http_request.is_disconnected():
+            logger.warning(f"クライアントが切断したためジョブをキャンセルします: {ctx.job_id}")
+            ctx.cancel_event.set()
+            return
+
+async def execute_pipeline(pipeline: DownloadPipeline, ctx: PipelineContext, deliver: str,
+                           http_request: Request = None):
+    """ジョブとして登録し、パイプラインを専用の枠のスレッドで実行
+
+    RSSが上限を超えている場合は下回るまで開始を待たせる。http_request を渡すと
+    クライアントの切断を監視し、切断されたらジョブをキャンセルする。ダウンロード済みの
+    成果物が再利用できる状態ならプリフェッチとして保持し、それ以外は呼び出し元で削除する。
+    """
+    if not await wait_for_rss(MEMORY_LIMIT_BYTES, MEMORY_WAIT_TIMEOUT):
+        raise PipelineError("サーバーのメモリが不足しています。しばらくしてから再試行してください", status_code=503)
+    job_tracker.start(ctx)
+    if PREFETCH_ENABLED:
+        prefetch_manager.shed_if_loaded()
+    task = asyncio.ensure_future(anyio.to_thread.run_sync(pipeline.run, ctx, deliver, limiter=pipeline_threads))
+    try:
+        if http_request is not None:
+            await watch_disconnect(http_request, task, ctx)
+        await task
+    except Exception as e:
+        if ctx.cancel_event.is_set():
+            job_tracker.finish(ctx, "cancelled", "クライアントが切断しました")
+            if pipeline.resumable(ctx):
+                prefetch_manager.adopt(ctx)
+        else:
+            job_tracker.finish(ctx, "failed", str(e))
+        raise
+    job_tracker.finish(ctx, "completed")
+
+def client_address(http_request: Request) -> str:
+    """レート制限に使うクライアントのアドレス
+
+    X-Forwarded-For の左側はクライアントが自由に付けられるため使わない。信頼できるプロキシが
+    TRUSTED_PROXY_COUNT 段ある場合は、右から数えてその段数目（最も外側のプロキシが追加した値）を使う。
+    """
+    if TRUSTED_PROXY_COUNT > 0:
+        hops = [hop.strip() for value in http_request.headers.getlist("x-forwarded-for")
+                for hop in value.split(",") if hop.strip()]
+        if len(hops) >= TRUSTED_PROXY_COUNT:
+            return hops[-TRUSTED_PROXY_COUNT]
+    return http_request.client.host if http_request.client else "unknown"
+
+def rate_limited(http_request: Request, kind: str = "download", limit: int = None) -> bool:
+    """クライアントごとの1分あたりの回数が上限を超えているか（kind ごとに別々に数える）"""
+    limit = DOWNLOAD_RATE_LIMIT_PER_MINUTE if limit is None else limit
+    if limit <= 0:
+        return False
+    try:
+        return shared_store.hit_rate_limit(f"{kind}:{client_address(http_request)}", limit, 60)
+    except Exception as e:
+        logger.warning(f"レート制限カウンタの更新に失敗: {e}")
+        return False
+
+# ---------------------------------------------------------------------------
+# 投機的プリフェッチ
+#   /preview の成功時にダウンロードと変換を裏で始め、ユーザーがタイトルと
+#   アーティストを編集している間に済ませておく。ダウンロード要求ではタグ付けと配信のみ行う。
+# ---------------------------------------------------------------------------
+
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "false").lower() in ("1", "true", "yes")
+# 同時に実行するプリフェッチ数
+PREFETCH_MAX_WORKERS = int(os.getenv("PREFETCH_MAX_WORKERS", "1"))
+# 保持するプリフェッチ数（実行中・待機中・完了済みの合計）
+PREFETCH_MAX_ENTRIES = int(os.getenv("PREFETCH_MAX_ENTRIES", "8"))
+# 受け取られなかったプリフェッチを破棄するまでの時間（秒）
+PREFETCH_TTL = float(os.getenv("PREFETCH_TTL", "600"))
+# 期限切れのプリフェッチを破棄する間隔（秒）
+PREFETCH_SWEEP_INTERVAL = 30
+# 実行中のダウンロードがこの数以上になったらプリフェッチを止めて破棄する
+PREFETCH_SHED_ACTIVE_JOBS = int(os.getenv("PREFETCH_SHED_ACTIVE_JOBS", "4"))
+# プリフェッチ用スレッドのnice値（FFmpegの子プロセスにも引き継がれる）
+PREFETCH_NICE = 10
+
+def _lower_thread_priority():
+    """プリフェッチ用スレッドの優先度を下げる（Linuxではスレッド単位で有効）"""
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), PREFETCH_NICE)
+    except (AttributeError, OSError) as e:
+        logger.debug(f"プリフェッチスレッドの優先度を変更できません: {e}")
+
+def prefetch_key(url: str, clip: tuple = None, profile: str = None) -> str:
+    """プリフェッチの識別子（範囲指定と、既定以外の出力プロファイルは別扱い）"""
+    key = url.strip()
+    if clip:
+        key += f"#{clip_label(clip)}"
+    if profile and profile != OUTPUT_PROFILE:
+        key += f"#{profile}"
+    return key
+
+@dataclass
+class PrefetchEntry:
+    """1件のプリフェッチ"""
+    url: str
+    ctx: PipelineContext
+    future: object
+    created_at: float = field(default_factory=time.monotonic)
+
+class PrefetchManager:
+    """URLごとのプリフェッチを低優先度・同時実行数制限付きで管理する
+
+    プリフェッチはこのワーカーのメモリと一時ディレクトリにのみ存在するため、
+    別ワーカーに届いたダウンロード要求では通常どおり処理される。
+    """
+
+    def __init__(self, download_dir: Path, max_workers: int, max_entries: int, ttl: float):
+        self.download_dir = download_dir
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, max_workers), thread_name_prefix="prefetch", initializer=_lower_thread_priority)
+        self._entries = OrderedDict()
+        # 完了済みのfutureへのコールバックは同じスレッドで即座に呼ばれるため再入可能にする
+        self._lock = threading.RLock()
+        self.stats = {
+            "started": 0,
+            "hits": 0,
+            "misses": 0,
+            "failed": 0,
+            "cancelled": 0,
+            "evicted": 0,
+            "expired": 0,
+            "skipped_under_load": 0,
+            "adopted": 0,
+            "wasted_bytes": 0,
+        }
+
+    def submit(self, url: str):
+        """プリフェッチを開始（同じURLが実行中・完了済みなら何もしない）"""
+        url = url.strip()
+        if job_tracker.draining:
+            return
+        with self._lock:
+            self._evict_expired()
+            if url in self._entries:
+                return
+            if job_tracker.active_count() >= PREFETCH_SHED_ACTIVE_JOBS or rss_over_limit(MEMORY_LIMIT_BYTES):
+                self.stats["skipped_under_load"] += 1
+                logger.info(f"高負荷のためプリフェッチしません: {url}")
+                return
+            while len(self._entries) >= self.max_entries:
+                _, oldest = self._entries.popitem(last=False)
+                self._discard(oldest, "evicted")
+
+            pipeline = DownloadPipeline(self.download_dir, cache=stage_cache, library=audio_library,
+                                        scheduler=work_scheduler)
+            ctx = pipeline.new_context(url)
+            future = self._executor.submit(self._run, pipeline, ctx)
+            self._entries[url] = PrefetchEntry(url=url, ctx=ctx, future=future)
+            self.stats["started"] += 1
+        logger.info(f"🔮 プリフェッチ開始: {url} ({ctx.job_id})")
+
+    @staticmethod
+    def _run(pipeline: DownloadPipeline, ctx: PipelineContext) -> PipelineContext:
+        with tracer.request("prefetch", **{"job.id": ctx.job_id, "url": ctx.url}):
+            return pipeline.prefetch(ctx)
+
+    def claim(self, url: str, clip: tuple = None, profile: str = None) -> Optional[PipelineContext]:
+        """プリフェッチ結果を受け取る（実行中なら完了を待つ）。なければ None"""
+        url = prefetch_key(url, clip, profile)
+        with self._lock:
+            self._evict_expired()
+            entry = self._entries.pop(url, None)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            if entry.future.cancel():
+                # まだ開始していなければ待たずに通常のダウンロードを行う
+                self.stats["cancelled"] += 1
+                self.stats["misses"] += 1
+                entry.ctx.cleanup()
+                return None
+
+        try:
+            ctx = entry.future.result()
+        except Exception as e:
+            logger.warning(f"プリフェッチが失敗していたため通常のダウンロードを行います: {e}")
+            with self._lock:
+                self.stats["failed"] += 1
+                self.stats["misses"] += 1
+            entry.ctx.cleanup()
+            return None
+
+        with self._lock:
+            self.stats["hits"] += 1
+        logger.info(f"🎯 プリフェッチを使用: {url} ({ctx.job_id})")
+        return ctx
+
+    def holds(self, url: str, clip: tuple = None, profile: str = None) -> bool:
+        with self._lock:
+            return prefetch_key(url, clip, profile) in self._entries
+
+    def adopt(self, ctx: PipelineContext) -> bool:
+        """キャンセルされたジョブの成果物を引き取り、同じURLの次の要求で使えるようにする
+
+        一時ディレクトリを新しい名前に移すため、元のコンテキストの cleanup() では削除されない。
+        範囲指定や出力プロファイルが異なる要求には使わない。指定されたメタデータなど要求ごとの値は引き継がない。
+        """
+        url = prefetch_key(ctx.url, ctx.clip, ctx.profile)
+        job_id = str(uuid.uuid4())[:8]
+        temp_dir = self.download_dir / job_id
+        try:
+            ctx.temp_dir.rename(temp_dir)
+        except OSError as e:
+            logger.warning(f"中断されたジョブの成果物を保持できません: {e}")
+            return False
+
+        kept = replace(
+            ctx,
+            temp_dir=temp_dir,
+            job_id=job_id,
+            media_path=temp_dir / ctx.media_path.name,
+            produced_files=[],
+            output_path=None,
+            tagged=False,
+            ydl=None,
+            cancel_event=threading.Event(),
+            completed_stages=ctx.completed_stages - {"tag"},
+            # タイトル・アーティストや計測値は中断された要求のものなので、次の要求に引き継がない
+            title=None,
+            artist=None,
+            filename="",
+            timings={},
+            cache_hits=set(),
+            library_match=None,
+            output_bytes=0,
+        )
+        future = Future()
+        future.set_result(kept)
+        with self._lock:
+            previous = self._entries.pop(url, None)
+            if previous is not None:
+                self._discard(previous, "evicted")
+            while len(self._entries) >= self.max_entries:
+                _, oldest = self._entries.popitem(last=False)
+                self._discard(oldest, "evicted")
+            self._entries[url] = PrefetchEntry(url=url, ctx=kept, future=future)
+            self.stats["adopted"] += 1
+        logger.info(f"♻️ 中断されたジョブの成果物を保持: {url} ({job_id})")
+        return True
+
+    def shed(self, reason: str = "cancelled"):
+        """受け取られていないプリフェッチをすべて中止・破棄"""
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+            for entry in entries:
+                self._discard(entry, reason)
+        if entries:
+            logger.info(f"プリフェッチを{len(entries)}件破棄しました ({reason})")
+
+    def shed_if_loaded(self):
+        """実行中のダウンロードが多い場合はプリフェッチを止める"""
+        if self._entries and (job_tracker.active_count() >= PREFETCH_SHED_ACTIVE_JOBS
+                              or rss_over_limit(MEMORY_LIMIT_BYTES)):
+            self.shed("cancelled")
+
+    def shutdown(self):
+        self.shed("cancelled")
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            claims = self.stats["hits"] + self.stats["misses"]
+            return {
+                "enabled": PREFETCH_ENABLED,
+                **self.stats,
+                "hit_rate": self.stats["hits"] / claims if claims else 0.0,
+                "entries": [
+                    {
+                        "url": entry.url,
+                        "job_id": entry.ctx.job_id,
+                        "age": time.monotonic() - entry.created_at,
+                        "state": "done" if entry.future.done() else "running",
+                        "timings": entry.ctx.timings,
+                    }
+                    for entry in self._entries.values()
+                ],
+            }
+
+    def sweep(self):
+        """期限切れのプリフェッチ（引き取った成果物を含む）を破棄"""
+        with self._lock:
+            self._evict_expired()
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        expired = [u for u, e in self._entries.items() if now - e.created_at > self.ttl]
+        for url in expired:
+            self._discard(self._entries.pop(url), "expired")
+        if expired:
+            logger.info(f"期限切れのプリフェッチを{len(expired)}件破棄しました")
+
+    def _discard(self, entry: PrefetchEntry, reason: str):
+        """プリフェッチを中止し、完了後に一時ファイルを削除して無駄になった書き込み量を計上"""
+        self.stats[reason] += 1
+        entry.ctx.cancel_event.set()
+        entry.future.cancel()
+
+        def finalize(_):
+            with self._lock:
+                self.stats["wasted_bytes"] += entry.ctx.bytes_written
+            entry.ctx.cleanup()
+
+        entry.future.add_done_callback(finalize)
+
+prefetch_manager = PrefetchManager(DOWNLOAD_DIR, PREFETCH_MAX_WORKERS, PREFETCH_MAX_ENTRIES, PREFETCH_TTL)
+
+async def sweep_prefetches():
+    """受け取られないプリフェッチを定期的に破棄する（要求が来ないワーカーにも一時ファイルを残さない）"""
+    while True:
+        await asyncio.sleep(PREFETCH_SWEEP_INTERVAL)
+        try:
+            await run_in_threadpool(prefetch_manager.sweep)
+        except Exception as e:
+            logger.warning(f"プリフェッチの定期破棄でエラー: {e}")
+
+async def claim_prefetch(url: str, clip: tuple = None, profile: str = None) -> Optional[PipelineContext]:
+    """プリフェッチ（または中断されたジョブの成果物）があればその結果を受け取る"""
+    if not PREFETCH_ENABLED and not prefetch_manager.holds(url, clip, profile):
+        return None
+    return await run_in_threadpool(prefetch_manager.claim, url, clip, profile)
+
 @app.get("/")
-async def root():
+async def root(http_request: Request):
     """ルートエンドポイント - 開発環境ではAPI情報、プロダクション環境では静的ファイルを配信"""
     # distディレクトリが存在する場合（プロダクション環境）
-    if Path("../dist").exists():
-        return FileResponse("../dist/index.html")
+    if static_files is not None:
+        return await static_files.get_response("index.html", http_request.scope)
     else:
         return {"message": "YouTube M4A Downloader API", "status": "running"}
 
@@ -471,6 +2168,40 @@ async def options_download():
     """CORSプリフライトリクエスト用"""
     return {"message": "OK"}
 
+def get_preview_opts() -> dict:
+    """プレビュー用のyt-dlp設定（情報のみ取得）"""
+    return {
+        'quiet': True,
+        'no_warnings': True,
+        'extractaudio': False,
+        'skip_download': True,  # ダウンロードはスキップ
+        'writeinfojson': False,
+        'writesubtitles': False,
+        'writeautomaticsub': False,
+        'writethumbnail': False,
+        # YouTubeボット検出回避のための設定
+        'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+        'referer': 'https://www.youtube.com/',
+        'headers': {
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+            'Accept-Language': 'en-us,en;q=0.5',
+            'Sec-Fetch-Mode': 'navigate',
+        },
+        'retries': 20,
+        'fragment_retries': 20,
+        'extractor_retries': 20,
+        'extractor_args': {
+            'youtube': {
+                'player_client': ['android', 'web', 'ios', 'tv_embedded', 'mweb', 'web_embedded'],
+                'skip': ['hls'],
+                'formats': ['missing_pot'],
+                'player_skip': ['webpage', 'configs'],
+            }
+        },
+        'cookiefile': 'cookies.txt',  # ← ここを追加
+    }
+
 @app.post("/preview", response_model=PreviewResponse)
 async def preview_video(request: PreviewRequest):
     """YouTube動画の情報を取得（メタデータ編集用）"""
@@ -484,71 +2215,39 @@ async def preview_video(request: PreviewRequest):
         
         logger.info(f"プレビュー取得開始: {request.url}")
         
-        # yt-dlpオプション設定（情報のみ取得）
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extractaudio': False,
-            'skip_download': True,  # ダウンロードはスキップ
-            'writeinfojson': False,
-            'writesubtitles': False,
-            'writeautomaticsub': False,
-            'writethumbnail': False,
-            # YouTubeボット検出回避のための設定
-            'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'referer': 'https://www.youtube.com/',
-            'headers': {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                'Accept-Language': 'en-us,en;q=0.5',
-                'Sec-Fetch-Mode': 'navigate',
-            },
-            'retries': 20,
-            'fragment_retries': 20,
-            'extractor_retries': 20,
-            'extractor_args': {
-                'youtube': {
-                    'player_client': ['android', 'web', 'ios', 'tv_embedded', 'mweb', 'web_embedded'],
-                    'skip': ['hls'],
-                    'formats': ['missing_pot'],
-                    'player_skip': ['webpage', 'configs'],
-                }
-            },
-            'cookiefile': 'cookies.txt',  # ← ここを追加
-        }
+        # yt-dlpで動画情報を取得（プレビュー用の実行枠で、ダウンロードの待ちに影響されない）
+        info = await run_in_threadpool(fetch_preview_info, request.url)
         
-        # yt-dlpで動画情報を取得
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(request.url, download=False)
-            
-            if not info:
-                return PreviewResponse(
-                    success=False,
-                    message="動画情報を取得できませんでした。"
-                )
-            
-            # メタデータを解析
-            title = info.get('title', '不明なタイトル')
-            uploader = info.get('uploader', '不明なアーティスト')
-            duration = info.get('duration', 0)
-            description = info.get('description', '')
-            thumbnail = info.get('thumbnail', '')
-            
-            # アーティスト名と曲名を解析
-            parsed_title, parsed_artist = parse_title_artist(title, uploader)
-            
-            logger.info(f"プレビュー取得成功: {parsed_title} by {parsed_artist}")
-            
+        if not info:
             return PreviewResponse(
-                success=True,
-                message="動画情報を取得しました",
-                title=parsed_title,
-                artist=parsed_artist,
-                duration=duration,
-                uploader=uploader,
-                description=description[:200] if description else "",  # 200文字まで
-                thumbnail=thumbnail
+                success=False,
+                message="動画情報を取得できませんでした。"
             )
+        
+        # メタデータを解析
+        title = info.get('title', '不明なタイトル')
+        uploader = info.get('uploader', '不明なアーティスト')
+        duration = info.get('duration', 0)
+        description = info.get('description', '')
+        thumbnail = info.get('thumbnail', '')
+        
+        # アーティスト名と曲名を解析
+        parsed_title, parsed_artist = parse_title_artist(title, uploader)
+        
+        logger.info(f"プレビュー取得成功: {parsed_title} by {parsed_artist}")
+        if PREFETCH_ENABLED:
+            prefetch_manager.submit(request.url)
+        
+        return PreviewResponse(
+            success=True,
+            message="動画情報を取得しました",
+            title=parsed_title,
+            artist=parsed_artist,
+            duration=duration,
+            uploader=uploader,
+            description=description[:200] if description else "",  # 200文字まで
+            thumbnail=thumbnail
+        )
             
     except Exception as e:
         logger.error(f"プレビュー取得エラー: {str(e)}")
@@ -557,453 +2256,397 @@ async def preview_video(request: PreviewRequest):
             message=f"エラーが発生しました: {str(e)}"
         )
 
+# ---------------------------------------------------------------------------
+# 一括・プレイリストのプレビュー
+#   プレイリストは extract_flat で一覧（IDとタイトル）を1回で取得し、各動画の詳細は
+#   同時実行数を制限して並列に取得する。結果は解決した順に NDJSON / SSE で返す。
+# ---------------------------------------------------------------------------
+
+# 詳細を同時に取得する動画数
+BATCH_PREVIEW_CONCURRENCY = int(os.getenv("BATCH_PREVIEW_CONCURRENCY", "4"))
+# 1回のリクエストで扱う最大件数
+BATCH_PREVIEW_MAX_ITEMS = int(os.getenv("BATCH_PREVIEW_MAX_ITEMS", "200"))
+# クライアントごとの1分あたりの一括プレビュー回数（0で無制限）。ダウンロードの回数制限とは別に数える
+BATCH_PREVIEW_RATE_LIMIT_PER_MINUTE = int(os.getenv("BATCH_PREVIEW_RATE_LIMIT_PER_MINUTE", "0"))
+
+# 一時コピーで更新されたクッキーを cookies.txt に書き戻すときのロック
+preview_cookie_lock = threading.Lock()
+
+@contextmanager
+def isolated_preview_opts(write_back: bool = False, **overrides):
+    """並列実行用のプレビュー設定
+
+    yt-dlpは終了時に cookiefile を書き戻すため、同時に動く複数のインスタンスが
+    同じ cookies.txt を読み書きすると壊れる。一時コピーを読み書きさせ、write_back の場合は
+    成功後にロックを取って cookies.txt を丸ごと置き換える（読み込み側が途中の状態を見ないように）。
+    """
+    opts = dict(get_preview_opts(), **overrides)
+    cookiefile = opts.pop('cookiefile', None)
+    with tempfile.TemporaryDirectory(prefix='preview-') as temp_dir:
+        temp_cookiefile = None
+        if cookiefile:
+            cookiefile = Path(cookiefile)
+            temp_cookiefile = Path(temp_dir) / cookiefile.name
+            if cookiefile.is_file():
+                shutil.copy(cookiefile, temp_cookiefile)
+            opts['cookiefile'] = str(temp_cookiefile)
+        yield opts
+        if write_back and temp_cookiefile is not None and temp_cookiefile.is_file():
+            with preview_cookie_lock:
+                staged = cookiefile.with_name(f".{cookiefile.name}.{os.getpid()}.tmp")
+                shutil.copy(temp_cookiefile, staged)
+                os.replace(staged, cookiefile)
+
+def fetch_preview_info(url: str, isolated: bool = False, **overrides) -> Optional[dict]:
+    """プレビュー用の実行枠で動画情報を取得（ダウンロードの実行枠とは別なので待たされない）
+
+    cookies.txt は常に一時コピーを使う。単独の /preview では更新されたクッキーを書き戻し、
+    isolated（一括プレビューの並列取得）では書き戻さない。
+    """
+    with work_scheduler.slot(PREVIEW_LANE), \
+            isolated_preview_opts(write_back=not isolated, **overrides) as opts, PacedYoutubeDL(opts) as ydl:
+        return ydl.extract_info(url, download=False)
+
+def extract_listing(url: str) -> dict:
+    """プレイリストは中身を展開せずに一覧だけ、単一動画は通常どおり情報を取得"""
+    info = fetch_preview_info(url, isolated=True, extract_flat='in_playlist', noplaylist=False,
+                              playlistend=BATCH_PREVIEW_MAX_ITEMS)
+    if not info:
+        raise ValueError("動画情報を取得できませんでした")
+    return info
+
+def extract_preview(url: str) -> dict:
+    """1件の動画の詳細情報を取得（一括プレビューの並列取得用）"""
+    info = fetch_preview_info(url, isolated=True)
+    if not info:
+        raise ValueError("動画情報を取得できませんでした")
+    return info
+
+def preview_item(index: int, info: dict, status: str) -> dict:
+    """info dict（フラット抽出の項目を含む）からプレビュー1件分のイベントを作成"""
+    original_title = info.get('title') or '不明なタイトル'
+    uploader = info.get('uploader') or info.get('channel') or '不明なアーティスト'
+    title, artist = parse_title_artist(original_title, uploader)
+    thumbnail = info.get('thumbnail')
+    if not thumbnail and info.get('thumbnails'):
+        thumbnail = info['thumbnails'][-1].get('url')
+    description = info.get('description') or ''
+    return {
+        "type": "item",
+        "index": index,
+        "status": status,
+        "id": info.get('id'),
+        "url": info.get('webpage_url') or info.get('url'),
+        "title": title,
+        "artist": artist,
+        "original_title": original_title,
+        "uploader": uploader,
+        "duration": int(info.get('duration') or 0),
+        "thumbnail": thumbnail or "",
+        "description": description[:200],
+    }
+
+async def batch_preview_events(urls: list[str], details: bool):
+    """プレビューのイベントを解決した順に生成
+
+    一覧の取得と詳細の取得は並行して進め、どちらのイベントもキュー経由で届いた順に返す。
+    """
+    semaphore = asyncio.Semaphore(max(1, BATCH_PREVIEW_CONCURRENCY))
+    events = asyncio.Queue()
+    pending = []
+    count = 0
+
+    async def resolve(index: int, url: str):
+        async with semaphore:
+            try:
+                info = await run_in_threadpool(extract_preview, url)
+                await events.put(preview_item(index, info, "resolved"))
+            except Exception as e:
+                await events.put({"type": "item", "index": index, "status": "failed", "url": url, "message": str(e)})
+
+    async def list_all():
+        nonlocal count
+        for source_url in urls:
+            if count >= BATCH_PREVIEW_MAX_ITEMS:
+                break
+            try:
+                listing = await run_in_threadpool(extract_listing, source_url)
+            except Exception as e:
+                await events.put({"type": "error", "url": source_url, "message": str(e)})
+                continue
+
+            if listing.get('_type') != 'playlist':
+                # 単一動画は一覧の取得で詳細まで揃っている
+                await events.put(preview_item(count, listing, "resolved"))
+                count += 1
+                continue
+
+            entries = [entry for entry in listing.get('entries') or [] if entry]
+            await events.put({"type": "playlist", "url": source_url, "title": listing.get('title'), "count": len(entries)})
+            for entry in entries[:BATCH_PREVIEW_MAX_ITEMS - count]:
+                await events.put(preview_item(count, entry, "listed"))
+                entry_url = entry.get('url') or entry.get('webpage_url')
+                if details and entry_url:
+                    pending.append(asyncio.ensure_future(resolve(count, entry_url)))
+                count += 1
+        await asyncio.gather(*pending)
+        await events.put(None)
+
+    producer = asyncio.ensure_future(list_all())
+    failed = 0
+    try:
+        while True:
+            event = await events.get()
+            if event is None:
+                break
+            if event["type"] == "error" or event.get("status") == "failed":
+                failed += 1
+            yield event
+        await producer
+        yield {"type": "done", "count": count, "failed": failed}
+    finally:
+        # クライアントが切断した場合などは残りの取得を取りやめる
+        producer.cancel()
+        for future in pending:
+            future.cancel()
+
+@app.post("/preview/batch")
+async def preview_batch(request: BatchPreviewRequest, http_request: Request):
+    """複数URL・プレイリストのプレビューを NDJSON（既定）または SSE でストリーミング
+
+    プレイリストの各動画はまず一覧の情報（status: listed）を返し、details が true の場合は
+    詳細を取得でき次第 status: resolved として同じ index で返す。
+    """
+    urls = [url.strip() for url in request.urls if url.strip()]
+    if not urls:
+        raise HTTPException(status_code=400, detail="URLが指定されていません")
+    if rate_limited(http_request, "batch_preview", BATCH_PREVIEW_RATE_LIMIT_PER_MINUTE):
+        raise HTTPException(status_code=429, detail="リクエストが多すぎます。しばらくしてから再試行してください")
+
+    use_sse = "text/event-stream" in http_request.headers.get("accept", "")
+    logger.info(f"一括プレビュー開始: {len(urls)}件 ({'SSE' if use_sse else 'NDJSON'})")
+
+    async def body():
+        async for event in batch_preview_events(urls, request.details):
+            data = json.dumps(event, ensure_ascii=False)
+            yield f"event: {event['type']}\ndata: {data}\n\n" if use_sse else data + "\n"
+
+    return StreamingResponse(
+        body(),
+        media_type="text/event-stream" if use_sse else "application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @app.post("/download", response_model=DownloadResponse)
-async def download_audio(request: DownloadRequest):
+async def download_audio(request: DownloadRequest, http_request: Request):
     """YouTube動画をM4Aでダウンロード（単一動画のみ）"""
-    temp_dir = None
+    url = request.url.strip()
+    if not url:
+        raise HTTPException(status_code=400, detail="URLが指定されていません")
     try:
-        url = request.url.strip()
-        
-        if not url:
-            raise HTTPException(status_code=400, detail="URLが指定されていません")
-        
-        # 単一動画のみ対応
-        is_playlist = False
-        
-        # ダウンロード用の一意なディレクトリを作成
-        download_id = str(uuid.uuid4())[:8]
-        temp_dir = DOWNLOAD_DIR / download_id
-        temp_dir.mkdir(exist_ok=True)
-        
-        logger.info(f"ダウンロード開始: {url}")
-        logger.info(f"一時ディレクトリ: {temp_dir}")
-        
-        # ダウンロード実行（シンプル2段階）
-        download_success = False
-        download_attempts = [
-            ('通常', False),
-            ('フォールバック', True)
-        ]  # ローカル成功版ベースのシンプル設定
-        
-        for attempt, (attempt_name, use_fallback) in enumerate(download_attempts):
-            if download_success:
-                break
-                
-            logger.info(f"ダウンロード試行 {attempt + 1}/2 ({attempt_name}設定)")
-            ydl_opts = get_ydl_opts(temp_dir, is_playlist, use_fallback)
-            
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                try:
-                    # まず情報を取得
-                    logger.info("動画情報を取得中...")
-                    info = ydl.extract_info(url, download=False)
-                    
-                    if not info:
-                        if use_fallback:
-                            raise HTTPException(status_code=404, detail="動画情報を取得できませんでした")
-                        continue
-                    
-                    # 単一動画のダウンロード
-                    logger.info("単一動画をダウンロード中...")
-                    ydl.download([url])
-                    
-                    # ダウンロード後、実際にファイルが存在するか確認
-                    downloaded_files = list(temp_dir.glob('*'))
-                    audio_video_files = [f for f in downloaded_files if f.suffix.lower() in ['.m4a', '.mp4', '.webm', '.aac', '.flv', '.3gp']]
-                    
-                    if audio_video_files:
-                        download_success = True
-                        logger.info(f"✅ ダウンロード成功 - ファイル: {[f.name for f in audio_video_files]}")
-                    else:
-                        logger.warning(f"ダウンロードは完了したが音声/動画ファイルが見つかりません: {[f.name for f in downloaded_files]}")
-                        raise Exception("音声/動画ファイルのダウンロードに失敗")
-                    
-                except Exception as e:
-                    logger.warning(f"ダウンロード試行 {attempt + 1} ({attempt_name}設定) 失敗: {e}")
-                    if use_fallback:
-                        # フォールバックでも失敗した場合はエラーを発生
-                        raise HTTPException(status_code=500, detail=f"全ての方法でダウンロードに失敗しました: {str(e)}")
-                    continue
-        
-        if not download_success:
-            raise HTTPException(status_code=500, detail="全てのダウンロード試行が失敗しました")
-        
-        # ダウンロード後の処理
-        try:
-            # M4Aファイルを探す
-            m4a_files = list(temp_dir.glob('*.m4a'))
-            
-            if not m4a_files:
-                # M4Aファイルが見つからない場合、他の音声・動画フォーマットも探す
-                logger.info("M4Aファイルが見つかりません。他のフォーマットを探しています...")
-                
-                # より多くのフォーマットを検索
-                all_files = list(temp_dir.glob('*'))
-                logger.info(f"ダウンロードされたファイル: {[f.name for f in all_files]}")
-                
-                audio_files = (
-                    list(temp_dir.glob('*.webm')) + 
-                    list(temp_dir.glob('*.mp4')) + 
-                    list(temp_dir.glob('*.aac')) +
-                    list(temp_dir.glob('*.flv')) +  # FLVも追加
-                    list(temp_dir.glob('*.3gp')) +  # 3GPも追加
-                    list(temp_dir.glob('*.avi')) +  # AVIも追加
-                    list(temp_dir.glob('*.mkv'))    # MKVも追加
-                )
-                
-                if audio_files:
-                    # 最初に見つかったファイルを使用
-                    audio_file = audio_files[0]
-                    logger.info(f"音声ファイルを発見: {audio_file.name}")
-                    m4a_file = temp_dir / f"{audio_file.stem}.m4a"
-                    
-                    # ファイル名を変更してm4aとして扱う
-                    audio_file.rename(m4a_file)
-                    logger.info(f"ファイルをm4aに変換: {audio_file.name} -> {m4a_file.name}")
-                else:
-                    # どのファイルも見つからない場合、詳細ログを出力
-                    logger.error(f"音声ファイルが見つかりません。ディレクトリ内容: {[f.name for f in all_files]}")
-                    raise HTTPException(status_code=500, detail="音声ファイルの生成に失敗しました")
-            else:
-                m4a_file = m4a_files[0]  # 単一動画なので最初のファイル
-            
-            # 動画情報を取得
-            video_title = info.get('title', 'Unknown')
-            uploader = info.get('uploader', 'Unknown Artist')
-            thumbnail_url = info.get('thumbnail')
-            
-            logger.info(f"動画情報 - タイトル: '{video_title}', 投稿者: '{uploader}'")
-            
-            # タイトルとアーティストを解析
-            title, artist = parse_title_artist(video_title, uploader)
-            logger.info(f"解析結果 - タイトル: '{title}', アーティスト: '{artist}'")
-            
-            # サムネイル画像を処理
-            thumbnail_path = None
-            video_id = info.get('id', 'thumb')
-            
-            # まず既存のサムネイル画像ファイルを探す
-            existing_thumbnails = list(temp_dir.glob(f'{video_id}.*')) + list(temp_dir.glob('*.jpg')) + list(temp_dir.glob('*.png')) + list(temp_dir.glob('*.webp'))
-            
-            if existing_thumbnails:
-                # 既存のサムネイル画像を使用
-                original_thumb = existing_thumbnails[0]
-                thumbnail_path = temp_dir / f"{video_id}_cover.jpg"
-                try:
-                    # 既存の画像を800x800に変換
-                    from PIL import Image
-                    with Image.open(original_thumb) as img:
-                        if img.mode != 'RGB':
-                            img = img.convert('RGB')
-                        
-                        # 正方形にクロップ
-                        width, height = img.size
-                        size = min(width, height)
-                        left = (width - size) // 2
-                        top = (height - size) // 2
-                        right = left + size
-                        bottom = top + size
-                        
-                        img_cropped = img.crop((left, top, right, bottom))
-                        img_resized = img_cropped.resize((800, 800), Image.Resampling.LANCZOS)
-                        
-                        # 保存
-                        img_resized.save(thumbnail_path, 'JPEG', quality=95, optimize=True)
-                        logger.info(f"✅ 既存サムネイルから800x800ジャケット画像を作成: {thumbnail_path.name}")
-                except Exception as e:
-                    logger.warning(f"既存サムネイルの処理に失敗: {e}")
-                    thumbnail_path = None
-            
-            # 既存のサムネイルがない場合、URLからダウンロードして処理
-            if not thumbnail_path and thumbnail_url:
-                thumbnail_path = temp_dir / f"{video_id}_cover.jpg"
-                if download_and_process_thumbnail(thumbnail_url, thumbnail_path):
-                    logger.info(f"✅ URLからジャケット画像処理完了: {thumbnail_path.name}")
-                else:
-                    thumbnail_path = None
-            
-            # メタデータを追加
-            add_metadata_to_m4a(m4a_file, title, artist, None, thumbnail_path)
-            
-            # ファイル名を変更
-            safe_artist = sanitize_filename(artist)
-            safe_title = sanitize_filename(title)
-            new_filename = f"{safe_artist}-{safe_title}.m4a"
-            new_filepath = temp_dir / new_filename
-            
-            # ファイル名を変更
-            m4a_file.rename(new_filepath)
-            logger.info(f"ファイル名変更: {new_filename}")
-            
-            # ファイルをダウンロードディレクトリに移動
-            final_path = DOWNLOAD_DIR / new_filename
-            shutil.move(str(new_filepath), str(final_path))
-            logger.info(f"ファイル移動: {new_filename} -> downloads/")
-            
-            # 一時ディレクトリを削除
-            shutil.rmtree(temp_dir)
-            temp_dir = None
-            
-            return DownloadResponse(
-                success=True,
-                message=f"ダウンロード完了: {title} - {artist}",
-                file_path=str(final_path),
-                file_name=new_filename
-            )
-            
-        except Exception as e:
-            logger.error(f"ダウンロードエラー: {e}")
-            raise HTTPException(status_code=500, detail=f"ダウンロードエラー: {str(e)}")
-                
-    except HTTPException:
-        raise
+        clip = parse_clip_range(request.start, request.end)
+        profile = parse_output_profile(request.profile)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if rate_limited(http_request):
+        raise HTTPException(status_code=429, detail="リクエストが多すぎます。しばらくしてから再試行してください")
+
+    logger.info(f"ダウンロード開始: {url}{f' ({clip_label(clip)})' if clip else ''}")
+    pipeline = DownloadPipeline(DOWNLOAD_DIR, cache=stage_cache, library=audio_library,
+                                scheduler=work_scheduler)
+    ctx = await claim_prefetch(url, clip, profile) or pipeline.new_context(url, clip=clip, profile=profile)
+    try:
+        await execute_pipeline(pipeline, ctx, "store", http_request)
+        return DownloadResponse(
+            success=True,
+            message=f"ダウンロード完了: {ctx.title} - {ctx.artist}",
+            file_path=str(ctx.output_path),
+            file_name=ctx.filename,
+            profile=ctx.profile,
+            encode_seconds=round(ctx.timings.get("convert", 0.0), 3),
+            file_size=ctx.output_bytes,
+        )
+    except PipelineError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.message)
     except Exception as e:
         logger.error(f"予期しないエラー: {e}")
         raise HTTPException(status_code=500, detail=f"予期しないエラー: {str(e)}")
     finally:
         # 一時ディレクトリのクリーンアップ
-        if temp_dir and temp_dir.exists():
-            try:
-                shutil.rmtree(temp_dir)
-                logger.info(f"一時ディレクトリを削除: {temp_dir}")
-            except Exception as e:
-                logger.warning(f"一時ディレクトリの削除に失敗: {e}")
+        ctx.cleanup()
 
 @app.post("/download-with-metadata", response_model=DownloadResponse)
-async def download_audio_with_metadata(request: DownloadWithMetadataRequest):
+async def download_audio_with_metadata(request: DownloadWithMetadataRequest, http_request: Request):
     """YouTube動画をM4Aでダウンロード（編集されたメタデータ付き）"""
-    temp_dir = None
-    success = False  # 成功フラグ
-    
+    url = request.url.strip()
+    title = request.title.strip()
+    artist = request.artist.strip()
+
+    if not url:
+        return DownloadResponse(success=False, message="エラーが発生しました: 400: URLが指定されていません")
+    if not title:
+        return DownloadResponse(success=False, message="エラーが発生しました: 400: タイトルが指定されていません")
+    if not artist:
+        return DownloadResponse(success=False, message="エラーが発生しました: 400: アーティスト名が指定されていません")
     try:
-        url = request.url.strip()
-        title = request.title.strip()
-        artist = request.artist.strip()
-        
-        if not url:
-            raise HTTPException(status_code=400, detail="URLが指定されていません")
-        
-        if not title:
-            raise HTTPException(status_code=400, detail="タイトルが指定されていません")
-        
-        if not artist:
-            raise HTTPException(status_code=400, detail="アーティスト名が指定されていません")
-        
-        # 単一動画のみ対応
-        is_playlist = False
-        
-        # ダウンロード用の一意なディレクトリを作成
-        download_id = str(uuid.uuid4())[:8]
-        temp_dir = DOWNLOAD_DIR / download_id
-        temp_dir.mkdir(exist_ok=True)
-        
-        logger.info(f"メタデータ付きダウンロード開始: {url}")
-        logger.info(f"タイトル: '{title}', アーティスト: '{artist}'")
-        logger.info(f"一時ディレクトリ: {temp_dir}")
-        
-        # ダウンロード実行（シンプル2段階）
-        download_success = False
-        download_attempts = [
-            ('通常', False),
-            ('フォールバック', True)
-        ]  # ローカル成功版ベースのシンプル設定
-        
-        for attempt, (attempt_name, use_fallback) in enumerate(download_attempts):
-            if download_success:
-                break
-                
-            logger.info(f"ダウンロード試行 {attempt + 1}/2 ({attempt_name}設定)")
-            ydl_opts = get_ydl_opts(temp_dir, is_playlist, use_fallback)
-            
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                try:
-                    # まず情報を取得
-                    logger.info("動画情報を取得中...")
-                    info = ydl.extract_info(url, download=False)
-                    
-                    if not info:
-                        if use_fallback:
-                            raise HTTPException(status_code=404, detail="動画情報を取得できませんでした")
-                        continue
-                    
-                    # 単一動画のダウンロード
-                    logger.info("単一動画をダウンロード中...")
-                    ydl.download([url])
-                    
-                    # ダウンロード後、実際にファイルが存在するか確認
-                    downloaded_files = list(temp_dir.glob('*'))
-                    audio_video_files = [f for f in downloaded_files if f.suffix.lower() in ['.m4a', '.mp4', '.webm', '.aac', '.flv', '.3gp']]
-                    
-                    if audio_video_files:
-                        download_success = True
-                        logger.info(f"✅ ダウンロード成功 - ファイル: {[f.name for f in audio_video_files]}")
-                    else:
-                        logger.warning(f"ダウンロードは完了したが音声/動画ファイルが見つかりません: {[f.name for f in downloaded_files]}")
-                        raise Exception("音声/動画ファイルのダウンロードに失敗")
-                    
-                except Exception as e:
-                    logger.warning(f"ダウンロード試行 {attempt + 1} ({attempt_name}設定) 失敗: {e}")
-                    if use_fallback:
-                        # フォールバックでも失敗した場合はエラーを発生
-                        return DownloadResponse(
-                            success=False,
-                            message=f"全ての方法でダウンロードに失敗しました: {str(e)}"
-                        )
-                    continue
-        
-        if not download_success:
-            return DownloadResponse(
-                success=False,
-                message="全てのダウンロード試行が失敗しました"
-            )
-        
-        # ダウンロード後の処理
-        try:
-            # M4Aファイルを探す
-            m4a_files = list(temp_dir.glob('*.m4a'))
-            
-            if not m4a_files:
-                # M4Aファイルが見つからない場合、他の音声・動画フォーマットも探す
-                logger.info("M4Aファイルが見つかりません。他のフォーマットを探しています...")
-                
-                # より多くのフォーマットを検索
-                all_files = list(temp_dir.glob('*'))
-                logger.info(f"ダウンロードされたファイル: {[f.name for f in all_files]}")
-                
-                audio_files = (
-                    list(temp_dir.glob('*.webm')) + 
-                    list(temp_dir.glob('*.mp4')) + 
-                    list(temp_dir.glob('*.aac')) +
-                    list(temp_dir.glob('*.flv')) +  # FLVも追加
-                    list(temp_dir.glob('*.3gp')) +  # 3GPも追加
-                    list(temp_dir.glob('*.avi')) +  # AVIも追加
-                    list(temp_dir.glob('*.mkv'))    # MKVも追加
-                )
-                
-                if audio_files:
-                    # 最初に見つかったファイルを使用
-                    audio_file = audio_files[0]
-                    logger.info(f"音声ファイルを発見: {audio_file.name}")
-                    m4a_file = temp_dir / f"{audio_file.stem}.m4a"
-                    
-                    # ファイル名を変更してm4aとして扱う
-                    audio_file.rename(m4a_file)
-                    logger.info(f"ファイルをm4aに変換: {audio_file.name} -> {m4a_file.name}")
-                else:
-                    # どのファイルも見つからない場合、詳細ログを出力
-                    logger.error(f"音声ファイルが見つかりません。ディレクトリ内容: {[f.name for f in all_files]}")
-                    raise HTTPException(status_code=500, detail="音声ファイルの生成に失敗しました")
-            else:
-                m4a_file = m4a_files[0]  # 単一動画なので最初のファイル
-            
-            # 動画情報を取得
-            thumbnail_url = info.get('thumbnail')
-            video_id = info.get('id', 'thumb')
-            
-            # サムネイル画像を処理
-            thumbnail_path = None
-            
-            # まず既存のサムネイル画像ファイルを探す
-            existing_thumbnails = list(temp_dir.glob(f'{video_id}.*')) + list(temp_dir.glob('*.jpg')) + list(temp_dir.glob('*.png')) + list(temp_dir.glob('*.webp'))
-            
-            if existing_thumbnails:
-                # 既存のサムネイル画像を使用
-                original_thumb = existing_thumbnails[0]
-                thumbnail_path = temp_dir / f"{video_id}_cover.jpg"
-                try:
-                    # 既存の画像を800x800に変換
-                    from PIL import Image
-                    with Image.open(original_thumb) as img:
-                        if img.mode != 'RGB':
-                            img = img.convert('RGB')
-                        
-                        # 正方形にクロップ
-                        width, height = img.size
-                        size = min(width, height)
-                        left = (width - size) // 2
-                        top = (height - size) // 2
-                        right = left + size
-                        bottom = top + size
-                        
-                        img_cropped = img.crop((left, top, right, bottom))
-                        img_resized = img_cropped.resize((800, 800), Image.Resampling.LANCZOS)
-                        
-                        # 保存
-                        img_resized.save(thumbnail_path, 'JPEG', quality=95, optimize=True)
-                        logger.info(f"✅ 既存サムネイルから800x800ジャケット画像を作成: {thumbnail_path.name}")
-                except Exception as e:
-                    logger.warning(f"既存サムネイルの処理に失敗: {e}")
-                    thumbnail_path = None
-            
-            # 既存のサムネイルがない場合、URLからダウンロードして処理
-            if not thumbnail_path and thumbnail_url:
-                thumbnail_path = temp_dir / f"{video_id}_cover.jpg"
-                if download_and_process_thumbnail(thumbnail_url, thumbnail_path):
-                    logger.info(f"✅ URLからジャケット画像処理完了: {thumbnail_path.name}")
-                else:
-                    logger.warning("サムネイル画像の処理に失敗")
-                    thumbnail_path = None
-            
-            # M4Aファイルにメタデータを追加（編集されたメタデータを使用）
-            try:
-                if add_metadata_to_m4a(m4a_file, title, artist, None, thumbnail_path):
-                    logger.info("✅ メタデータの追加が完了しました")
-                else:
-                    logger.warning("メタデータの追加に失敗しました（処理は続行）")
-            except Exception as e:
-                logger.warning(f"メタデータ追加中にエラーが発生: {e} （処理は続行）")
-            
-            # ファイル名を生成（編集されたメタデータを使用）
-            filename = f"{sanitize_filename(artist)}-{sanitize_filename(title)}.m4a"
-            
-            logger.info(f"ダウンロード完了: {filename}")
-            
-            # 成功フラグを設定
-            success = True
-            
-            # ファイルをレスポンスとして返し、バックグラウンドで一時ディレクトリを削除
-            def cleanup_temp_dir():
-                try:
-                    if temp_dir and temp_dir.exists():
-                        shutil.rmtree(temp_dir)
-                        logger.info(f"一時ディレクトリを削除: {temp_dir}")
-                except Exception as e:
-                    logger.warning(f"一時ディレクトリの削除に失敗: {e}")
-            
-            # ファイルレスポンスを返す（バックグラウンドタスクで削除）
-            background_tasks = BackgroundTasks()
-            background_tasks.add_task(cleanup_temp_dir)
-            
-            return FileResponse(
-                m4a_file,
-                media_type="audio/m4a",
-                filename=filename,
-                headers={"Content-Disposition": f"attachment; filename={filename}"},
-                background=background_tasks
-            )
-            
-        except Exception as e:
-            logger.error(f"ダウンロード処理エラー: {str(e)}")
-            return DownloadResponse(
-                success=False,
-                message=f"ダウンロードエラー: {str(e)}"
-            )
+        clip = parse_clip_range(request.start, request.end)
+        profile = parse_output_profile(request.profile)
+    except ValueError as e:
+        return DownloadResponse(success=False, message=f"エラーが発生しました: 400: {e}")
+    if rate_limited(http_request):
+        return DownloadResponse(success=False, message="リクエストが多すぎます。しばらくしてから再試行してください")
 
+    logger.info(f"メタデータ付きダウンロード開始: {url}{f' ({clip_label(clip)})' if clip else ''}")
+    logger.info(f"タイトル: '{title}', アーティスト: '{artist}'")
+    pipeline = DownloadPipeline(DOWNLOAD_DIR, cache=stage_cache, library=audio_library,
+                                scheduler=work_scheduler)
+    ctx = await claim_prefetch(url, clip, profile)
+    if ctx is not None:
+        ctx.title, ctx.artist = title, artist
+    else:
+        ctx = pipeline.new_context(url, title, artist, clip=clip, profile=profile)
+    try:
+        await execute_pipeline(pipeline, ctx, "stream", http_request)
+    except PipelineError as e:
+        ctx.cleanup()
+        return DownloadResponse(success=False, message=e.message)
     except Exception as e:
         logger.error(f"ダウンロードエラー: {str(e)}")
-        return DownloadResponse(
-            success=False,
-            message=f"エラーが発生しました: {str(e)}"
-        )
-    
-    finally:
-        # 成功した場合はバックグラウンドタスクで削除されるため、エラー時のみ削除
-        if not success and temp_dir and temp_dir.exists():
-            try:
-                shutil.rmtree(temp_dir)
-                logger.info(f"一時ディレクトリを削除（エラー時）: {temp_dir}")
-            except Exception as e:
-                logger.warning(f"一時ディレクトリの削除に失敗: {e}")
+        ctx.cleanup()
+        return DownloadResponse(success=False, message=f"エラーが発生しました: {str(e)}")
+
+    # ファイルをレスポンスとして返し、バックグラウンドで一時ディレクトリを削除
+    background_tasks = BackgroundTasks()
+    background_tasks.add_task(ctx.cleanup)
+    return FileResponse(
+        ctx.output_path,
+        media_type=ctx.media_type,
+        filename=ctx.filename,
+        headers={
+            "Content-Disposition": f"attachment; filename={ctx.filename}",
+            "X-Output-Profile": ctx.profile,
+            "X-Encode-Seconds": f"{ctx.timings.get('convert', 0.0):.3f}",
+        },
+        background=background_tasks
+    )
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """ジョブの状態を取得（どのワーカーで実行中でも参照可能）"""
+    job = job_tracker.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="ジョブが見つかりません")
+    return job
+
+@app.get("/debug/prefetch")
+async def debug_prefetch():
+    """プリフェッチの状態と統計（ヒット率、無駄になった書き込み量）"""
+    return prefetch_manager.snapshot()
+
+@app.get("/debug/library")
+async def debug_library():
+    """同一音源ライブラリの登録数とヒット率（ステージキャッシュのヒット率も含む）"""
+    if audio_library is None:
+        return {"enabled": False, "stage_cache": stage_cache.snapshot()}
+    return {"enabled": True, **await run_in_threadpool(audio_library.snapshot), "stage_cache": stage_cache.snapshot()}
+
+@app.get("/debug/static")
+async def debug_static():
+    """フロントエンド配信のメモリキャッシュと圧縮済みファイルの利用状況"""
+    if static_files is None:
+        return {"enabled": False}
+    return {"enabled": True, "assets": asset_files.snapshot(), "static": static_files.snapshot()}
+
+@app.get("/debug/scheduler")
+async def debug_scheduler():
+    """レーンごとの実行中・待機中のジョブと、実行枠の待ち時間（p50/p95）"""
+    return work_scheduler.snapshot()
+
+@app.get("/debug/profiles")
+async def debug_profiles():
+    """出力プロファイルごとの件数・変換時間・出力サイズ（このワーカーの集計）"""
+    ffmpeg_path = await run_in_threadpool(find_ffmpeg_path)
+    he_aac = bool(ffmpeg_path) and await run_in_threadpool(ffmpeg_has_encoder, ffmpeg_path, 'libfdk_aac')
+    return {
+        "default": OUTPUT_PROFILE,
+        "mobile_codec": f"HE-AAC {MOBILE_HE_AAC_BITRATE}" if he_aac else f"AAC-LC {MOBILE_AAC_BITRATE}",
+        "profiles": output_profile_stats.snapshot(),
+    }
+
+@app.get("/debug/upstream")
+async def debug_upstream():
+    """上流へのリクエスト数・受信量と、レート制限で待った時間（ホスト・帯域ごと）"""
+    return upstream_limiter.snapshot()
+
+@app.get("/debug/memory")
+async def debug_memory():
+    """プロセスのRSSと画像デコード用メモリ予算の状態"""
+    return {
+        "rss": current_rss(),
+        "rss_limit": MEMORY_LIMIT_BYTES,
+        "active_jobs": job_tracker.active_count(),
+        "image_budget": image_memory.snapshot(),
+    }
+
+@app.get("/debug/traces")
+async def debug_traces(request_id: Optional[str] = None, limit: int = 20):
+    """直近のトレース（TRACE_EXPORTER に memory を含む場合）"""
+    if tracer.memory is None:
+        return {"enabled": False, "sample_rate": tracer.sample_rate, "traces": []}
+    return {
+        "enabled": True,
+        "sample_rate": tracer.sample_rate,
+        "dropped_spans": tracer.processor.dropped,
+        "traces": tracer.memory.traces(request_id, limit),
+    }
+
+def require_admin(http_request: Request):
+    """管理APIのトークンを確認"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="管理APIは無効です")
+    token = http_request.headers.get("x-admin-token", "")
+    if not secrets.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="管理トークンが正しくありません")
+
+@app.post("/admin/profile")
+async def start_profile(request: ProfileStartRequest, http_request: Request):
+    """次のN件のリクエスト、または指定秒数のあいだプロファイルを取得"""
+    require_admin(http_request)
+    if not 0 <= request.requests <= 1000 or not 0 <= request.seconds <= 600:
+        raise HTTPException(status_code=400, detail="requests は1000件、seconds は600秒までです")
+    if not 1 <= request.interval_ms <= 1000:
+        raise HTTPException(status_code=400, detail="interval_ms は1〜1000の範囲で指定してください")
+    try:
+        session = profiler.start(request.requests, request.seconds, request.interval_ms / 1000)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return session.summary()
+
+@app.get("/admin/profile")
+async def list_profiles(http_request: Request):
+    """プロファイルの一覧"""
+    require_admin(http_request)
+    return {"armed": profiler.armed, "sessions": profiler.sessions()}
+
+@app.get("/admin/profile/{session_id}")
+async def get_profile(session_id: str, http_request: Request, format: str = "folded"):
+    """プロファイル結果（folded: flamegraph.pl / speedscope 形式, json: 関数ごとの集計）"""
+    require_admin(http_request)
+    session = profiler.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="プロファイルが見つかりません")
+    if format == "json":
+        return session.summary()
+    return PlainTextResponse(session.folded())
+
+@app.post("/admin/profile/{session_id}/stop")
+async def stop_profile(session_id: str, http_request: Request):
+    """実行中のプロファイルを終了"""
+    require_admin(http_request)
+    stopped = profiler.stop(session_id)
+    if not stopped:
+        raise HTTPException(status_code=404, detail="実行中のプロファイルが見つかりません")
+    return stopped[0].summary()
 
 @app.get("/download/{file_name}")
 async def get_file(file_name: str):
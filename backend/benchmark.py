@@ -0,0 +1,554 @@
+"""ダウンロードパイプラインのベンチマーク
+
+実際の `/download-with-metadata` フローを、ローカルの偽エクストラクタと
+フィクスチャ配信用HTTPサーバーに対して実行し、以下を計測する。
+
+- ステージごとの処理時間
+- 同時リクエスト数（デフォルト 1/4/16/64）ごとのスループット
+- ピークRSS（FFmpegなどの子プロセスを含む）とピークディスク使用量
+
+ネットワークには一切接続しないため、通常のLinuxマシン上でオフライン実行できる。
+FFmpegだけは必要（テストトーンの生成と音声変換に使用）。
+
+使い方（backendディレクトリで実行）:
+    python benchmark.py
+    python benchmark.py --concurrency 1,4 --duration 60 --json bench.jsonl
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+# app.py はテンプレートを相対パスで読むため、backendディレクトリを基準にする
+BACKEND_DIR = Path(__file__).resolve().parent
+os.chdir(BACKEND_DIR)
+sys.path.insert(0, str(BACKEND_DIR))
+
+import requests
+import uvicorn
+from PIL import Image, ImageDraw
+from yt_dlp.extractor.common import InfoExtractor
+
+import app as app_module
+
+logger = logging.getLogger("benchmark")
+
+FIXTURE_FORMATS = {
+    # 拡張子: (コーデック引数, acodec)
+    'm4a': (['-c:a', 'aac', '-b:a', '128k'], 'aac'),
+    'webm': (['-c:a', 'libopus', '-b:a', '128k'], 'opus'),
+}
+
+
+# ---------------------------------------------------------------------------
+# フィクスチャ
+# ---------------------------------------------------------------------------
+
+def generate_fixtures(fixture_dir: Path, duration: int, ffmpeg_path: str) -> dict:
+    """FFmpegでテストトーンを、PILでサムネイル画像を生成"""
+    fixture_dir.mkdir(parents=True, exist_ok=True)
+    media = {}
+
+    for ext, (codec_args, acodec) in FIXTURE_FORMATS.items():
+        output = fixture_dir / f"tone-{duration}s.{ext}"
+        if not output.exists():
+            cmd = [
+                ffmpeg_path, '-y', '-loglevel', 'error',
+                '-f', 'lavfi', '-i', f'sine=frequency=440:sample_rate=44100:duration={duration}',
+                '-f', 'lavfi', '-i', f'sine=frequency=660:sample_rate=44100:duration={duration}',
+                '-filter_complex', '[0:a][1:a]amerge=inputs=2[a]', '-map', '[a]',
+                *codec_args, str(output),
+            ]
+            result = subprocess.run(cmd, capture_output=True, text=True)
+            if result.returncode != 0:
+                logger.warning(f"フィクスチャ生成に失敗 ({ext}): {result.stderr.strip()}")
+                continue
+        media[ext] = {'path': output, 'acodec': acodec, 'filesize': output.stat().st_size}
+
+    thumbnail = fixture_dir / "thumbnail.jpg"
+    if not thumbnail.exists():
+        # YouTubeのmaxresdefaultと同じ16:9の画像
+        img = Image.new('RGB', (1280, 720), (30, 30, 60))
+        draw = ImageDraw.Draw(img)
+        for i in range(0, 1280, 40):
+            draw.line([(i, 0), (1280 - i, 720)], fill=(200, 120, 40), width=3)
+        img.save(thumbnail, 'JPEG', quality=90)
+
+    if not media:
+        raise RuntimeError("フィクスチャ音声を1つも生成できませんでした")
+    return {'media': media, 'thumbnail': thumbnail}
+
+
+class FixtureRequestHandler(SimpleHTTPRequestHandler):
+    """フィクスチャを配信するハンドラ（Rangeリクエストと帯域制限に対応）"""
+
+    throttle_bytes_per_sec = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_head(self):
+        path = Path(self.translate_path(self.path))
+        if not path.is_file():
+            self.send_error(404, "File not found")
+            return None
+
+        size = path.stat().st_size
+        start, end = 0, size - 1
+        range_header = self.headers.get('Range')
+        match = re.match(r'bytes=(\d*)-(\d*)$', range_header or '')
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = int(match.group(2)) if match.group(2) else size - 1
+            else:
+                start = max(0, size - int(match.group(2)))
+            end = min(end, size - 1)
+            if start > end:
+                self.send_error(416, "Requested Range Not Satisfiable")
+                return None
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Type', self.guess_type(str(path)))
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+        f = open(path, 'rb')
+        f.seek(start)
+        self._remaining = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        chunk_size = 64 * 1024
+        while self._remaining > 0:
+            chunk = source.read(min(chunk_size, self._remaining))
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            self._remaining -= len(chunk)
+            if self.throttle_bytes_per_sec:
+                time.sleep(len(chunk) / self.throttle_bytes_per_sec)
+
+
+def start_fixture_server(fixture_dir: Path, throttle_kbps: int) -> tuple[ThreadingHTTPServer, str]:
+    """フィクスチャ配信用のHTTPサーバーをバックグラウンドで起動"""
+    handler = partial(FixtureRequestHandler, directory=str(fixture_dir))
+    FixtureRequestHandler.throttle_bytes_per_sec = throttle_kbps * 1024
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    return server, f"http://{host}:{port}"
+
+
+# ---------------------------------------------------------------------------
+# 偽エクストラクタ
+# ---------------------------------------------------------------------------
+
+class BenchFixtureIE(InfoExtractor):
+    """ローカルのフィクスチャサーバーを指すURLをYouTube動画のように見せる"""
+
+    IE_NAME = 'benchfixture'
+    _VALID_URL = r'https?://bench\.invalid/watch\?v=(?P<id>[\w-]+)'
+
+    base_url = None
+    media = None
+    duration = 0
+    extract_latency = 0.0
+
+    def _real_extract(self, url):
+        video_id = self._match_id(url)
+        if self.extract_latency:
+            time.sleep(self.extract_latency)
+
+        formats = []
+        for ext, fixture in self.media.items():
+            formats.append({
+                'format_id': f'fixture-{ext}',
+                'url': f"{self.base_url}/{fixture['path'].name}",
+                'ext': ext,
+                'acodec': fixture['acodec'],
+                'vcodec': 'none',
+                'abr': 128,
+                'asr': 44100,
+                'filesize': fixture['filesize'],
+                'protocol': 'http',
+            })
+
+        thumbnail_url = f"{self.base_url}/thumbnail.jpg"
+        return {
+            'id': video_id,
+            'title': f'Bench Artist - Bench Track {video_id}',
+            'uploader': 'Bench Artist',
+            'duration': self.duration,
+            'thumbnail': thumbnail_url,
+            'thumbnails': [{'id': '0', 'url': thumbnail_url, 'width': 1280, 'height': 720}],
+            'formats': formats,
+        }
+
+
+def install_fake_extractor(base_url: str, media: dict, duration: int, extract_latency: float):
+    """yt-dlpの既定エクストラクタ一覧の先頭に偽エクストラクタを差し込む"""
+    BenchFixtureIE.base_url = base_url
+    BenchFixtureIE.media = media
+    BenchFixtureIE.duration = duration
+    BenchFixtureIE.extract_latency = extract_latency
+
+    ydl_module = sys.modules['yt_dlp.YoutubeDL']
+    original_classes = ydl_module.gen_extractor_classes
+    original_lookup = ydl_module.get_info_extractor
+    ydl_module.gen_extractor_classes = lambda: [BenchFixtureIE, *original_classes()]
+    ydl_module.get_info_extractor = (
+        lambda ie_key: BenchFixtureIE if ie_key == BenchFixtureIE.ie_key() else original_lookup(ie_key))
+
+
+# ---------------------------------------------------------------------------
+# 計測
+# ---------------------------------------------------------------------------
+
+class StageTimer:
+    """ステージごとの処理時間をスレッドセーフに集計"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = defaultdict(list)
+        self._io = []
+        self._fetch = []
+
+    def record(self, stage: str, elapsed: float):
+        with self._lock:
+            self._samples[stage].append(elapsed)
+
+    def record_io(self, files_written: int, bytes_written: int):
+        with self._lock:
+            self._io.append((files_written, bytes_written))
+
+    def record_fetch(self, fetch_stats: dict):
+        with self._lock:
+            self._fetch.append(fetch_stats.get('throughput', 0.0))
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+            self._io.clear()
+            self._fetch.clear()
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {stage: _stats(values) for stage, values in self._samples.items()}
+
+    def io_summary(self) -> dict:
+        """1ジョブあたりのファイル書き込み数と書き込みバイト数"""
+        with self._lock:
+            if not self._io:
+                return {'files_per_job': 0.0, 'bytes_per_job': 0.0}
+            return {
+                'files_per_job': sum(f for f, _ in self._io) / len(self._io),
+                'bytes_per_job': sum(b for _, b in self._io) / len(self._io),
+            }
+
+    def fetch_summary(self) -> dict:
+        """1ジョブあたりのダウンロード速度（MB/s）"""
+        with self._lock:
+            return _stats([t / 1e6 for t in self._fetch])
+
+
+def silence_ydl_output():
+    """yt-dlpの進捗表示を抑制（集計結果を読みやすくするため）"""
+    original = app_module.get_ydl_opts
+
+    def quiet_opts(*args, **kwargs):
+        return dict(original(*args, **kwargs), quiet=True, noprogress=True)
+
+    app_module.get_ydl_opts = quiet_opts
+
+
+def instrument_stages(timer: StageTimer):
+    """パイプラインのステージ計測フックに集計処理を登録"""
+    def hook(stage, elapsed, ctx, error):
+        timer.record(stage if error is None else f"{stage} (error)", elapsed)
+        if stage == "fetch" and error is None and ctx.fetch_stats:
+            timer.record_fetch(ctx.fetch_stats)
+        if stage == "deliver" and error is None:
+            timer.record_io(ctx.files_written, ctx.bytes_written)
+
+    app_module.PIPELINE_HOOKS.append(hook)
+
+
+def _process_tree_pids(pid: int) -> list[int]:
+    """/proc から子孫プロセスを含むPID一覧を取得"""
+    pids = [pid]
+    try:
+        for task in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{task}/children') as f:
+                for child in f.read().split():
+                    pids.extend(_process_tree_pids(int(child)))
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        pass
+    return pids
+
+
+def _rss_bytes(pid: int) -> int:
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (FileNotFoundError, ProcessLookupError):
+        return 0
+
+
+def _dir_size(path: Path) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class ResourceSampler:
+    """ピークRSS（子プロセス込み）とピークディスク使用量を定期的にサンプリング"""
+
+    def __init__(self, watch_dir: Path, interval: float = 0.05):
+        self.watch_dir = watch_dir
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_disk = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self._stop.clear()
+        self.peak_rss = 0
+        self.peak_disk = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        pid = os.getpid()
+        while not self._stop.is_set():
+            rss = sum(_rss_bytes(p) for p in _process_tree_pids(pid))
+            self.peak_rss = max(self.peak_rss, rss)
+            self.peak_disk = max(self.peak_disk, _dir_size(self.watch_dir))
+            self._stop.wait(self.interval)
+
+
+def _stats(values: list[float]) -> dict:
+    ordered = sorted(values)
+    if not ordered:
+        return {'count': 0}
+
+    def pct(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+    return {
+        'count': len(ordered),
+        'mean': sum(ordered) / len(ordered),
+        'p50': pct(50),
+        'p95': pct(95),
+        'max': ordered[-1],
+    }
+
+
+# ---------------------------------------------------------------------------
+# 実行
+# ---------------------------------------------------------------------------
+
+def start_app_server() -> tuple[uvicorn.Server, str]:
+    """アプリ本体を同一プロセス内のuvicornで起動"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    config = uvicorn.Config(app_module.app, host='127.0.0.1', port=port, log_level='warning')
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, daemon=True).start()
+
+    deadline = time.time() + 30
+    while not server.started:
+        if time.time() > deadline:
+            raise RuntimeError("アプリサーバーの起動がタイムアウトしました")
+        time.sleep(0.05)
+    return server, f"http://127.0.0.1:{port}"
+
+
+def run_job(app_url: str, job_id: str) -> dict:
+    """1件のメタデータ付きダウンロードを実行し、結果を返す"""
+    start = time.perf_counter()
+    try:
+        response = requests.post(
+            f"{app_url}/download-with-metadata",
+            json={
+                'url': f"https://bench.invalid/watch?v={job_id}",
+                'title': f'Bench Track {job_id}',
+                'artist': 'Bench Artist',
+            },
+            timeout=600,
+        )
+        body = response.content
+        ok = response.status_code == 200 and response.headers.get('content-type', '').startswith('audio/')
+        error = None if ok else body[:200].decode('utf-8', 'replace')
+    except Exception as e:
+        body, ok, error = b'', False, str(e)
+    return {'ok': ok, 'elapsed': time.perf_counter() - start, 'bytes': len(body), 'error': error}
+
+
+def run_level(app_url: str, concurrency: int, jobs: int, timer: StageTimer, download_dir: Path) -> dict:
+    """指定した同時実行数でジョブを流し、集計結果を返す"""
+    timer.reset()
+    job_ids = [f"c{concurrency}-{i}" for i in range(jobs)]
+
+    with ResourceSampler(download_dir) as sampler:
+        wall_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(partial(run_job, app_url), job_ids))
+        wall = time.perf_counter() - wall_start
+
+    succeeded = [r for r in results if r['ok']]
+    errors = [r['error'] for r in results if not r['ok']]
+    return {
+        'concurrency': concurrency,
+        'jobs': jobs,
+        'succeeded': len(succeeded),
+        'failed': len(errors),
+        'errors': errors[:3],
+        'wall_seconds': wall,
+        'jobs_per_second': len(succeeded) / wall if wall else 0.0,
+        'output_mbytes_per_second': sum(r['bytes'] for r in succeeded) / wall / 1e6 if wall else 0.0,
+        'latency': _stats([r['elapsed'] for r in succeeded]),
+        'stages': timer.summary(),
+        'writes': timer.io_summary(),
+        'fetch_mbytes_per_second': timer.fetch_summary(),
+        'peak_rss_mb': sampler.peak_rss / 1e6,
+        'peak_disk_mb': sampler.peak_disk / 1e6,
+    }
+
+
+def print_level(result: dict):
+    latency = result['latency']
+    print(f"\n=== 同時実行数 {result['concurrency']} ({result['succeeded']}/{result['jobs']} 成功) ===")
+    print(f"  スループット : {result['jobs_per_second']:.2f} jobs/s, {result['output_mbytes_per_second']:.2f} MB/s")
+    if latency.get('count'):
+        print(f"  レイテンシ   : p50 {latency['p50']:.2f}s / p95 {latency['p95']:.2f}s / max {latency['max']:.2f}s")
+    print(f"  ピークRSS    : {result['peak_rss_mb']:.1f} MB")
+    print(f"  ピークディスク: {result['peak_disk_mb']:.1f} MB")
+    writes = result['writes']
+    print(f"  書き込み/ジョブ: {writes['files_per_job']:.1f} ファイル, {writes['bytes_per_job'] / 1e6:.2f} MB")
+    fetch = result['fetch_mbytes_per_second']
+    if fetch.get('count'):
+        print(f"  ダウンロード速度/ジョブ: 平均 {fetch['mean']:.2f} MB/s / p50 {fetch['p50']:.2f} MB/s")
+    print("  ステージ別（平均 / p95, 秒）:")
+    for stage, stats in sorted(result['stages'].items()):
+        print(f"    {stage:<16} {stats['mean']:8.3f} / {stats['p95']:8.3f}  (n={stats['count']})")
+    for error in result['errors']:
+        print(f"  ❌ {error}")
+
+
+def _git_revision() -> str:
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=BACKEND_DIR)
+        return result.stdout.strip() or 'unknown'
+    except Exception:
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ダウンロードパイプラインのベンチマーク（オフライン）")
+    parser.add_argument('--concurrency', default='1,4,16,64', help="同時実行数のカンマ区切りリスト")
+    parser.add_argument('--jobs-per-level', type=int, default=0, help="各レベルのジョブ数（0なら同時実行数の2倍）")
+    parser.add_argument('--duration', type=int, default=30, help="テストトーンの長さ（秒）")
+    parser.add_argument('--throttle-kbps', type=int, default=0, help="フィクスチャ配信の帯域制限（KB/s, 0で無制限）")
+    parser.add_argument('--extract-latency', type=float, default=0.0, help="偽エクストラクタの擬似遅延（秒）")
+    parser.add_argument('--fixture-dir', type=Path, default=None, help="フィクスチャの保存先（省略時は一時ディレクトリ）")
+    parser.add_argument('--convert-mode', choices=app_module.CONVERT_MODES, default=app_module.CONVERT_MODE,
+                        help="変換モード（three_step: 従来の3段階, single_pass: FFmpeg 1回）")
+    parser.add_argument('--connections', type=int, default=app_module.PARALLEL_DOWNLOAD_CONNECTIONS,
+                        help="1ジョブあたりの並列ダウンロード接続数（1で無効）")
+    parser.add_argument('--json', type=Path, default=None, help="結果をJSON Linesで追記するファイル")
+    parser.add_argument('--verbose', action='store_true', help="アプリとyt-dlpのログを表示")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if not args.verbose:
+        logging.getLogger('app').setLevel(logging.WARNING)
+
+    ffmpeg_path = shutil.which('ffmpeg')
+    if not ffmpeg_path:
+        sys.exit("❌ FFmpegが見つかりません。ベンチマークにはFFmpegが必要です。")
+
+    work_dir = Path(tempfile.mkdtemp(prefix='imusic-bench-'))
+    fixture_dir = args.fixture_dir or work_dir / 'fixtures'
+    download_dir = work_dir / 'downloads'
+    download_dir.mkdir()
+    app_module.DOWNLOAD_DIR = download_dir
+    app_module.CONVERT_MODE = args.convert_mode
+    app_module.PARALLEL_DOWNLOAD_CONNECTIONS = args.connections
+
+    try:
+        fixtures = generate_fixtures(fixture_dir, args.duration, ffmpeg_path)
+        fixture_server, fixture_url = start_fixture_server(fixture_dir, args.throttle_kbps)
+        install_fake_extractor(fixture_url, fixtures['media'], args.duration, args.extract_latency)
+
+        if not args.verbose:
+            silence_ydl_output()
+        timer = StageTimer()
+        instrument_stages(timer)
+        app_server, app_url = start_app_server()
+
+        levels = [int(c) for c in args.concurrency.split(',') if c.strip()]
+        results = []
+        for concurrency in levels:
+            jobs = args.jobs_per_level or concurrency * 2
+            result = run_level(app_url, concurrency, jobs, timer, download_dir)
+            print_level(result)
+            results.append(result)
+
+        app_server.should_exit = True
+        fixture_server.shutdown()
+
+        if args.json:
+            record = {
+                'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'revision': _git_revision(),
+                'params': {
+                    'duration': args.duration,
+                    'throttle_kbps': args.throttle_kbps,
+                    'extract_latency': args.extract_latency,
+                    'convert_mode': args.convert_mode,
+                    'connections': args.connections,
+                },
+                'levels': results,
+            }
+            with open(args.json, 'a') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            print(f"\n結果を追記しました: {args.json}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
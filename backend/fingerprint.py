@@ -0,0 +1,342 @@
+"""音声フィンガープリントによる同一音源の検出
+
+公式動画・トピックチャンネル・歌詞動画など、動画IDは違っても中身が同じ音源を見つけて
+処理済みのファイルを再利用するためのライブラリ。
+
+フィンガープリントは Haitsma-Kalker 方式のサブフィンガープリント（1フレーム32bit）で、
+FFmpegでデコードした低サンプルレートのモノラルPCMから NumPy でまとめて計算する。
+ハッシュ値は間引いてSQLiteのインデックス（B-tree）に登録し、検索は
+「ハッシュの完全一致 → 時間ずれごとの投票 → ビット誤り率での確認」の順に行うため、
+ライブラリの曲数が増えても全件比較にはならない。再生時間でも候補を絞り込む。
+"""
+import logging
+import shutil
+import sqlite3
+import subprocess
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 5512
+FRAME_SIZE = 2048   # 約0.37秒
+HOP_SIZE = 64       # 約11.6ms（時間ずれがあっても近いフレームが必ず存在するように細かくする）
+BAND_COUNT = 33     # 300Hz〜2000Hzを対数間隔で分割（隣接バンドの差分で32bitになる）
+BAND_EDGES = np.round(
+    np.geomspace(300, 2000, BAND_COUNT + 1) * FRAME_SIZE / SAMPLE_RATE).astype(np.intp)
+WINDOW = np.hanning(FRAME_SIZE).astype(np.float32)
+# 一度にFFTするフレーム数（メモリ使用量を抑えるため）
+BLOCK_FRAMES = 1024
+
+# 照合に使う長さ（秒）。登録側は冒頭の長さを長めに取り、前奏の長さが違うアップロードにも合うようにする
+PROBE_SECONDS = 30
+INDEX_SECONDS = 60
+# インデックスに登録するハッシュの間隔（フレーム数）。照合側は全フレームを使うので取りこぼさない
+INDEX_STRIDE = 4
+# 無音などで現れる情報のないハッシュは登録しない
+IGNORED_HASHES = (0, 0xFFFFFFFF)
+
+# 同一音源とみなすビット誤り率の上限と、比較に必要な重なり（フレーム数, 約3秒）
+BER_THRESHOLD = 0.35
+MIN_OVERLAP_FRAMES = 256
+# ビット誤り率で確認する候補数
+MAX_CANDIDATES = 10
+
+
+def decode_pcm(ffmpeg_path: str, source: Path, seconds: float, timeout: float = 60) -> np.ndarray:
+    """FFmpegで冒頭 seconds 秒をモノラル・低サンプルレートのPCMにデコード"""
+    cmd = [
+        ffmpeg_path, '-nostdin', '-loglevel', 'error', '-i', str(source), '-t', str(seconds),
+        '-vn', '-ac', '1', '-ar', str(SAMPLE_RATE), '-f', 's16le', 'pipe:1',
+    ]
+    result = subprocess.run(cmd, capture_output=True, timeout=timeout)
+    # 途中までしかないファイルはエラーを出しつつデコードできた分を返すため、出力があれば使う
+    if not result.stdout:
+        stderr = result.stderr.decode('utf-8', 'replace').strip()
+        raise ValueError(f"音声をデコードできませんでした: {stderr[-200:]}")
+    return np.frombuffer(result.stdout, dtype='<i2').astype(np.float32) / 32768.0
+
+
+def compute_fingerprint(samples: np.ndarray) -> np.ndarray:
+    """PCMからサブフィンガープリント列（uint32）を計算"""
+    if len(samples) < FRAME_SIZE + HOP_SIZE:
+        return np.empty(0, dtype=np.uint32)
+    frames = np.lib.stride_tricks.sliding_window_view(samples, FRAME_SIZE)[::HOP_SIZE]
+    energies = np.empty((len(frames), BAND_COUNT), dtype=np.float32)
+    for start in range(0, len(frames), BLOCK_FRAMES):
+        block = frames[start:start + BLOCK_FRAMES] * WINDOW
+        spectrum = np.abs(np.fft.rfft(block, axis=1)) ** 2
+        energies[start:start + len(block)] = np.add.reduceat(spectrum, BAND_EDGES, axis=1)[:, :BAND_COUNT]
+
+    # 隣接バンドのエネルギー差が、前フレームより増えたかどうかを1bitにする
+    band_diff = energies[:, :-1] - energies[:, 1:]
+    bits = (band_diff[1:] - band_diff[:-1]) > 0
+    return np.packbits(bits, axis=1, bitorder='little').view('<u4').ravel().astype(np.uint32)
+
+
+def bit_error_rate(probe: np.ndarray, stored: np.ndarray, shift: int) -> tuple[float, int]:
+    """probe[i] と stored[i + shift] を重ねたときのビット誤り率と、重なったフレーム数"""
+    start = max(0, -shift)
+    end = min(len(probe), len(stored) - shift)
+    if end - start < MIN_OVERLAP_FRAMES:
+        return 1.0, 0
+    diff = probe[start:end] ^ stored[start + shift:end + shift]
+    errors = int(np.unpackbits(diff.view(np.uint8)).sum())
+    return errors / ((end - start) * 32), end - start
+
+
+@dataclass
+class LibraryMatch:
+    """ライブラリ内で見つかった同一音源"""
+    track_id: int
+    path: Path
+    reason: str  # "video" | "fingerprint"
+    ber: Optional[float] = None
+    shift_seconds: Optional[float] = None
+
+    def to_dict(self) -> dict:
+        return {
+            "track_id": self.track_id,
+            "reason": self.reason,
+            "ber": self.ber,
+            "shift_seconds": self.shift_seconds,
+        }
+
+
+class AudioLibrary:
+    """処理済み音源のファイルとフィンガープリントのインデックス
+
+    音源ファイルは library_dir に、インデックスは同じディレクトリのSQLiteに保存するため、
+    同一ホストの複数ワーカーで共有できる。合計サイズが max_bytes を超えたら
+    最近使われていないものから削除する。
+    """
+
+    def __init__(self, library_dir: Path, max_bytes: int, duration_tolerance: float = 5):
+        self.library_dir = Path(library_dir)
+        self.library_dir.mkdir(parents=True, exist_ok=True)
+        self.db_path = self.library_dir / "index.db"
+        self.max_bytes = max_bytes
+        self.duration_tolerance = duration_tolerance
+        self._local = threading.local()
+        self.stats = {"video_hits": 0, "fingerprint_hits": 0, "misses": 0, "added": 0, "evicted": 0}
+        self._stats_lock = threading.Lock()
+        self._connect().executescript("""
+            CREATE TABLE IF NOT EXISTS tracks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                path TEXT NOT NULL,
+                duration REAL NOT NULL,
+                size INTEGER NOT NULL,
+                fingerprint BLOB NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS tracks_duration ON tracks (duration);
+            CREATE INDEX IF NOT EXISTS tracks_last_used ON tracks (last_used);
+            CREATE TABLE IF NOT EXISTS hashes (
+                hash INTEGER NOT NULL,
+                track_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                PRIMARY KEY (hash, track_id, position)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS hashes_track ON hashes (track_id);
+            CREATE TABLE IF NOT EXISTS videos (
+                video_key TEXT PRIMARY KEY,
+                track_id INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS videos_track ON videos (track_id);
+        """)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS probe (hash INTEGER NOT NULL, position INTEGER NOT NULL)")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _count(self, key: str):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    # --- 検索 ---
+
+    def lookup_video(self, video_key: str) -> Optional[LibraryMatch]:
+        """同じ動画が登録済みか"""
+        match = self._find_video(video_key)
+        if match is not None:
+            self._touch(match.track_id)
+            self._count("video_hits")
+        return match
+
+    def _find_video(self, video_key: str) -> Optional[LibraryMatch]:
+        row = self._connect().execute(
+            "SELECT t.id, t.path FROM videos v JOIN tracks t ON t.id = v.track_id WHERE v.video_key = ?",
+            (video_key,),
+        ).fetchone()
+        return LibraryMatch(track_id=row[0], path=Path(row[1]), reason="video") if row else None
+
+    def lookup(self, fingerprint: np.ndarray, duration: float) -> Optional[LibraryMatch]:
+        """フィンガープリントと再生時間が一致する音源を探す"""
+        match = self._find(fingerprint, duration)
+        if match is None:
+            self._count("misses")
+            return None
+        self._touch(match.track_id)
+        self._count("fingerprint_hits")
+        return match
+
+    def _find(self, fingerprint: np.ndarray, duration: float) -> Optional[LibraryMatch]:
+        positions = np.flatnonzero(~np.isin(fingerprint, IGNORED_HASHES))
+        if len(positions) < MIN_OVERLAP_FRAMES:
+            return None
+
+        conn = self._connect()
+        conn.execute("DELETE FROM probe")
+        conn.executemany("INSERT INTO probe (hash, position) VALUES (?, ?)",
+                         zip(fingerprint[positions].tolist(), positions.tolist()))
+        # ハッシュが一致したフレームの時間ずれごとに投票し、票の多い候補だけを詳しく比較する
+        # （CROSS JOIN で照合側を外側に固定し、登録済みハッシュは主キーで引く）
+        candidates = conn.execute("""
+            SELECT h.track_id, h.position - p.position AS shift, COUNT(*) AS votes
+            FROM probe p
+            CROSS JOIN hashes h ON h.hash = p.hash
+            JOIN tracks t ON t.id = h.track_id
+            WHERE t.duration BETWEEN ? AND ?
+            GROUP BY h.track_id, shift
+            ORDER BY votes DESC
+            LIMIT ?
+        """, (duration - self.duration_tolerance, duration + self.duration_tolerance, MAX_CANDIDATES)).fetchall()
+        conn.execute("DELETE FROM probe")
+
+        best = None
+        for track_id, shift, votes in candidates:
+            row = conn.execute("SELECT path, fingerprint FROM tracks WHERE id = ?", (track_id,)).fetchone()
+            if row is None:
+                continue
+            stored = np.frombuffer(row[1], dtype='<u4')
+            ber, overlap = bit_error_rate(fingerprint, stored, shift)
+            logger.debug(f"フィンガープリント候補: track={track_id} shift={shift} votes={votes} BER={ber:.3f}")
+            if ber < BER_THRESHOLD and (best is None or ber < best.ber):
+                best = LibraryMatch(track_id=track_id, path=Path(row[0]), reason="fingerprint",
+                                    ber=round(ber, 4), shift_seconds=round(shift * HOP_SIZE / SAMPLE_RATE, 2))
+        return best
+
+    # --- 登録 ---
+
+    def add(self, video_key: str, source: Path, fingerprint: np.ndarray, duration: float) -> Optional[int]:
+        """音源ファイルをライブラリにコピーして登録し、track_id を返す
+
+        同じ音源がすでに登録済みなら、動画IDをその音源に関連付けるだけにする。
+        """
+        existing = self._find_video(video_key) or self._find(fingerprint, duration)
+        if existing is not None:
+            self.alias(video_key, existing.track_id)
+            return existing.track_id
+
+        indexed = np.arange(0, len(fingerprint), INDEX_STRIDE)
+        indexed = indexed[~np.isin(fingerprint[indexed], IGNORED_HASHES)]
+        if len(indexed) == 0:
+            return None
+
+        path = self.library_dir / f"{uuid.uuid4().hex}{source.suffix}"
+        shutil.copyfile(source, path)
+        size = path.stat().st_size
+        now = time.time()
+        try:
+            with self._transaction() as conn:
+                # 別のワーカーが先に登録していればそちらを使う
+                row = conn.execute("SELECT track_id FROM videos WHERE video_key = ?", (video_key,)).fetchone()
+                if row is not None:
+                    path.unlink(missing_ok=True)
+                    return row[0]
+                track_id = conn.execute(
+                    "INSERT INTO tracks (path, duration, size, fingerprint, created_at, last_used)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (str(path), duration, size, fingerprint.astype('<u4').tobytes(), now, now),
+                ).lastrowid
+                conn.executemany(
+                    "INSERT OR IGNORE INTO hashes (hash, track_id, position) VALUES (?, ?, ?)",
+                    ((h, track_id, p) for h, p in zip(fingerprint[indexed].tolist(), indexed.tolist())),
+                )
+                conn.execute("INSERT INTO videos (video_key, track_id) VALUES (?, ?)", (video_key, track_id))
+        except Exception:
+            path.unlink(missing_ok=True)
+            raise
+        self._count("added")
+        logger.info(f"📚 ライブラリに登録: track={track_id} ({video_key}, {size} bytes, {len(indexed)}ハッシュ)")
+        self._evict()
+        return track_id
+
+    def alias(self, video_key: str, track_id: int):
+        """別の動画IDを登録済みの音源に関連付ける（次回はフィンガープリント計算を省く）"""
+        with self._transaction() as conn:
+            conn.execute("INSERT OR IGNORE INTO videos (video_key, track_id) VALUES (?, ?)", (video_key, track_id))
+
+    def _touch(self, track_id: int):
+        try:
+            with self._transaction() as conn:
+                conn.execute("UPDATE tracks SET last_used = ? WHERE id = ?", (time.time(), track_id))
+        except sqlite3.Error as e:
+            logger.warning(f"ライブラリの使用日時の更新に失敗: {e}")
+
+    def _evict(self):
+        """合計サイズが上限を超えていれば最近使われていない音源から削除"""
+        if self.max_bytes <= 0:
+            return
+        removed = []
+        with self._transaction() as conn:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM tracks").fetchone()[0]
+            for track_id, path, size in conn.execute(
+                    "SELECT id, path, size FROM tracks ORDER BY last_used").fetchall():
+                if total <= self.max_bytes:
+                    break
+                conn.execute("DELETE FROM hashes WHERE track_id = ?", (track_id,))
+                conn.execute("DELETE FROM videos WHERE track_id = ?", (track_id,))
+                conn.execute("DELETE FROM tracks WHERE id = ?", (track_id,))
+                total -= size
+                removed.append(Path(path))
+        for path in removed:
+            path.unlink(missing_ok=True)
+            self._count("evicted")
+        if removed:
+            logger.info(f"ライブラリから{len(removed)}件を削除（容量上限）")
+
+    def snapshot(self) -> dict:
+        conn = self._connect()
+        tracks, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM tracks").fetchone()
+        videos = conn.execute("SELECT COUNT(*) FROM videos").fetchone()[0]
+        with self._stats_lock:
+            stats = dict(self.stats)
+        return {
+            "tracks": tracks,
+            "videos": videos,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            **stats,
+        }
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
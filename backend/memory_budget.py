@@ -0,0 +1,98 @@
+"""メモリ使用量の予算管理
+
+画像のデコードなど一時的に大きなメモリを使う処理は、事前に見積もった量を予算から
+確保してから実行する（同時に確保できる合計を制限する）。また、プロセスのRSSが
+上限を超えている間は新しいジョブの開始を遅らせる。
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryBudgetExceeded(Exception):
+    """予算内でメモリを確保できなかった"""
+
+
+def current_rss() -> Optional[int]:
+    """プロセスの現在のRSS（bytes）。取得できない環境では None"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class MemoryBudget:
+    """同時に確保できるメモリ量の上限を管理する（バイト数のセマフォ）"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self.waits = 0
+        self.rejected = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, amount: int, timeout: float = 30):
+        """amount バイトを確保して処理を実行。timeout 秒以内に確保できなければ例外"""
+        if amount > self.limit:
+            with self._condition:
+                self.rejected += 1
+            raise MemoryBudgetExceeded(f"必要なメモリ {amount} bytes が上限 {self.limit} bytes を超えています")
+
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            if self.used + amount > self.limit:
+                self.waits += 1
+            while self.used + amount > self.limit:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.rejected += 1
+                    raise MemoryBudgetExceeded(f"メモリ予算の空き待ちがタイムアウトしました ({amount} bytes)")
+                self._condition.wait(remaining)
+            self.used += amount
+            self.peak = max(self.peak, self.used)
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.used -= amount
+                self._condition.notify_all()
+
+    def snapshot(self) -> dict:
+        with self._condition:
+            return {
+                "limit": self.limit,
+                "used": self.used,
+                "peak": self.peak,
+                "waits": self.waits,
+                "rejected": self.rejected,
+            }
+
+
+def rss_over_limit(limit: int) -> bool:
+    """RSSが上限を超えているか（上限0または取得できない場合は False）"""
+    if limit <= 0:
+        return False
+    rss = current_rss()
+    return rss is not None and rss > limit
+
+
+async def wait_for_rss(limit: int, timeout: float, interval: float = 0.5) -> bool:
+    """RSSが上限を下回るまで待つ。timeout 秒を過ぎても下回らなければ False"""
+    if not rss_over_limit(limit):
+        return True
+    logger.warning(f"RSSが上限 {limit / 1e6:.0f} MB を超えているため、新しいジョブを待機させます")
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        await asyncio.sleep(interval)
+        if not rss_over_limit(limit):
+            return True
+    return False
@@ -0,0 +1,299 @@
+"""本番環境向けのオンデマンド・サンプリングプロファイラ
+
+管理APIで有効にしたときだけサンプリング用スレッドを起動し、`sys._current_frames()` から
+全スレッドのスタックを一定間隔で記録する。ウォールクロックでのサンプリングなので、
+Python の処理（正規表現、PIL、mutagen など）だけでなく、サブプロセスやネットワークの
+待ち時間もスタックとして現れる。結果は flamegraph.pl / speedscope で読める
+folded 形式（`frame;frame;frame count`）で出力する。
+
+無効時はサンプリング用スレッドが存在せず、管理トークンも未設定ならミドルウェアは
+真偽値を1つ確認するだけで素通しする（トークン設定時は X-Profile ヘッダーの有無だけを見る）。
+"""
+import logging
+import os
+import secrets
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# アプリのコードがあるディレクトリ（待機中のスレッドを除外する判定に使う）
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# スタックの末端がこれらの関数で、アプリのフレームを含まないスレッドは待機中とみなして除外する
+IDLE_FUNCTIONS = {"wait", "select", "poll", "epoll", "get", "_worker", "accept", "sleep"}
+
+MAX_STACK_DEPTH = 128
+
+
+@dataclass
+class ProfileSession:
+    """1回分のプロファイル"""
+    session_id: str
+    mode: str  # "requests" | "window" | "request"
+    interval: float
+    remaining_requests: int = 0
+    deadline: Optional[float] = None
+    inflight: int = 0
+    started_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    samples: int = 0
+    stacks: Counter = field(default_factory=Counter)
+    # X-Profile で開始した場合のリクエストID（クライアントが指定できるため識別子には使わない）
+    request_id: str = ""
+
+    @property
+    def finished(self) -> bool:
+        return self.finished_at is not None
+
+    def sampling(self, now: float) -> bool:
+        """このサンプルを記録する対象か"""
+        if self.finished:
+            return False
+        if self.mode == "window":
+            return now < self.deadline
+        return self.inflight > 0
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def summary(self, top: int = 30) -> dict:
+        """関数ごとの自己時間・累積時間の割合"""
+        self_counts = Counter()
+        total_counts = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")[1:]
+            if frames:
+                self_counts[frames[-1]] += count
+            for frame in set(frames):
+                total_counts[frame] += count
+        samples = self.samples or 1
+        return {
+            "session_id": self.session_id,
+            "mode": self.mode,
+            "request_id": self.request_id,
+            "interval_ms": self.interval * 1000,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "samples": self.samples,
+            "remaining_requests": self.remaining_requests,
+            "inflight": self.inflight,
+            "self": [{"frame": f, "ratio": c / samples} for f, c in self_counts.most_common(top)],
+            "total": [{"frame": f, "ratio": c / samples} for f, c in total_counts.most_common(top)],
+        }
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{getattr(code, 'co_qualname', code.co_name)} ({os.path.basename(code.co_filename)})"
+
+
+def _is_idle(frames: list) -> bool:
+    if not frames or frames[-1].f_code.co_name not in IDLE_FUNCTIONS:
+        return False
+    return not any(f.f_code.co_filename.startswith(APP_DIR) for f in frames)
+
+
+class Profiler:
+    """プロファイルセッションとサンプリング用スレッドを管理"""
+
+    def __init__(self, default_interval: float = 0.01, max_sessions: int = 20):
+        self.default_interval = default_interval
+        self.max_sessions = max_sessions
+        # ミドルウェアが確認するフラグ。False の間はサンプリング用スレッドも存在しない
+        self.armed = False
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    # --- セッション管理 ---
+
+    def start(self, requests: int = 0, seconds: float = 0, interval: float = None) -> ProfileSession:
+        """次の requests 件のリクエスト、または seconds 秒間のプロファイルを開始"""
+        interval = interval or self.default_interval
+        if requests > 0:
+            session = ProfileSession(uuid.uuid4().hex[:12], "requests", interval, remaining_requests=requests)
+        elif seconds > 0:
+            session = ProfileSession(uuid.uuid4().hex[:12], "window", interval, deadline=time.monotonic() + seconds)
+        else:
+            raise ValueError("requests または seconds を指定してください")
+        self._add(session)
+        logger.info(f"🔬 プロファイル開始: {session.session_id} ({session.mode})")
+        return session
+
+    def start_request(self, request_id: str) -> ProfileSession:
+        """1件のリクエストだけをプロファイル（X-Profile ヘッダー用）
+
+        セッションIDは常にサーバー側で発行する（同じ X-Request-ID の別リクエストと混ざらないように）。
+        """
+        session = ProfileSession(uuid.uuid4().hex[:12], "request", self.default_interval, inflight=1,
+                                 request_id=request_id or "")
+        self._add(session)
+        return session
+
+    def stop(self, session_id: str = None) -> list[ProfileSession]:
+        """実行中のセッションを終了（省略時はすべて）"""
+        with self._lock:
+            stopped = [s for s in self._sessions.values()
+                       if not s.finished and (session_id is None or s.session_id == session_id)]
+            for session in stopped:
+                session.finished_at = time.time()
+            self._update_armed()
+        return stopped
+
+    def get(self, session_id: str) -> Optional[ProfileSession]:
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def sessions(self) -> list[dict]:
+        with self._lock:
+            return [
+                {"session_id": s.session_id, "mode": s.mode, "request_id": s.request_id,
+                 "samples": s.samples, "finished": s.finished}
+                for s in reversed(self._sessions.values())
+            ]
+
+    def _add(self, session: ProfileSession):
+        with self._lock:
+            self._sessions[session.session_id] = session
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+            self._update_armed()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+                self._thread.start()
+
+    def _update_armed(self):
+        self.armed = any(not s.finished for s in self._sessions.values())
+
+    # --- リクエストの追跡 ---
+
+    def request_started(self) -> list[ProfileSession]:
+        """リクエスト数指定のセッションにこのリクエストを割り当てる"""
+        with self._lock:
+            claimed = []
+            for session in self._sessions.values():
+                if session.mode == "requests" and not session.finished and session.remaining_requests > 0:
+                    session.remaining_requests -= 1
+                    session.inflight += 1
+                    claimed.append(session)
+            return claimed
+
+    def request_finished(self, sessions: list[ProfileSession]):
+        with self._lock:
+            for session in sessions:
+                session.inflight -= 1
+                if session.inflight <= 0 and session.remaining_requests <= 0 and not session.finished:
+                    session.finished_at = time.time()
+                    logger.info(f"🔬 プロファイル完了: {session.session_id} ({session.samples}サンプル)")
+            self._update_armed()
+
+    # --- サンプリング ---
+
+    def _sample_loop(self):
+        own_id = threading.get_ident()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                for session in self._sessions.values():
+                    if session.mode == "window" and not session.finished and now >= session.deadline:
+                        session.finished_at = time.time()
+                        logger.info(f"🔬 プロファイル完了: {session.session_id} ({session.samples}サンプル)")
+                self._update_armed()
+                active = [s for s in self._sessions.values() if s.sampling(now)]
+                if not self.armed:
+                    self._thread = None
+                    return
+                interval = min((s.interval for s in active), default=self.default_interval)
+
+            if active:
+                stacks = self._collect(own_id)
+                with self._lock:
+                    for session in active:
+                        session.samples += 1
+                        session.stacks.update(stacks)
+            time.sleep(interval)
+
+    @staticmethod
+    def _collect(own_id: int) -> list[str]:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        stacks = []
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            frames = []
+            while frame is not None and len(frames) < MAX_STACK_DEPTH:
+                frames.append(frame)
+                frame = frame.f_back
+            frames.reverse()
+            if _is_idle(frames):
+                continue
+            thread_name = names.get(thread_id, str(thread_id))
+            # スレッドプールの番号はまとめる（flamegraphが細切れにならないように）
+            thread_name = thread_name.rstrip("0123456789_-") or thread_name
+            stacks.append(";".join([thread_name] + [_frame_label(f) for f in frames]))
+        return stacks
+
+
+class ProfilingMiddleware:
+    """プロファイル対象のリクエストを追跡する
+
+    プロファイルが有効でなければ何もしない。`X-Profile: 1` と正しい管理トークンを付けた
+    リクエストはそのリクエスト単独でプロファイルし、`X-Profile-ID` ヘッダーでIDを返す。
+    """
+
+    def __init__(self, app, profiler: Profiler, admin_token: str = "", request_id=None):
+        self.app = app
+        self.profiler = profiler
+        self.admin_token = admin_token
+        # 管理トークンがなければ X-Profile による個別プロファイルは受け付けない
+        self.opt_in_enabled = bool(admin_token)
+        self.request_id = request_id or (lambda: "")
+
+    def _opted_in(self, scope) -> bool:
+        # X-Profile がなければ他のヘッダーは見ない（トークンの比較は X-Profile 付きのときだけ）
+        profile = token = None
+        for name, value in scope.get("headers") or ():
+            if name == b"x-profile":
+                profile = value
+            elif name == b"x-admin-token":
+                token = value
+        if profile not in (b"1", b"true"):
+            return False
+        return secrets.compare_digest(token or b"", self.admin_token.encode())
+
+    async def __call__(self, scope, receive, send):
+        if not (self.profiler.armed or self.opt_in_enabled):
+            await self.app(scope, receive, send)
+            return
+        if scope["type"] != "http" or scope["path"].startswith("/admin/"):
+            await self.app(scope, receive, send)
+            return
+
+        opted_in = self.opt_in_enabled and self._opted_in(scope)
+        if not self.profiler.armed and not opted_in:
+            await self.app(scope, receive, send)
+            return
+
+        sessions = self.profiler.request_started()
+        if opted_in:
+            sessions.append(self.profiler.start_request(self.request_id()))
+        if not sessions:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start" and opted_in:
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-profile-id", sessions[-1].session_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            self.profiler.request_finished(sessions)
@@ -0,0 +1,143 @@
+"""HTTPレンジリクエストによる並列ダウンロード
+
+1本の接続ごとに帯域が絞られるストリームでも、バイト範囲を分割して複数の接続で
+同時に取得することで全体の転送時間を短縮する。各範囲は事前に確保したファイルの
+該当オフセットへ直接書き込むため、全体をメモリに保持することはない。
+"""
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# 1回の読み込みサイズ（メモリ上に保持するのはこのサイズまで）
+READ_SIZE = 256 * 1024
+# これより小さくは分割しない（リクエスト数が増えすぎないように）
+MIN_CHUNK_SIZE = 256 * 1024
+
+
+class RangeDownloadError(Exception):
+    """レンジリクエストでのダウンロードができない（サーバー非対応など）"""
+
+
+@dataclass
+class RangeDownloadStats:
+    """1ジョブ分の転送結果"""
+    bytes: int
+    seconds: float
+    connections: int
+    chunks: int
+
+    @property
+    def throughput(self) -> float:
+        """平均スループット（bytes/s）"""
+        return self.bytes / self.seconds if self.seconds > 0 else 0.0
+
+
+def probe_size(opener: Callable, url: str, headers: dict) -> int:
+    """先頭1バイトをレンジ指定で取得し、Content-Range から全体サイズを得る"""
+    response = opener(url, {**headers, 'Range': 'bytes=0-0'})
+    try:
+        content_range = response.headers.get('Content-Range', '')
+        match = re.match(r'bytes\s+0-0/(\d+)', content_range)
+        if response.status != 206 or not match:
+            raise RangeDownloadError(f"レンジリクエスト非対応 (status={response.status})")
+        return int(match.group(1))
+    finally:
+        response.close()
+
+
+def download_parallel(opener: Callable, url: str, output_path: Path, headers: Optional[dict] = None,
+                      connections: int = 4, chunk_size: int = 4 * 1024 * 1024,
+                      total_size: Optional[int] = None, retries: int = 3,
+                      should_abort: Optional[Callable[[], bool]] = None) -> RangeDownloadStats:
+    """URLを最大 chunk_size ごとのバイト範囲に分け、最大 connections 本で並列取得する
+
+    opener(url, headers) は status / headers / read(n) / close() を持つレスポンスを返す関数。
+    should_abort が True を返した時点で残りの取得を中止する。
+    """
+    headers = dict(headers or {})
+    if total_size is None:
+        total_size = probe_size(opener, url, headers)
+    if total_size <= 0:
+        raise RangeDownloadError("ファイルサイズが不明です")
+
+    # 小さいファイルでも接続数ぶんには分割する
+    chunk_size = max(MIN_CHUNK_SIZE, min(chunk_size, -(-total_size // connections)))
+    ranges = [(start, min(start + chunk_size, total_size) - 1) for start in range(0, total_size, chunk_size)]
+    connections = max(1, min(connections, len(ranges)))
+    logger.info(f"並列ダウンロード開始: {total_size} bytes, {len(ranges)}チャンク, {connections}接続")
+
+    downloaded = 0
+    downloaded_lock = threading.Lock()
+    aborted = threading.Event()
+
+    def fetch_range(fd: int, start: int, end: int):
+        nonlocal downloaded
+        for attempt in range(retries + 1):
+            offset = start
+            try:
+                response = opener(url, {**headers, 'Range': f'bytes={start}-{end}'})
+                try:
+                    if response.status != 206:
+                        raise RangeDownloadError(f"レンジリクエスト非対応 (status={response.status})")
+                    while offset <= end:
+                        if aborted.is_set() or (should_abort and should_abort()):
+                            aborted.set()
+                            raise RangeDownloadError("ダウンロードが中止されました")
+                        data = response.read(min(READ_SIZE, end - offset + 1))
+                        if not data:
+                            break
+                        os.pwrite(fd, data, offset)
+                        offset += len(data)
+                        with downloaded_lock:
+                            downloaded += len(data)
+                finally:
+                    response.close()
+                if offset > end:
+                    return
+                raise IOError(f"範囲 {start}-{end} の途中で接続が切れました ({offset - start} bytes)")
+            except RangeDownloadError:
+                raise
+            except Exception as e:
+                with downloaded_lock:
+                    downloaded -= offset - start
+                if attempt == retries:
+                    raise
+                logger.warning(f"範囲 {start}-{end} の取得に失敗、再試行 {attempt + 1}/{retries}: {e}")
+                time.sleep(min(2 ** attempt, 10))
+
+    start_time = time.perf_counter()
+    fd = os.open(output_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, total_size)
+        with ThreadPoolExecutor(max_workers=connections, thread_name_prefix='range-dl') as pool:
+            futures = [pool.submit(fetch_range, fd, start, end) for start, end in ranges]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                aborted.set()
+                for future in futures:
+                    future.cancel()
+                raise
+    except BaseException:
+        os.close(fd)
+        Path(output_path).unlink(missing_ok=True)
+        raise
+    os.close(fd)
+
+    stats = RangeDownloadStats(
+        bytes=downloaded,
+        seconds=time.perf_counter() - start_time,
+        connections=connections,
+        chunks=len(ranges),
+    )
+    logger.info(f"✅ 並列ダウンロード完了: {stats.bytes} bytes, {stats.seconds:.2f}s, {stats.throughput / 1e6:.2f} MB/s")
+    return stats
@@ -0,0 +1,204 @@
+"""プレビューとダウンロードの優先度付きスケジューリング
+
+到着順に処理すると、3時間のDJミックスが数分の曲や `/preview` を待たせてしまうため、
+処理を4つのレーンに分けて同時実行数を制限する。
+
+- preview:  プレビュー（情報取得のみ）。ダウンロードの待ちに影響されない
+- download: 通常のダウンロード。推定処理量（再生時間 × ビットレート）の小さい順に実行する
+- long:     一定時間より長い動画。同時実行数を少なく制限した別レーンで実行する
+- prefetch: 投機的プリフェッチ。download / long の枠は使わず、それらに待ちがある間は開始しない
+
+推定処理量の小さい順だけだと大きなジョブが後回しにされ続けるため、待った時間に
+応じて処理量を割り引く（エージング）。割引は全員に同じ速さでかかるので、
+`処理量 + 割引率 × 到着時刻` の小さい順に並べれば、いつ比較しても同じ順序になる。
+"""
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_LANE = "preview"
+DOWNLOAD_LANE = "download"
+LONG_LANE = "long"
+PREFETCH_LANE = "prefetch"
+
+# ビットレートが分からない場合の仮定（kbps）
+DEFAULT_BITRATE_KBPS = 128
+# 再生時間も分からない場合の推定処理量（bytes, 約5分の曲）
+UNKNOWN_COST = 5 * 1024 * 1024
+# キャンセルを確認する間隔（秒）
+POLL_INTERVAL = 0.5
+# 待ち時間のパーセンタイル計算に使う直近の件数
+RECENT_WAITS = 256
+
+
+class QueueTimeout(Exception):
+    """待機時間内に実行枠を確保できなかった"""
+
+
+class QueueCancelled(Exception):
+    """実行枠の待機中にキャンセルされた"""
+
+
+def estimate_cost(info: dict) -> float:
+    """ジョブの推定処理量（bytes）: 再生時間 × フォーマットのビットレート
+
+    ビットレートがなければファイルサイズ、どちらもなければ既定のビットレートで見積もる。
+    """
+    duration = info.get('duration') or 0
+    bitrate = info.get('abr') or info.get('tbr')
+    if duration and bitrate:
+        return duration * bitrate * 1000 / 8
+    size = info.get('filesize') or info.get('filesize_approx')
+    if size:
+        return float(size)
+    if duration:
+        return duration * DEFAULT_BITRATE_KBPS * 1000 / 8
+    return float(UNKNOWN_COST)
+
+
+@dataclass
+class _Ticket:
+    cost: float
+    key: float
+    enqueued_at: float
+
+
+@dataclass
+class _Lane:
+    name: str
+    slots: int
+    # これらのレーンに待ちがある間は実行枠を渡さない
+    yields_to: tuple = ()
+    running: int = 0
+    waiting: list = field(default_factory=list)
+    stats: dict = field(default_factory=lambda: {
+        "granted": 0, "waited": 0, "wait_seconds": 0.0, "max_wait": 0.0, "timeouts": 0, "cancelled": 0,
+    })
+    recent_waits: deque = field(default_factory=lambda: deque(maxlen=RECENT_WAITS))
+
+    def has_capacity(self) -> bool:
+        return self.slots <= 0 or self.running < self.slots
+
+
+class Slot:
+    """確保した実行枠（release() で返す。複数回呼んでもよい）"""
+
+    def __init__(self, scheduler: "WorkScheduler", lane: str, waited: float):
+        self.scheduler = scheduler
+        self.lane = lane
+        self.waited = waited
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.scheduler._release(self.lane)
+
+
+class WorkScheduler:
+    """レーンごとの同時実行数と、レーン内の実行順序を管理する（slots が0以下のレーンは無制限）"""
+
+    def __init__(self, download_slots: int = 4, long_slots: int = 1, preview_slots: int = 8,
+                 long_job_seconds: float = 1800, aging_bytes_per_second: float = 1024 * 1024,
+                 queue_timeout: float = 600, prefetch_slots: int = 1):
+        self.long_job_seconds = long_job_seconds
+        self.aging_bytes_per_second = aging_bytes_per_second
+        self.queue_timeout = queue_timeout
+        self._lanes = {
+            PREVIEW_LANE: _Lane(PREVIEW_LANE, preview_slots),
+            DOWNLOAD_LANE: _Lane(DOWNLOAD_LANE, download_slots),
+            LONG_LANE: _Lane(LONG_LANE, long_slots),
+            PREFETCH_LANE: _Lane(PREFETCH_LANE, prefetch_slots, yields_to=(DOWNLOAD_LANE, LONG_LANE)),
+        }
+        self._condition = threading.Condition()
+
+    def lane_for(self, duration: Optional[float]) -> str:
+        """再生時間からダウンロードのレーンを選ぶ"""
+        if self.long_job_seconds > 0 and duration and duration > self.long_job_seconds:
+            return LONG_LANE
+        return DOWNLOAD_LANE
+
+    def acquire(self, lane_name: str, cost: float = 0, cancel_event: threading.Event = None,
+                timeout: float = None) -> Slot:
+        """実行枠を確保する（空きがなければ順番が来るまで待つ）"""
+        lane = self._lanes[lane_name]
+        timeout = self.queue_timeout if timeout is None else timeout
+        now = time.monotonic()
+        ticket = _Ticket(cost=cost, key=cost + self.aging_bytes_per_second * now, enqueued_at=now)
+        deadline = now + timeout
+
+        with self._condition:
+            lane.waiting.append(ticket)
+            try:
+                while not (lane.has_capacity() and min(lane.waiting, key=lambda t: t.key) is ticket
+                           and not any(self._lanes[name].waiting for name in lane.yields_to)):
+                    if cancel_event is not None and cancel_event.is_set():
+                        lane.stats["cancelled"] += 1
+                        raise QueueCancelled("実行枠の待機中にキャンセルされました")
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        lane.stats["timeouts"] += 1
+                        raise QueueTimeout(f"混雑のため実行枠を確保できませんでした（{lane_name}, {timeout:g}秒）")
+                    self._condition.wait(min(remaining, POLL_INTERVAL))
+            finally:
+                lane.waiting.remove(ticket)
+                # 先頭が抜けたので次の待機者に確認させる
+                self._condition.notify_all()
+
+            lane.running += 1
+            waited = time.monotonic() - ticket.enqueued_at
+            lane.stats["granted"] += 1
+            lane.recent_waits.append(waited)
+            if waited > POLL_INTERVAL / 10:
+                lane.stats["waited"] += 1
+                lane.stats["wait_seconds"] += waited
+                lane.stats["max_wait"] = max(lane.stats["max_wait"], waited)
+
+        if waited >= 1:
+            logger.info(f"⏱️ 実行枠を確保: {lane_name} (待ち {waited:.1f}s, 推定 {cost / 1e6:.1f} MB)")
+        return Slot(self, lane_name, waited)
+
+    @contextmanager
+    def slot(self, lane_name: str, cost: float = 0, cancel_event: threading.Event = None):
+        """実行枠を確保して処理を実行"""
+        slot = self.acquire(lane_name, cost, cancel_event)
+        try:
+            yield slot
+        finally:
+            slot.release()
+
+    def _release(self, lane_name: str):
+        with self._condition:
+            self._lanes[lane_name].running -= 1
+            self._condition.notify_all()
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        with self._condition:
+            lanes = {}
+            for name, lane in self._lanes.items():
+                waits = sorted(lane.recent_waits)
+                lanes[name] = {
+                    "slots": lane.slots,
+                    "running": lane.running,
+                    "waiting": [
+                        {"cost": round(t.cost), "age": round(now - t.enqueued_at, 3)}
+                        for t in sorted(lane.waiting, key=lambda t: t.key)
+                    ],
+                    **lane.stats,
+                    "wait_seconds": round(lane.stats["wait_seconds"], 3),
+                    "max_wait": round(lane.stats["max_wait"], 3),
+                    "p50_wait": round(waits[len(waits) // 2], 3) if waits else 0.0,
+                    "p95_wait": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3) if waits else 0.0,
+                }
+        return {
+            "long_job_seconds": self.long_job_seconds,
+            "aging_bytes_per_second": self.aging_bytes_per_second,
+            "lanes": lanes,
+        }
@@ -0,0 +1,423 @@
+"""ワーカー・レプリカ間で共有する状態ストア
+
+ジョブ状態、ステージキャッシュ、シングルフライトロック、レート制限カウンタを
+プロセスの外に置くためのキー・バリューストア。`SHARED_STORE_URL` で切り替える。
+
+    memory://                      プロセス内（単一ワーカー向け、既定）
+    sqlite:////tmp/downloads/x.db  SQLite + ファイルロック（同一ホストの複数ワーカー向け）
+    redis://localhost:6379/0       Redis互換サーバー（複数レプリカ向け、redis-pyが必要）
+"""
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+
+class LockTimeout(Exception):
+    """ロックを時間内に取得できなかった"""
+
+
+class SharedStore(ABC):
+    """共有ストアの共通インターフェース
+
+    値はバイト列。期限（ttl, 秒）を過ぎたキーは存在しないものとして扱う。
+    未実装のメソッドがあるバックエンドはインスタンス化の時点でエラーになる。
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[bytes]:
+        """値を取得（なければ None）"""
+
+    @abstractmethod
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        """値を保存"""
+
+    @abstractmethod
+    def set_if_absent(self, key: str, value: bytes, ttl: Optional[float] = None) -> bool:
+        """キーが存在しない場合のみ保存し、保存したかどうかを返す"""
+
+    @abstractmethod
+    def delete(self, key: str):
+        """キーを削除"""
+
+    @abstractmethod
+    def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        """カウンタを加算して新しい値を返す（ttlはキー作成時のみ設定）"""
+
+    @contextmanager
+    @abstractmethod
+    def lock(self, name: str, ttl: float = 600, timeout: float = 600):
+        """ワーカー間の排他ロック（同じ処理の重複実行を防ぐ）"""
+
+    def get_json(self, key: str):
+        value = self.get(key)
+        return json.loads(value) if value is not None else None
+
+    def set_json(self, key: str, value, ttl: Optional[float] = None):
+        self.set(key, json.dumps(value, ensure_ascii=False, default=str).encode('utf-8'), ttl)
+
+    def hit_rate_limit(self, key: str, limit: int, window: float) -> bool:
+        """固定ウィンドウ方式でカウントし、上限を超えたら True を返す"""
+        bucket = int(time.time() // window)
+        return self.incr(f"ratelimit:{key}:{bucket}", ttl=window * 2) > limit
+
+    def close(self):
+        pass
+
+
+class MemoryStore(SharedStore):
+    """プロセス内ストア（単一ワーカー用）
+
+    キャッシュ（`cache_prefixes` で始まるキー）は合計バイト数で上限を設け、最近使われて
+    いないものから追い出す。カウンタ・ロック・ジョブ状態などそれ以外のキーは追い出さず、
+    期限切れでのみ削除する（追い出すとレート制限のカウンタがリセットされてしまうため）。
+    """
+
+    def __init__(self, max_cache_bytes: int = 64 * 1024 * 1024, cache_prefixes: tuple = ("stage:",)):
+        self.max_cache_bytes = max_cache_bytes
+        self.cache_prefixes = tuple(cache_prefixes)
+        self._entries = {}
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._named_locks = {}
+
+    def _map(self, key):
+        return self._cache if key.startswith(self.cache_prefixes) else self._entries
+
+    def _alive(self, key):
+        entries = self._map(key)
+        entry = entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and expires_at < time.time():
+            self._remove(key)
+            return None
+        if entries is self._cache:
+            self._cache.move_to_end(key)
+        return value
+
+    def _remove(self, key):
+        entries = self._map(key)
+        entry = entries.pop(key, None)
+        if entry is not None and entries is self._cache:
+            self._cache_bytes -= len(entry[1])
+
+    def _store(self, key, expires_at, value):
+        self._remove(key)
+        if key.startswith(self.cache_prefixes):
+            # 上限より大きい値はキャッシュしない
+            if len(value) > self.max_cache_bytes:
+                return
+            self._cache[key] = (expires_at, value)
+            self._cache_bytes += len(value)
+            while self._cache_bytes > self.max_cache_bytes:
+                _, (_, evicted) = self._cache.popitem(last=False)
+                self._cache_bytes -= len(evicted)
+        else:
+            self._entries[key] = (expires_at, value)
+            self._purge_expired()
+
+    def _put(self, key, value, ttl):
+        self._store(key, time.time() + ttl if ttl else None, value)
+
+    def _purge_expired(self):
+        # 書き込み100回ごとに期限切れのキーを掃除
+        self._writes += 1
+        if self._writes % 100 == 0:
+            now = time.time()
+            for key in [k for k, (expires_at, _) in self._entries.items() if expires_at is not None and expires_at < now]:
+                del self._entries[key]
+
+    def get(self, key):
+        with self._lock:
+            return self._alive(key)
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._put(key, value, ttl)
+
+    def set_if_absent(self, key, value, ttl=None):
+        with self._lock:
+            if self._alive(key) is not None:
+                return False
+            self._put(key, value, ttl)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def incr(self, key, amount=1, ttl=None):
+        with self._lock:
+            current = self._alive(key)
+            if current is None:
+                value = amount
+                self._put(key, str(value).encode(), ttl)
+            else:
+                value = int(current) + amount
+                self._store(key, self._map(key)[key][0], str(value).encode())
+            return value
+
+    @contextmanager
+    def lock(self, name, ttl=600, timeout=600):
+        # 名前ごとのロックは使用中のスレッド数を数え、誰も使わなくなったら削除する
+        with self._lock:
+            entry = self._named_locks.setdefault(name, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            if not entry[0].acquire(timeout=timeout):
+                raise LockTimeout(name)
+            try:
+                yield
+            finally:
+                entry[0].release()
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._named_locks[name]
+
+
+class SQLiteStore(SharedStore):
+    """SQLite + ファイルロックによる同一ホスト内の共有ストア"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock_dir = self.path.parent / f"{self.path.name}.locks"
+        self.lock_dir.mkdir(exist_ok=True)
+        self._local = threading.local()
+        # 書き込み回数とスレッドごとの接続一覧はスレッドプールの全スレッドから触るためロックで保護する
+        self._state_lock = threading.Lock()
+        self._writes = 0
+        self._connections = []
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv ("
+                " key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # 接続は作成したスレッドだけが使う（close() でまとめて閉じるため check_same_thread は無効にする）
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._state_lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _expires(self, ttl):
+        return time.time() + ttl if ttl else None
+
+    def _purge_expired(self, conn):
+        # 書き込み100回ごとに期限切れのキーを掃除
+        with self._state_lock:
+            self._writes += 1
+            purge = self._writes % 100 == 0
+        if purge:
+            conn.execute("DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at < ?", (time.time(),))
+
+    def get(self, key):
+        row = self._connect().execute(
+            "SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at >= ?)",
+            (key, time.time()),
+        ).fetchone()
+        return bytes(row[0]) if row else None
+
+    def set(self, key, value, ttl=None):
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, self._expires(ttl)),
+            )
+            self._purge_expired(conn)
+
+    def set_if_absent(self, key, value, ttl=None):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM kv WHERE key = ? AND expires_at < ?", (key, time.time()))
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, self._expires(ttl)),
+            )
+            return cursor.rowcount == 1
+
+    def delete(self, key):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def incr(self, key, amount=1, ttl=None):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM kv WHERE key = ? AND expires_at < ?", (key, time.time()))
+            row = conn.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                value = amount
+                conn.execute(
+                    "INSERT INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, str(value).encode(), self._expires(ttl)),
+                )
+            else:
+                value = int(bytes(row[0])) + amount
+                conn.execute("UPDATE kv SET value = ? WHERE key = ?", (str(value).encode(), key))
+            return value
+
+    @contextmanager
+    def lock(self, name, ttl=600, timeout=600):
+        # flockはプロセスが終了すると自動で解放されるため、ttlは不要。
+        # ロックファイルは解放時に削除する。削除前のファイルを開いて待っていた側は、
+        # 取得後にパスのファイルと一致しないことを確認して開き直す
+        digest = hashlib.sha1(name.encode('utf-8')).hexdigest()
+        path = self.lock_dir / f"{digest}.lock"
+        deadline = time.monotonic() + timeout
+        while True:
+            lock_file = open(path, 'a')
+            try:
+                while True:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if time.monotonic() > deadline:
+                            raise LockTimeout(name)
+                        time.sleep(0.05)
+                try:
+                    current = os.stat(path)
+                except FileNotFoundError:
+                    current = None
+                if current is not None and current.st_ino == os.fstat(lock_file.fileno()).st_ino:
+                    break
+            except BaseException:
+                lock_file.close()
+                raise
+            lock_file.close()
+        try:
+            yield
+        finally:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+    def close(self):
+        with self._state_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local.conn = None
+
+
+class RedisStore(SharedStore):
+    """Redis互換サーバーによる共有ストア
+
+    `get` / `set(ex=, nx=)` / `delete` / `incrby` / `expire` / `eval` を持つクライアントであれば
+    redis-py 以外（テスト用のスタンドインなど）でも利用できる。
+    """
+
+    # 自分のトークンのときだけロックを削除する（GETとDELの間に他のワーカーが取得したロックを消さない）
+    RELEASE_SCRIPT = (
+        "if redis.call('get', KEYS[1]) == ARGV[1] then "
+        "return redis.call('del', KEYS[1]) else return 0 end"
+    )
+
+    def __init__(self, client, prefix: str = "imusic:"):
+        self.client = client
+        self.prefix = prefix
+
+    def _key(self, key):
+        return f"{self.prefix}{key}"
+
+    @staticmethod
+    def _ex(ttl):
+        return max(1, int(ttl + 0.999)) if ttl else None
+
+    def get(self, key):
+        return self.client.get(self._key(key))
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self._key(key), value, ex=self._ex(ttl))
+
+    def set_if_absent(self, key, value, ttl=None):
+        return bool(self.client.set(self._key(key), value, ex=self._ex(ttl), nx=True))
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+    def incr(self, key, amount=1, ttl=None):
+        value = self.client.incrby(self._key(key), amount)
+        if value == amount and ttl:
+            self.client.expire(self._key(key), self._ex(ttl))
+        return int(value)
+
+    @contextmanager
+    def lock(self, name, ttl=600, timeout=600):
+        # ttl付きのキーでロックし、保持中のワーカーが落ちても期限で解放されるようにする
+        key = f"lock:{name}"
+        token = uuid.uuid4().hex.encode()
+        deadline = time.monotonic() + timeout
+        while not self.set_if_absent(key, token, ttl):
+            if time.monotonic() > deadline:
+                raise LockTimeout(name)
+            time.sleep(0.05)
+        try:
+            yield
+        finally:
+            self.client.eval(self.RELEASE_SCRIPT, 1, self._key(key), token)
+
+    def close(self):
+        close = getattr(self.client, 'close', None)
+        if close:
+            close()
+
+
+def create_store(url: Optional[str] = None, memory_cache_bytes: int = 64 * 1024 * 1024) -> SharedStore:
+    """URLから共有ストアを作成（memory_cache_bytes はプロセス内ストアのキャッシュ上限）"""
+    url = url or "memory://"
+    parsed = urlparse(url)
+
+    if parsed.scheme == "memory":
+        store = MemoryStore(max_cache_bytes=memory_cache_bytes)
+    elif parsed.scheme == "sqlite":
+        # sqlite:////abs/path.db → /abs/path.db, sqlite:///rel.db → rel.db
+        store = SQLiteStore(Path(url[len("sqlite:///"):]))
+    elif parsed.scheme in ("redis", "rediss", "unix"):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("Redisストアを使用するには redis パッケージが必要です: pip install redis")
+        store = RedisStore(redis.Redis.from_url(url))
+    else:
+        raise ValueError(f"未対応の共有ストアURL: {url}")
+
+    logger.info(f"共有ストア: {type(store).__name__} ({parsed.scheme}) pid={os.getpid()}")
+    return store
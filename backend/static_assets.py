@@ -0,0 +1,253 @@
+"""フロントエンドのビルド成果物（dist）の配信
+
+- 起動時に圧縮可能なファイルの `.gz`（brotli パッケージがあれば `.br` も）を事前に作成し、
+  リクエストの Accept-Encoding に合わせて圧縮済みのファイルをそのまま返す（リクエストごとの圧縮はしない）
+- `/assets/` 配下でファイル名にハッシュを含むもの（Viteの `index-DiwrgTda.js` など）は `immutable` で長期キャッシュさせ、
+  それ以外（index.html など）は ETag で再検証させる（変更がなければ304）
+- 小さいファイルは圧縮形式ごとにメモリに保持し、ディスクを読まずに返す
+  （メモリにない場合はディスクから返し、応答後にスレッドで読み込んでおく）
+"""
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import stat
+import threading
+from collections import OrderedDict
+from email.utils import formatdate
+from pathlib import Path
+from typing import Optional
+
+from starlette.background import BackgroundTask
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+
+try:
+    import brotli
+except ImportError:  # brotli は任意（なければ gzip のみ作成する）
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# 事前圧縮する拡張子（画像・フォントなど圧縮済みの形式は対象外）
+COMPRESSIBLE_EXTENSIONS = {'.js', '.mjs', '.css', '.html', '.svg', '.json', '.map', '.txt', '.xml', '.webmanifest', '.wasm'}
+# これより小さいファイルは圧縮しても効果がない
+MIN_COMPRESS_SIZE = 1024
+# 元のサイズの9割以上にしかならない場合は圧縮版を作らない
+MIN_COMPRESSION_RATIO = 0.9
+
+# 優先順（Accept-Encoding に両方含まれる場合は br を使う）
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+# Viteが付けるコンテンツハッシュ入りのファイル名（例: index-DiwrgTda.js, vendor-3f9a1c2e.css）
+# 大文字か数字を含む8文字に限る（apple-touch-icon.png や long-filename.css を誤って長期キャッシュさせない）
+HASHED_NAME = re.compile(r'-(?=[A-Za-z0-9_]{0,7}[A-Z0-9])[A-Za-z0-9_]{8}\.[A-Za-z0-9]+$')
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+
+def precompress_directory(directory: Path, min_size: int = MIN_COMPRESS_SIZE) -> dict:
+    """ディレクトリ内の圧縮可能なファイルについて `.gz` / `.br` を作成（既に最新なら何もしない）
+
+    複数ワーカーが同時に起動しても壊れたファイルを配信しないよう、一時ファイルに書いてから置き換える。
+    """
+    stats = {"files": 0, "created": 0, "skipped": 0, "original_bytes": 0, "compressed_bytes": 0}
+    compressors = [(".gz", lambda data: gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        compressors.insert(0, (".br", lambda data: brotli.compress(data, quality=11)))
+
+    for path in Path(directory).rglob("*"):
+        if path.suffix.lower() not in COMPRESSIBLE_EXTENSIONS or not path.is_file():
+            continue
+        source_stat = path.stat()
+        if source_stat.st_size < min_size:
+            continue
+        stats["files"] += 1
+        data = None
+        for suffix, compress in compressors:
+            target = path.with_name(path.name + suffix)
+            try:
+                if target.exists() and target.stat().st_mtime >= source_stat.st_mtime:
+                    stats["skipped"] += 1
+                    continue
+                data = data if data is not None else path.read_bytes()
+                compressed = compress(data)
+                if len(compressed) >= len(data) * MIN_COMPRESSION_RATIO:
+                    continue
+                temp = target.with_name(f".{target.name}.{os.getpid()}.tmp")
+                temp.write_bytes(compressed)
+                os.replace(temp, target)
+                stats["created"] += 1
+                stats["original_bytes"] += len(data)
+                stats["compressed_bytes"] += len(compressed)
+            except OSError as e:
+                logger.warning(f"事前圧縮に失敗: {target.name} ({e})")
+
+    logger.info(f"🗜️ 静的ファイルの事前圧縮: {stats['files']}ファイル, 作成 {stats['created']}, "
+                f"最新 {stats['skipped']}{'' if brotli else ' (brotli未インストールのためgzipのみ)'}")
+    return stats
+
+
+def _encoding_qualities(request_headers: Headers) -> dict:
+    """Accept-Encoding の圧縮形式ごとの q 値（q を省略したものは1、解釈できない q は0）"""
+    qualities = {}
+    for item in request_headers.get("accept-encoding", "").split(","):
+        name, *params = [part.strip() for part in item.split(";")]
+        if not name:
+            continue
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = min(max(float(value), 0.0), 1.0)
+                except ValueError:
+                    quality = 0.0
+        qualities[name.lower()] = quality
+    return qualities
+
+
+def _select_encoding(request_headers: Headers, available) -> Optional[str]:
+    """圧縮済みファイルのある形式から、q 値が最も高いものを選ぶ（同じなら br を優先、無圧縮の方が高ければ None）
+
+    明示されていない形式には `*` の q 値を使う。identity は明示的に除外されない限り受け付ける。
+    """
+    qualities = _encoding_qualities(request_headers)
+    wildcard = qualities.get("*")
+    best, best_quality = None, 0.0
+    for encoding, _ in ENCODINGS:
+        if encoding not in available:
+            continue
+        quality = qualities.get(encoding, wildcard or 0.0)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    identity = qualities.get("identity", 1.0 if wildcard is None else wildcard)
+    if best is None or best_quality < identity:
+        return None
+    return best
+
+
+def _etag(stat_result: os.stat_result) -> str:
+    """FileResponse と同じ形式のETag"""
+    base = f"{stat_result.st_mtime}-{stat_result.st_size}"
+    return f'"{hashlib.md5(base.encode(), usedforsecurity=False).hexdigest()}"'
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """圧縮済みファイルの選択・キャッシュヘッダー・小さいファイルのメモリキャッシュ付きの StaticFiles"""
+
+    def __init__(self, *args, memory_cache_bytes: int = 16 * 1024 * 1024,
+                 memory_cache_max_file_size: int = 128 * 1024, immutable_hashed: bool = False, **kwargs):
+        super().__init__(*args, **kwargs)
+        # ハッシュ入りのファイル名を immutable で返すか（ビルド成果物の assets ディレクトリのみ）
+        self.immutable_hashed = immutable_hashed
+        self.memory_cache_bytes = memory_cache_bytes
+        self.memory_cache_max_file_size = memory_cache_max_file_size
+        # パス -> (元ファイルの mtime, {圧縮形式: (圧縮済みファイルのパス, stat)})
+        self._variants = {}
+        # (パス, 圧縮形式) -> (ファイルのバージョン, 本文)
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        # メモリキャッシュはイベントループとスレッド（応答後の読み込み）の両方から触る
+        self._memory_lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk": 0, "not_modified": 0, "encoded": 0}
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope, status_code: int = 200) -> Response:
+        request_headers = Headers(scope=scope)
+        full_path = str(full_path)
+        variants = self._find_variants(full_path, stat_result)
+        encoding, served_path, served_stat = self._select_variant(full_path, stat_result, variants, request_headers)
+
+        headers = {
+            "cache-control": (IMMUTABLE_CACHE_CONTROL
+                              if self.immutable_hashed and HASHED_NAME.search(os.path.basename(full_path))
+                              else REVALIDATE_CACHE_CONTROL),
+            "etag": _etag(served_stat),
+            "last-modified": formatdate(served_stat.st_mtime, usegmt=True),
+        }
+        if variants:
+            headers["vary"] = "Accept-Encoding"
+        if encoding:
+            headers["content-encoding"] = encoding
+            self.stats["encoded"] += 1
+
+        if status_code == 200 and self.is_not_modified(Headers(headers), request_headers):
+            self.stats["not_modified"] += 1
+            return NotModifiedResponse(Headers(headers))
+
+        media_type = mimetypes.guess_type(full_path)[0] or "text/plain"
+        background = None
+        if served_stat.st_size <= self.memory_cache_max_file_size:
+            key = (full_path, encoding)
+            version = (stat_result.st_mtime, served_stat.st_mtime, served_stat.st_size)
+            body = self._memory_get(key, version)
+            if body is not None:
+                self.stats["memory_hits"] += 1
+                return Response(body, status_code=status_code, headers=headers, media_type=media_type)
+            # イベントループを止めないよう、メモリへの読み込みは応答後にスレッドで行う
+            background = BackgroundTask(self._load_into_memory, key, version, served_path)
+        self.stats["disk"] += 1
+        return FileResponse(served_path, status_code=status_code, headers=headers,
+                            media_type=media_type, stat_result=served_stat, background=background)
+
+    def _find_variants(self, full_path: str, stat_result: os.stat_result) -> dict:
+        """圧縮済みファイルの一覧（元ファイルより古いものは使わない）。元ファイルが変わるまで再確認しない"""
+        cached = self._variants.get(full_path)
+        if cached is not None and cached[0] == stat_result.st_mtime:
+            return cached[1]
+        variants = {}
+        for encoding, suffix in ENCODINGS:
+            try:
+                variant_stat = os.stat(full_path + suffix)
+            except OSError:
+                continue
+            if stat.S_ISREG(variant_stat.st_mode) and variant_stat.st_mtime >= stat_result.st_mtime:
+                variants[encoding] = (full_path + suffix, variant_stat)
+        self._variants[full_path] = (stat_result.st_mtime, variants)
+        return variants
+
+    @staticmethod
+    def _select_variant(full_path: str, stat_result: os.stat_result, variants: dict,
+                        request_headers: Headers) -> tuple[Optional[str], str, os.stat_result]:
+        """クライアントが受け付ける圧縮済みファイルがあればそれを選ぶ"""
+        encoding = _select_encoding(request_headers, variants) if variants else None
+        if encoding is not None:
+            return (encoding, *variants[encoding])
+        return None, full_path, stat_result
+
+    def _memory_get(self, key: tuple, version: tuple) -> Optional[bytes]:
+        """メモリに保持している本文（元ファイルが更新されていれば None）"""
+        with self._memory_lock:
+            cached = self._memory.get(key)
+            if cached is None or cached[0] != version:
+                return None
+            self._memory.move_to_end(key)
+            return cached[1]
+
+    def _load_into_memory(self, key: tuple, version: tuple, path: str):
+        """小さいファイルをメモリに読み込む（スレッドで実行）"""
+        try:
+            with open(path, "rb") as f:
+                body = f.read()
+        except OSError:
+            return
+        if len(body) != version[2]:
+            # 読み込み中に更新された
+            return
+        with self._memory_lock:
+            cached = self._memory.pop(key, None)
+            if cached is not None:
+                self._memory_size -= len(cached[1])
+            self._memory[key] = (version, body)
+            self._memory_size += len(body)
+            while self._memory_size > self.memory_cache_bytes and self._memory:
+                _, (_, evicted) = self._memory.popitem(last=False)
+                self._memory_size -= len(evicted)
+
+    def snapshot(self) -> dict:
+        with self._memory_lock:
+            memory = {"memory_entries": len(self._memory), "memory_bytes": self._memory_size}
+        return {**memory, **self.stats}
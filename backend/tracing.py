@@ -0,0 +1,391 @@
+"""リクエスト単位のトレーシング
+
+リクエストごとにIDを振り、パイプラインの各ステージを時間付きのスパンとして記録する。
+スパンはサンプリングされたリクエストのみ記録し、バックグラウンドスレッドから
+メモリ（/debug/traces）、JSON Linesファイル、OTLP/HTTP (JSON) 互換のコレクタへ送る。
+
+    TRACE_SAMPLE_RATE=0.1                      10%のリクエストを記録（0で無効）
+    TRACE_EXPORTER=memory,file,otlp            出力先（カンマ区切り）
+    TRACE_FILE=/tmp/imusic-traces.jsonl        file出力先
+    TRACE_OTLP_ENDPOINT=http://localhost:4318/v1/traces
+"""
+import contextvars
+import functools
+import json
+import logging
+import os
+import queue
+import random
+import secrets
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = "imusic-backend"
+
+
+@dataclass
+class Span:
+    """1つの処理区間"""
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str] = None
+    request_id: str = ""
+    start_ns: int = field(default_factory=time.time_ns)
+    end_ns: Optional[int] = None
+    attributes: dict = field(default_factory=dict)
+    error: Optional[str] = None
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "request_id": self.request_id,
+            "start": self.start_ns / 1e9,
+            "duration_ms": round(self.duration_ms, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class _NoopSpan:
+    """サンプリング対象外のリクエストで使う何もしないスパン"""
+
+    def set_attribute(self, key, value):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+_request_id = contextvars.ContextVar("request_id", default="")
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def current_request_id() -> str:
+    return _request_id.get()
+
+
+def set_attributes(**attributes):
+    """実行中のスパンに属性を追加（サンプリング対象外なら何もしない）"""
+    span = _current_span.get()
+    if span is not None:
+        span.attributes.update({k: v for k, v in attributes.items() if v is not None})
+
+
+# ---------------------------------------------------------------------------
+# エクスポーター
+# ---------------------------------------------------------------------------
+
+class MemoryExporter:
+    """直近のトレースをメモリに保持（/debug/traces 用）"""
+
+    def __init__(self, max_traces: int = 100):
+        self.max_traces = max_traces
+        self._traces = OrderedDict()
+        self._lock = threading.Lock()
+
+    def export(self, spans: list[Span]):
+        with self._lock:
+            for span in spans:
+                self._traces.setdefault(span.trace_id, []).append(span.to_dict())
+                self._traces.move_to_end(span.trace_id)
+            while len(self._traces) > self.max_traces:
+                self._traces.popitem(last=False)
+
+    def traces(self, request_id: str = None, limit: int = 20) -> list[dict]:
+        with self._lock:
+            traces = list(self._traces.values())
+        if request_id:
+            traces = [spans for spans in traces if any(s["request_id"] == request_id for s in spans)]
+        return [sorted(spans, key=lambda s: s["start"]) for spans in traces[-limit:]][::-1]
+
+
+class FileExporter:
+    """スパンを1行1件のJSONとしてファイルに追記"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    def export(self, spans: list[Span]):
+        with open(self.path, "a", encoding="utf-8") as f:
+            for span in spans:
+                f.write(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + "\n")
+
+
+class OTLPJsonExporter:
+    """OTLP/HTTP のJSONエンコーディングでコレクタへ送信"""
+
+    def __init__(self, endpoint: str, timeout: float = 5):
+        self.endpoint = endpoint
+        self.timeout = timeout
+
+    @staticmethod
+    def _value(value) -> dict:
+        if isinstance(value, bool):
+            return {"boolValue": value}
+        if isinstance(value, int):
+            return {"intValue": str(value)}
+        if isinstance(value, float):
+            return {"doubleValue": value}
+        return {"stringValue": str(value)}
+
+    def _span(self, span: Span) -> dict:
+        attributes = dict(span.attributes, **{"request.id": span.request_id})
+        encoded = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": 2 if span.parent_id is None else 1,
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns or span.start_ns),
+            "attributes": [{"key": k, "value": self._value(v)} for k, v in attributes.items()],
+            "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+        }
+        if span.parent_id:
+            encoded["parentSpanId"] = span.parent_id
+        return encoded
+
+    def export(self, spans: list[Span]):
+        payload = {
+            "resourceSpans": [{
+                "resource": {"attributes": [
+                    {"key": "service.name", "value": {"stringValue": SERVICE_NAME}},
+                    {"key": "process.pid", "value": {"intValue": str(os.getpid())}},
+                ]},
+                "scopeSpans": [{
+                    "scope": {"name": "imusic.tracing"},
+                    "spans": [self._span(span) for span in spans],
+                }],
+            }]
+        }
+        response = requests.post(self.endpoint, json=payload, timeout=self.timeout)
+        response.raise_for_status()
+
+
+class BatchProcessor:
+    """終了したスパンをキューに溜め、バックグラウンドスレッドでまとめて出力する
+
+    キューが一杯の場合はスパンを捨て、リクエスト処理を待たせない。
+    """
+
+    def __init__(self, exporters: list, max_queue: int = 2048, batch_size: int = 256, interval: float = 2.0):
+        self.exporters = exporters
+        self.batch_size = batch_size
+        self.interval = interval
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._worker, name="trace-export", daemon=True)
+        self._thread.start()
+
+    def on_end(self, span: Span):
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _drain(self) -> list[Span]:
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _export(self, batch: list[Span]):
+        for exporter in self.exporters:
+            try:
+                exporter.export(batch)
+            except Exception as e:
+                logger.warning(f"トレースの出力に失敗 ({type(exporter).__name__}): {e}")
+
+    def _worker(self):
+        while not self._stop.wait(self.interval):
+            while True:
+                batch = self._drain()
+                if not batch:
+                    break
+                self._export(batch)
+
+    def shutdown(self):
+        """残っているスパンを出力して停止"""
+        self._stop.set()
+        self._thread.join(timeout=self.interval + 1)
+        while True:
+            batch = self._drain()
+            if not batch:
+                break
+            self._export(batch)
+
+
+# ---------------------------------------------------------------------------
+# トレーサー
+# ---------------------------------------------------------------------------
+
+class Tracer:
+    """サンプリング付きのスパン生成"""
+
+    def __init__(self, sample_rate: float, processor: Optional[BatchProcessor] = None,
+                 memory: Optional[MemoryExporter] = None):
+        self.sample_rate = sample_rate
+        self.processor = processor
+        self.memory = memory
+
+    @contextmanager
+    def request(self, name: str, request_id: str = None, **attributes):
+        """リクエスト（またはバックグラウンドジョブ）のルートスパン
+
+        リクエストIDは常に設定し、スパンはサンプリングされた場合のみ記録する。
+        """
+        request_id = request_id or uuid.uuid4().hex[:16]
+        id_token = _request_id.set(request_id)
+        sampled = self.processor is not None and random.random() < self.sample_rate
+        try:
+            if sampled:
+                with self._start(name, secrets.token_hex(16), None, request_id, attributes) as span:
+                    yield span
+            else:
+                yield NOOP_SPAN
+        finally:
+            _request_id.reset(id_token)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """実行中のトレースに子スパンを追加（トレース外なら何もしない）"""
+        parent = _current_span.get()
+        if parent is None:
+            yield NOOP_SPAN
+            return
+        with self._start(name, parent.trace_id, parent.span_id, parent.request_id, attributes) as span:
+            yield span
+
+    def traced(self, name: str):
+        """関数全体をスパンにするデコレータ"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @contextmanager
+    def _start(self, name, trace_id, parent_id, request_id, attributes):
+        span = Span(
+            name=name,
+            trace_id=trace_id,
+            span_id=secrets.token_hex(8),
+            parent_id=parent_id,
+            request_id=request_id,
+            attributes={k: v for k, v in attributes.items() if v is not None},
+        )
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end_ns = time.time_ns()
+            self.processor.on_end(span)
+
+    def shutdown(self):
+        if self.processor is not None:
+            self.processor.shutdown()
+
+
+def create_tracer(sample_rate: float, exporters: str, file_path: str = None, otlp_endpoint: str = None) -> Tracer:
+    """環境変数の設定からトレーサーを作成"""
+    if sample_rate <= 0:
+        return Tracer(0.0)
+
+    memory = None
+    targets = []
+    for name in [e.strip() for e in exporters.split(",") if e.strip()]:
+        if name == "memory":
+            memory = MemoryExporter()
+            targets.append(memory)
+        elif name == "file":
+            targets.append(FileExporter(Path(file_path or "/tmp/imusic-traces.jsonl")))
+        elif name == "otlp":
+            targets.append(OTLPJsonExporter(otlp_endpoint or "http://localhost:4318/v1/traces"))
+        else:
+            raise ValueError(f"不明なトレース出力先: {name}")
+
+    logger.info(f"トレーシング有効: サンプリング率 {sample_rate}, 出力先 {exporters}")
+    return Tracer(sample_rate, BatchProcessor(targets), memory)
+
+
+class RequestIdFilter(logging.Filter):
+    """ログレコードにリクエストIDを付与"""
+
+    def filter(self, record):
+        record.request_id = _request_id.get() or "-"
+        return True
+
+
+def install_log_correlation(fmt: str = "%(levelname)s:%(name)s:[%(request_id)s] %(message)s"):
+    """ルートロガーのハンドラにリクエストIDを出力させる"""
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(RequestIdFilter())
+        handler.setFormatter(logging.Formatter(fmt))
+
+
+class TracingMiddleware:
+    """リクエストごとにIDを振り、レスポンス本文の送信完了までをルートスパンとして記録する
+
+    X-Request-ID ヘッダーがあればそれを引き継ぎ、レスポンスにも付与する。
+    """
+
+    def __init__(self, app, tracer: Tracer):
+        self.app = app
+        self.tracer = tracer
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        incoming = headers.get(b"x-request-id", b"").decode("latin-1")[:64]
+        request_id = incoming if incoming.replace("-", "").isalnum() else None
+
+        with self.tracer.request(f"{scope['method']} {scope['path']}", request_id,
+                                 **{"http.method": scope["method"], "http.path": scope["path"]}) as span:
+            sent_bytes = 0
+
+            async def send_with_id(message):
+                nonlocal sent_bytes
+                if message["type"] == "http.response.start":
+                    span.set_attribute("http.status_code", message["status"])
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"x-request-id", current_request_id().encode("latin-1"))]
+                elif message["type"] == "http.response.body":
+                    sent_bytes += len(message.get("body", b""))
+                    if not message.get("more_body", False):
+                        span.set_attribute("http.response_bytes", sent_bytes)
+                await send(message)
+
+            await self.app(scope, receive, send_with_id)
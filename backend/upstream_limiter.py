@@ -0,0 +1,231 @@
+"""上流（YouTubeなど）への送信レート制限
+
+1つのIPから短時間に大量のリクエストを送ると403やスロットリングを受けるため、
+上流ホストごとのリクエスト数と、全体の受信帯域をトークンバケットで制限する。
+待ち時間はホスト・帯域ごとに集計し、`/debug/upstream` で確認できる。
+
+既定ではプロセス内で制限し、共有ストアを渡すとワーカー間で共有する
+（1秒単位の枠をストアのカウンタで予約する近似方式）。共有時の帯域は読み込みごとではなく
+1秒分ずつまとめて予約し、ストアへの書き込みを減らす。
+"""
+import ipaddress
+import logging
+import threading
+import time
+from typing import Optional
+from urllib.parse import urlparse
+
+from shared_store import SharedStore
+
+logger = logging.getLogger(__name__)
+
+# これ以上待つ場合はログに出す（秒）
+LOG_WAIT_THRESHOLD = 1.0
+# 共有モードで先の枠を探す上限（これを超える待ちは最後の枠まで待つ）
+MAX_WINDOWS_AHEAD = 120
+# 共有モードで帯域をまとめて予約する量（秒分）
+BANDWIDTH_LEASE_SECONDS = 1.0
+
+
+def upstream_host(url: str) -> str:
+    """レート制限の単位となるホスト（サブドメインはまとめる: rr3---sn-xx.googlevideo.com → googlevideo.com）"""
+    host = (urlparse(url).hostname or "").lower()
+    try:
+        ipaddress.ip_address(host)
+        return host
+    except ValueError:
+        pass
+    return ".".join(host.split(".")[-2:])
+
+
+class TokenBucket:
+    """プロセス内のトークンバケット
+
+    予約した分だけ残量を減らし（マイナスも許す）、残量が0に戻るまでの時間を待ち時間として返す。
+    同時に予約したスレッドは予約順に間隔を空けて待つことになる。
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= amount
+            return max(0.0, -self._tokens / self.rate)
+
+
+class SharedWindowBucket:
+    """共有ストアのカウンタで1秒ごとの枠を予約するレート制限（複数ワーカー用）
+
+    現在の枠に空きがなければ次の枠を予約し、その枠の開始時刻までを待ち時間として返す。
+    """
+
+    def __init__(self, store: SharedStore, name: str, rate: float, window: float = 1.0):
+        self.store = store
+        self.name = name
+        self.limit = max(rate * window, 1)
+        self.window = window
+
+    def reserve(self, amount: float) -> float:
+        amount = max(1, int(amount))
+        now = time.time()
+        index = int(now // self.window)
+        for _ in range(MAX_WINDOWS_AHEAD):
+            key = f"upstream:{self.name}:{index}"
+            used = self.store.incr(key, amount, ttl=self.window * (MAX_WINDOWS_AHEAD + 2))
+            # 空の枠は1回分が上限より大きくても受け付ける
+            if used <= self.limit or used == amount:
+                return max(0.0, index * self.window - now)
+            self.store.incr(key, -amount)
+            index += 1
+        return max(0.0, index * self.window - now)
+
+
+class LeasedBucket:
+    """共有バケットからまとめて予約し、手元の残量から消費する
+
+    読み込みのたびにストアへ書き込むと、チャンクごとにSQLiteの書き込みやRedisの往復が発生するため、
+    lease 分をまとめて予約する。予約した枠が始まる時刻までは、手元の残量から使う分も待たせる。
+    """
+
+    def __init__(self, bucket, lease: float):
+        self.bucket = bucket
+        self.lease = max(1, lease)
+        self._available = 0.0
+        self._ready_at = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        with self._lock:
+            if amount > self._available:
+                size = max(amount - self._available, self.lease)
+                wait = self.bucket.reserve(size)
+                self._available += size
+                self._ready_at = max(self._ready_at, time.monotonic() + wait)
+            self._available -= amount
+            return max(0.0, self._ready_at - time.monotonic())
+
+
+class _PacedReader:
+    """レスポンス本文の読み込みを帯域制限に従わせるラッパー"""
+
+    def __init__(self, fp, limiter: "UpstreamLimiter"):
+        self._fp = fp
+        self._limiter = limiter
+
+    def read(self, *args, **kwargs):
+        data = self._fp.read(*args, **kwargs)
+        if data:
+            self._limiter.acquire_bytes(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._fp, name)
+
+
+class UpstreamLimiter:
+    """上流ホストごとのリクエスト数と全体の受信帯域の制限"""
+
+    def __init__(self, requests_per_second: float = 0, burst: float = 5, bytes_per_second: float = 0,
+                 host_rates: Optional[dict] = None, store: Optional[SharedStore] = None):
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.bytes_per_second = bytes_per_second
+        self.host_rates = dict(host_rates or {})
+        self.store = store
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._bandwidth = None
+        if bytes_per_second > 0:
+            self._bandwidth = self._new_bucket("bandwidth", bytes_per_second, bytes_per_second)
+            if store is not None:
+                self._bandwidth = LeasedBucket(self._bandwidth, bytes_per_second * BANDWIDTH_LEASE_SECONDS)
+        self._stats = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.requests_per_second > 0 or bool(self.host_rates) or self._bandwidth is not None
+
+    def _new_bucket(self, name: str, rate: float, burst: float):
+        if self.store is not None:
+            return SharedWindowBucket(self.store, name, rate)
+        return TokenBucket(rate, burst)
+
+    def _request_bucket(self, host: str):
+        rate = self.host_rates.get(host, self.requests_per_second)
+        if rate <= 0:
+            return None
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                bucket = self._buckets[host] = self._new_bucket(f"host:{host}", rate, self.burst)
+            return bucket
+
+    def _wait(self, key: str, bucket, amount: float) -> float:
+        wait = bucket.reserve(amount)
+        if wait > 0:
+            if wait >= LOG_WAIT_THRESHOLD:
+                logger.info(f"⏳ 上流のレート制限で {wait:.1f}s 待機 ({key})")
+            time.sleep(wait)
+        with self._lock:
+            stats = self._stats.setdefault(key, {"count": 0, "amount": 0, "waited": 0, "wait_seconds": 0.0, "max_wait": 0.0})
+            stats["count"] += 1
+            stats["amount"] += amount
+            if wait > 0:
+                stats["waited"] += 1
+                stats["wait_seconds"] += wait
+                stats["max_wait"] = max(stats["max_wait"], wait)
+        return wait
+
+    def acquire_request(self, url: str) -> float:
+        """リクエストを1件送ってよくなるまで待ち、待った秒数を返す"""
+        host = upstream_host(url)
+        bucket = self._request_bucket(host)
+        if bucket is None:
+            return 0.0
+        return self._wait(host, bucket, 1)
+
+    def acquire_bytes(self, amount: int) -> float:
+        """amount バイト受信した分の帯域を消費し、超過していれば待つ"""
+        if self._bandwidth is None:
+            return 0.0
+        return self._wait("bandwidth", self._bandwidth, amount)
+
+    def pace_response(self, response):
+        """yt-dlpのレスポンスの本文読み込みを帯域制限に従わせる"""
+        if self._bandwidth is not None and getattr(response, 'fp', None) is not None:
+            response.fp = _PacedReader(response.fp, self)
+        return response
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            stats = {key: dict(value, wait_seconds=round(value["wait_seconds"], 3), max_wait=round(value["max_wait"], 3))
+                     for key, value in self._stats.items()}
+        bandwidth = stats.pop("bandwidth", None)
+        return {
+            "enabled": self.enabled,
+            "shared": self.store is not None,
+            "requests_per_second": self.requests_per_second,
+            "host_rates": self.host_rates,
+            "bytes_per_second": self.bytes_per_second,
+            "hosts": stats,
+            "bandwidth": bandwidth,
+        }
+
+
+def parse_host_rates(value: str) -> dict:
+    """`googlevideo.com=10,youtube.com=2` 形式のホストごとの上限を読み込む"""
+    rates = {}
+    for item in value.split(","):
+        if "=" not in item:
+            continue
+        host, rate = item.split("=", 1)
+        rates[host.strip().lower()] = float(rate)
+    return rates